@@ -257,10 +257,19 @@ class WebControl(DiagnosticsControl):
     def _get_fallback_dir(self):
         return self.ctx.dir / "lib" / "fallback"
 
+    def _write_settings_snapshot(self, settings):
+        """Lets web workers load the settings without parsing config.xml"""
+        try:
+            settings.write_settings_snapshot()
+        except Exception as e:
+            self.ctx.err("WARNING: Failed to write %s: %s"
+                         % (settings.SETTINGS_SNAPSHOT_PATH, e))
+
     @config_required
     @assert_config_argtype
     def config(self, args, settings):
         """Generate a configuration file from a template"""
+        self._write_settings_snapshot(settings)
         server = args.type
         if args.http:
             port = args.http
@@ -468,6 +477,10 @@ class WebControl(DiagnosticsControl):
                          "[ERROR] Invalid omero.web.wsgi_worker_class %s" %
                          settings.WSGI_WORKER_CLASS)
 
+        from omeroweb.utils import is_preloaded
+        if is_preloaded(settings):
+            cmd += " --preload"
+
         cmd += " --timeout %(timeout)d"
         cmd += " --max-requests %(maxrequests)d"
         cmd += " %(wsgi_args)s"
@@ -476,6 +489,7 @@ class WebControl(DiagnosticsControl):
 
     @config_required
     def start(self, args, settings):
+        self._write_settings_snapshot(settings)
         self.collectstatic()
         if not args.keep_sessions:
             self.clearsessions(args)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+   Sampled, structured access log. For a sample of the requests, the view,
+   status, duration, web cache hits and misses and the calls to OMERO
+   services are logged as one line of JSON to the 'omeroweb.access' logger.
+   Requests that are not sampled only pay for one random() call.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('omeroweb.access')
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """Counters for a single sampled request."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.ice_calls = 0
+        self.ice_time = 0.0
+        self.ice_slowest = None
+        self.ice_slowest_time = 0.0
+        self.cache = {}
+        # Queries of a request may run on several threads, see run_queries()
+        self._lock = threading.Lock()
+
+    def ice_call(self, attr, seconds):
+        with self._lock:
+            self.ice_calls += 1
+            self.ice_time += seconds
+            if seconds > self.ice_slowest_time:
+                self.ice_slowest = attr
+                self.ice_slowest_time = seconds
+
+    def cache_outcome(self, outcome):
+        with self._lock:
+            self.cache[outcome] = self.cache.get(outcome, 0) + 1
+
+
+def get_request_stats():
+    """
+    Returns the L{RequestStats} of the request handled by this thread,
+    or None if the request is not sampled.
+    """
+    return getattr(_local, 'stats', None)
+
+
+def set_request_stats(stats):
+    """
+    Sets the L{RequestStats} of the request handled by this thread, e.g.
+    for a thread of a pool running queries of the request.
+    Returns the previous stats of the thread, to restore them afterwards.
+    """
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    return previous
+
+
+def record_cache(outcome):
+    """Counts a web cache 'hit' or 'miss' for the sampled request."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.cache_outcome(outcome)
+
+
+class AccessLogMiddleware(object):
+    """
+    Logs a sample of the requests, see omero.web.access_log.sample_rate.
+    Added as the first middleware when the sample rate is above 0.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.ACCESS_LOG_SAMPLE_RATE
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        stats = RequestStats()
+        previous = set_request_stats(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            set_request_stats(previous)
+        if response.streaming:
+            # Calls are also made while the content is streamed
+            response.streaming_content = self.stream(
+                request, response, stats, response.streaming_content)
+        else:
+            self.log(request, response, stats)
+        return response
+
+    def stream(self, request, response, stats, content):
+        """
+        Yields the streamed content, counting the calls made to produce
+        each chunk, and logs the request once streaming ends.
+        """
+        try:
+            content = iter(content)
+            while True:
+                previous = set_request_stats(stats)
+                try:
+                    chunk = next(content)
+                except StopIteration:
+                    break
+                finally:
+                    set_request_stats(previous)
+                yield chunk
+        finally:
+            self.log(request, response, stats)
+
+    def log(self, request, response, stats):
+        match = getattr(request, 'resolver_match', None)
+        record = {
+            'time': round(stats.start, 3),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match is not None else None,
+            'status': response.status_code,
+            'duration': round(time.time() - stats.start, 4),
+            'streaming': response.streaming,
+            'cache': stats.cache,
+            'ice_calls': stats.ice_calls,
+            'ice_time': round(stats.ice_time, 4),
+        }
+        if stats.ice_slowest is not None:
+            record['ice_slowest'] = stats.ice_slowest
+            record['ice_slowest_time'] = round(stats.ice_slowest_time, 4)
+        logger.info(json.dumps(record, sort_keys=True))
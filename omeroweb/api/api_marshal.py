@@ -20,6 +20,8 @@
 """Helper functions for views that handle object trees."""
 
 
+import omero
+from omero.rtypes import unwrap
 from omero_marshal import get_encoder
 
 
@@ -67,3 +69,37 @@ def marshal_objects(objects, extras=None, normalize=False):
     data, extra_objs = normalize_objects(marshalled)
     extra_objs['data'] = data
     return extra_objs
+
+
+def marshal_projection(rows, object_type, fields, extras=None):
+    """
+    Marshal rows from a projection query to a subset of omero_marshal json.
+
+    The first column of each row is the object ID and the others
+    correspond to the values of fields, in the same order.
+    Nested keys are created for paths such as ('omero:details', 'owner').
+
+    @param object_type: Type of object queried, e.g. Project
+    @param fields:      Dict of name: (hql, path) where path is a tuple of
+                        keys for the value in the marshalled dict
+    @param extras:      A dict of id:dict to add extra data to each object
+    """
+    model_class = getattr(omero.model, '%sI' % object_type)
+    schema_type = get_encoder(model_class).TYPE
+    paths = [path for hql, path in fields.values()]
+    marshalled = []
+    for row in rows:
+        obj_id = unwrap(row[0])
+        m = {'@id': obj_id, '@type': schema_type}
+        for path, value in zip(paths, row[1:]):
+            value = unwrap(value)
+            if value is None:
+                continue
+            target = m
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+        if extras is not None and obj_id in extras:
+            m.update(extras[obj_id])
+        marshalled.append(m)
+    return {'data': marshalled}
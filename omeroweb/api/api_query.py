@@ -22,15 +22,27 @@
 
 from omero.rtypes import unwrap, wrap, rlong
 from omero.sys import ParametersI
+from django.core.cache import cache
 from . import api_settings
 
-from .api_marshal import marshal_objects
+from .api_exceptions import BadRequestError
+from .api_marshal import marshal_objects, marshal_projection
+from omeroweb.utils import run_chunked
 from copy import deepcopy
+import base64
+import binascii
+import hashlib
+import json
+import re
 
 
 MAX_LIMIT = max(1, api_settings.API_MAX_LIMIT)
 DEFAULT_LIMIT = max(1, api_settings.API_LIMIT)
 
+# opts that don't change the number of objects matched by a query
+PAGING_OPTS = ('offset', 'limit', 'cursor', 'order_by', 'total_count',
+               'child_count')
+
 
 def get_wellsample_indices(conn, plate_id=None, plateacquisition_id=None):
     """
@@ -68,18 +80,302 @@ def get_child_counts(conn, link_class, parent_ids):
     """
     ctx = deepcopy(conn.SERVICE_OPTS)
     ctx.setOmeroGroup(-1)
-    params = ParametersI()
-    params.add('ids', wrap([rlong(id) for id in parent_ids]))
     query = ("select chl.parent.id, count(chl.id) from %s chl"
              " where chl.parent.id in (:ids) group by chl.parent.id"
              % link_class)
-    result = conn.getQueryService().projection(query, params, ctx)
+    qs = conn.getQueryService()
+
+    def count_children(ids):
+        params = ParametersI()
+        params.add('ids', wrap([rlong(id) for id in ids]))
+        return qs.projection(query, params, ctx)
+
     counts = {}
-    for d in result:
+    for d in run_chunked(conn, count_children, parent_ids):
         counts[d[0].val] = unwrap(d[1])
     return counts
 
 
+def encode_cursor(values):
+    """
+    Encode the sort key values of an object as an opaque cursor token.
+
+    @param values:      List of values, as returned by get_sort_keys()
+    @return             A url-safe string
+    """
+    token = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Decode a cursor token created by encode_cursor().
+
+    Raises BadRequestError if the token is not valid.
+
+    @param token:       Cursor string from the client
+    @return             List of sort key values
+    """
+    try:
+        token = token + '=' * (-len(token) % 4)
+        values = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError, binascii.Error):
+        values = None
+    if not isinstance(values, list) or len(values) == 0:
+        raise BadRequestError('Invalid cursor: %s' % token.rstrip('='))
+    return values
+
+
+def get_sort_keys(opts):
+    """
+    Return the HQL expressions used to sort and page through objects.
+
+    These are the 'order_by' expressions from opts, always ending with
+    'obj.id' so that the ordering is unique.
+    """
+    order_by = opts.get('order_by')
+    keys = []
+    if order_by:
+        keys = [k.strip() for k in order_by.split(',')]
+    return [k for k in keys if k != 'obj.id'] + ['obj.id']
+
+
+def build_keyset_clause(sort_keys, values, params):
+    """
+    Build an HQL clause that matches objects sorting after the cursor.
+
+    Objects are compared on each sort key in turn, with nulls sorting
+    last, as they do in ascending order in the database.
+
+    @param sort_keys:   List of HQL expressions from get_sort_keys()
+    @param values:      Values of the sort keys for the last object seen
+    @param params:      ParametersI that cursor values are added to
+    @return             The HQL clause
+    """
+    terms = []
+    equal = []
+    for i, (key, value) in enumerate(zip(sort_keys, values)):
+        if value is None:
+            # Nothing sorts after null, just match other nulls
+            equal.append('%s is null' % key)
+            continue
+        name = 'cursor%s' % i
+        if key == 'obj.id':
+            params.add(name, rlong(value))
+            after = '%s > :%s' % (key, name)
+        else:
+            params.add(name, wrap(value))
+            after = '(%s > :%s or %s is null)' % (key, name, key)
+        terms.append(' and '.join(equal + [after]))
+        equal.append('%s = :%s' % (key, name))
+    return ' or '.join(['(%s)' % t for t in terms])
+
+
+def apply_keyset(query, sort_keys, clause=None):
+    """
+    Add the keyset clause and sort keys to a query from conn.buildQuery().
+
+    Any 'order by' in the query is replaced by the sort keys.
+    """
+    order_by = query.rfind(' order by ')
+    if order_by >= 0:
+        query = query[:order_by]
+    if clause:
+        where = query.find(' where ')
+        if where >= 0:
+            query = '%s where (%s) and (%s)' % (
+                query[:where], query[where + len(' where '):], clause)
+        else:
+            query = '%s where %s' % (query, clause)
+    return '%s order by %s' % (query, ', '.join(sort_keys))
+
+
+def get_next_cursor(conn, object_type, sort_keys, obj_id, ctx):
+    """
+    Return the cursor token for the page following the object obj_id.
+
+    Sort key values are looked up by id, so this is cheap regardless
+    of how deep into the listing we are.
+    """
+    params = ParametersI()
+    params.addId(obj_id)
+    query = "select %s from %s obj where obj.id = :id" % (
+        ', '.join(sort_keys), object_type)
+    result = conn.getQueryService().projection(query, params, ctx)
+    return encode_cursor([unwrap(v) for v in result[0]])
+
+
+def projection_query(query, fields):
+    """
+    Turn a query from conn.buildQuery() into a projection of fields.
+
+    Fetch joins are kept as plain joins since they may be used by the
+    filters in the 'where' clause. Joins of collections, e.g. of links
+    to filter by parent, return a row per link so the projection is
+    distinct. The 'order by' expressions are added to the selected
+    columns after the fields, as required with 'distinct'.
+
+    @param query:       HQL query of the form 'select obj from ...'
+    @param fields:      Dict of name: (hql, path), see marshal_projection()
+    @return             HQL query selecting obj.id followed by fields
+    """
+    exprs = ['obj.id'] + [hql for hql, path in fields.values()]
+    order_by = query.rfind(' order by ')
+    if order_by >= 0:
+        for expr in split_expressions(query[order_by + len(' order by '):]):
+            if expr not in exprs:
+                exprs.append(expr)
+    query, n = re.subn(r'^\s*select (distinct )?obj ',
+                       'select distinct %s ' % ', '.join(exprs), query)
+    if n != 1:
+        raise BadRequestError('Projection not supported for: %s' % query)
+    return query.replace(' join fetch ', ' join ')
+
+
+def split_expressions(text):
+    """Split comma-separated HQL expressions, ignoring nested commas."""
+    exprs = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(text):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            exprs.append(text[start:i].strip())
+            start = i + 1
+    exprs.append(text[start:].strip())
+    return [e for e in exprs if e]
+
+
+def _count_cache_key(conn, object_type, group, opts):
+    """Return the part of count cache keys identifying the listing."""
+    filters = sorted([(k, v) for k, v in opts.items()
+                      if k not in PAGING_OPTS
+                      and not k.startswith('load_')])
+    key = repr((getattr(conn, 'host', None), conn.getUserId(),
+                object_type, group, filters))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def count_objects(conn, object_type, group, opts, ctx):
+    """
+    Count the objects matching the filters in opts.
+
+    Counts are cached for API_COUNT_CACHE_TIMEOUT seconds per user,
+    object_type, group and filter.
+
+    @param conn:        BlitzGateway
+    @param object_type: Type to query, e.g. Project
+    @param group:       ExperimenterGroup ID of the query context
+    @param opts:        Options dict for conn.buildCountQuery()
+    @param ctx:         Service options for the query
+    """
+    timeout = api_settings.API_COUNT_CACHE_TIMEOUT
+    if timeout > 0:
+        key = 'omero.web.api.count.%s' % _count_cache_key(
+            conn, object_type, group, opts)
+        count = cache.get(key)
+        if count is not None:
+            return count
+
+    count_query, params = conn.buildCountQuery(object_type, opts=opts)
+    result = conn.getQueryService().projection(count_query, params, ctx)
+    count = result[0][0].val
+    if timeout > 0:
+        cache.set(key, count, timeout)
+    return count
+
+
+# Links between the objects of a listing and the object it is filtered by,
+# e.g. Datasets filtered by 'project'. Linking and unlinking children
+# doesn't change the updateEvent of the objects, so the links are part of
+# the validators. Values are (link class, property of the filter object).
+LINK_FILTERS = {
+    ('Project', 'dataset'): ('ProjectDatasetLink', 'child'),
+    ('Dataset', 'project'): ('ProjectDatasetLink', 'parent'),
+    ('Dataset', 'image'): ('DatasetImageLink', 'child'),
+    ('Image', 'dataset'): ('DatasetImageLink', 'parent'),
+    ('Screen', 'plate'): ('ScreenPlateLink', 'child'),
+    ('Plate', 'screen'): ('ScreenPlateLink', 'parent'),
+    ('Experimenter', 'experimentergroup'): ('GroupExperimenterMap',
+                                            'parent'),
+    ('ExperimenterGroup', 'experimenter'): ('GroupExperimenterMap',
+                                            'child'),
+}
+
+
+def get_validators(conn, object_type, group=None, opts=None, cached=False):
+    """
+    Return values that change whenever the objects matching opts change.
+
+    This is a lightweight projection of the max(updateEvent) and count()
+    of the objects, ignoring paging, for use in ETags. For listings
+    filtered by a parent or child, the max(id) and count() of the links
+    to it are added.
+
+    The values are cached like the count of count_objects(), which is
+    also set from them. Cached values are only returned if 'cached' is
+    True: a 304 response must be based on current values.
+
+    @param conn:        BlitzGateway
+    @param object_type: Type to query, e.g. Project
+    @param group:       Filter query by ExperimenterGroup ID
+    @param opts:        Options dict for conn.buildQuery()
+    @param cached:      If True, return cached values if we have them
+    @return             List of values
+    """
+    opts = validate_opts(dict(opts or {}))
+    for key in list(opts.keys()):
+        if key.startswith('load_'):
+            opts[key] = False
+    if group is None:
+        group = -1
+    timeout = api_settings.API_COUNT_CACHE_TIMEOUT
+    if timeout > 0:
+        cache_key = _count_cache_key(conn, object_type, group, opts)
+        if cached:
+            values = cache.get('omero.web.api.validators.%s' % cache_key)
+            if values is not None:
+                return values
+
+    query, params, wrapper = conn.buildQuery(object_type, opts=opts)
+    order_by = query.rfind(' order by ')
+    if order_by >= 0:
+        query = query[:order_by]
+    query, n = re.subn(
+        r'^\s*select (distinct )?obj ',
+        'select max(obj.details.updateEvent.id), count(distinct obj.id) ',
+        query)
+    if n != 1:
+        return None
+    query = query.replace(' join fetch ', ' join ')
+    params.noPage()
+    ctx = deepcopy(conn.SERVICE_OPTS)
+    ctx.setOmeroGroup(group)
+    qs = conn.getQueryService()
+    result = qs.projection(query, params, ctx)
+    values = [unwrap(v) for v in result[0]]
+
+    for (otype, opt), (link_class, prop) in sorted(LINK_FILTERS.items()):
+        if otype != object_type or opts.get(opt) is None:
+            continue
+        link_params = ParametersI()
+        link_params.addId(opts[opt])
+        link_query = ('select max(link.id), count(link.id) from %s link'
+                      ' where link.%s.id = :id' % (link_class, prop))
+        result = qs.projection(link_query, link_params, ctx)
+        values.extend(unwrap(v) for v in result[0])
+
+    if timeout > 0:
+        cache.set('omero.web.api.validators.%s' % cache_key, values,
+                  timeout)
+        cache.set('omero.web.api.count.%s' % cache_key, values[1], timeout)
+    return values
+
+
 def validate_opts(opts):
     """Check that opts dict has valid 'limit' and 'offset'."""
     if opts is None:
@@ -95,22 +391,49 @@ def validate_opts(opts):
 def query_objects(conn, object_type,
                   group=None,
                   opts=None,
-                  normalize=False):
+                  normalize=False,
+                  fields=None):
     """
     Base query method, handles different object_types.
 
     Builds a query and adds common
     parameters and filters such as by owner or group.
+    If opts['cursor'] is not None (empty string for the first page)
+    we use keyset pagination instead of 'offset' and add the
+    cursor for the next page to meta['next'].
+    If opts['total_count'] is False, we don't count the objects.
+    If fields are specified, we only load those fields with a projection
+    query instead of loading and marshalling whole objects.
 
     @param conn:        BlitzGateway
     @param object_type: Type to query, e.g. Project
     @param group:       Filter query by ExperimenterGroup ID
     @param opts:        Options dict for conn.buildQuery()
     @param normalize:   If true, marshal groups and experimenters separately
+    @param fields:      Dict of name: (hql, path), see marshal_projection()
     """
     opts = validate_opts(opts)
+    if fields is not None:
+        # Don't load any graphs we won't marshal
+        for key in list(opts.keys()):
+            if key.startswith('load_'):
+                opts[key] = False
+    sort_keys = None
+    if opts.get('cursor') is not None:
+        sort_keys = get_sort_keys(opts)
+        opts['offset'] = 0
     # buildQuery is used by conn.getObjects()
     query, params, wrapper = conn.buildQuery(object_type, opts=opts)
+    if sort_keys is not None:
+        clause = None
+        if opts['cursor']:
+            values = decode_cursor(opts['cursor'])
+            if len(values) != len(sort_keys):
+                raise BadRequestError('Invalid cursor: %s' % opts['cursor'])
+            clause = build_keyset_clause(sort_keys, values, params)
+        query = apply_keyset(query, sort_keys, clause)
+    if fields is not None:
+        query = projection_query(query, fields)
     # Set the desired group context
     ctx = deepcopy(conn.SERVICE_OPTS)
     if group is None:
@@ -124,29 +447,64 @@ def query_objects(conn, object_type,
 
     if opts['limit'] == 0:
         result = []
+    elif fields is not None:
+        result = qs.projection(query, params, ctx)
     else:
         result = qs.findAllByQuery(query, params, ctx)
     for obj in result:
         objects.append(obj)
+    if fields is not None:
+        obj_ids = [row[0].val for row in objects]
+    else:
+        obj_ids = [obj.id.val for obj in objects]
 
     # Optionally get child counts...
     if opts and opts.get('child_count') and wrapper.LINK_CLASS:
-        obj_ids = [r.id.val for r in result]
         counts = get_child_counts(conn, wrapper.LINK_CLASS, obj_ids)
         for obj_id in obj_ids:
             count = counts[obj_id] if obj_id in counts else 0
             extras[obj_id] = {'omero:childCount': count}
 
-    # Query the count() of objects & add to 'meta' dict
-    count_query, params = conn.buildCountQuery(object_type, opts=opts)
-    result = qs.projection(count_query, params, ctx)
-
     meta = {}
     meta['offset'] = opts['offset']
     meta['limit'] = opts['limit']
     meta['maxLimit'] = MAX_LIMIT
-    meta['totalCount'] = result[0][0].val
+    # Query the count() of objects & add to 'meta' dict
+    if opts.get('total_count', True):
+        meta['totalCount'] = count_objects(conn, object_type, group,
+                                           opts, ctx)
+    if sort_keys is not None:
+        meta['next'] = None
+        if len(objects) > 0 and len(objects) == opts['limit']:
+            meta['next'] = get_next_cursor(conn, object_type, sort_keys,
+                                           obj_ids[-1], ctx)
 
-    marshalled = marshal_objects(objects, extras=extras, normalize=normalize)
+    if fields is not None:
+        marshalled = marshal_projection(objects, object_type, fields,
+                                        extras=extras)
+    else:
+        marshalled = marshal_objects(objects, extras=extras,
+                                     normalize=normalize)
     marshalled['meta'] = meta
     return marshalled
+
+
+def iter_objects(conn, object_type, group=None, opts=None, fields=None):
+    """
+    Generator of marshalled objects, for streaming large listings.
+
+    Pages through all the objects matching opts with keyset pagination,
+    MAX_LIMIT objects at a time, so that memory use is bounded by the
+    page size rather than the number of objects.
+    Arguments are the same as for query_objects().
+    """
+    opts = dict(opts or {})
+    opts['limit'] = MAX_LIMIT
+    opts['cursor'] = ''
+    opts['total_count'] = False
+    while opts['cursor'] is not None:
+        marshalled = query_objects(conn, object_type, group, opts,
+                                   fields=fields)
+        for m in marshalled['data']:
+            yield m
+        opts['cursor'] = marshalled['meta']['next']
@@ -45,6 +45,14 @@ API_SETTINGS_MAPPING = {
           "request.build_absolute_uri() to generate absolute urls "
           "based on each request. If set to a string or empty string, "
           "this will be used as prefix to relative urls.")],
+    "omero.web.api.count_cache_timeout":
+        ["API_COUNT_CACHE_TIMEOUT",
+         10,
+         int,
+         ("Number of seconds that the 'totalCount' of json api listings "
+          "is cached for each user, object type and filter. Counts are "
+          "stored in the Django cache configured by "
+          ":property:`omero.web.caches`. Set to 0 to disable.")],
 }
 
 process_custom_settings(sys.modules[__name__], 'API_SETTINGS_MAPPING')
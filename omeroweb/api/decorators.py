@@ -26,6 +26,7 @@ import omeroweb.decorators
 import logging
 import traceback
 from django.http import JsonResponse
+from django.http.response import HttpResponseBase
 from functools import update_wrapper
 from . import api_settings
 from .api_exceptions import BadRequestError, \
@@ -71,7 +72,12 @@ class json_response(object):
 
         By default, we simply return a JsonResponse() but this can be
         overwritten by subclasses if needed.
+        If the wrapped function returns an HttpResponse, e.g. for streaming,
+        we only add the global headers.
         """
+        if isinstance(rv, HttpResponseBase):
+            rv['X-OMERO-ApiVersion'] = api_settings.API_VERSION
+            return rv
         return self.create_response(rv)
 
     def handle_error(self, ex, trace):
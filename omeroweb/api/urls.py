@@ -67,6 +67,14 @@ POST to create a new object or PUT to update existing object.
 In both cases content body encodes json data.
 """
 
+api_batch = url(r'^v(?P<api_version>%s)/m/batch/$' % versions,
+                views.BatchView.as_view(),
+                name='api_batch')
+"""
+GET e.g. ?image=1&image=2&dataset=3 or POST a json list of
+[{"@type": "Image", "@id": 1}, ...] to load many objects at once.
+"""
+
 api_projects = url(r'^v(?P<api_version>%s)/m/projects/$' % versions,
                    views.ProjectsView.as_view(),
                    name='api_projects')
@@ -355,6 +363,7 @@ urlpatterns = [
     api_servers,
     api_login,
     api_save,
+    api_batch,
     api_projects,
     api_project,
     api_datasets,
@@ -21,17 +21,24 @@
 
 from django.views.generic import View
 from django.middleware import csrf
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.core.urlresolvers import reverse
 from . import api_settings
 
 import traceback
+import hashlib
 import json
 
-from .api_query import query_objects, get_child_counts, get_wellsample_indices
+from .api_query import query_objects, get_child_counts, \
+    get_wellsample_indices, get_validators, iter_objects
 from omero_marshal import get_encoder, get_decoder, OME_SCHEMA_URL
 from omero import ValidationException
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
 from omeroweb.connector import Server
+from omeroweb.decorators import ConnCleaningHttpResponse
 from .api_exceptions import BadRequestError, \
     CreatedObject, \
     MethodNotSupportedError, \
@@ -40,6 +47,10 @@ from omeroweb.api.decorators import login_required, json_response
 from omeroweb.webgateway.util import getIntOrDefault
 
 
+# Placeholder for the object ID when reversing url templates
+URL_ID_PLACEHOLDER = '9223372036854775807'
+
+
 def build_url(request, name, api_version, **kwargs):
     """
     Helper for generating urls within /api json responses.
@@ -62,6 +73,32 @@ def build_url(request, name, api_version, **kwargs):
         return "%s%s" % (prefix, url)
 
 
+def make_etag(request, conn, values):
+    """
+    Return a weak ETag based on the request and validator values.
+
+    The url (including query string), user and group context are
+    included since they determine the objects that are returned.
+    """
+    key = repr((request.get_full_path(), request.META.get('HTTP_ACCEPT'),
+                conn.getUserId(), conn.SERVICE_OPTS.getOmeroGroup(),
+                api_settings.API_VERSION, values))
+    return 'W/"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def etag_matches(request, etag):
+    """Return True if the request's If-None-Match header matches etag."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+    tags = [opaque(t) for t in header.split(',')]
+    return '*' in tags or opaque(etag) in tags
+
+
 @json_response()
 def api_versions(request, **kwargs):
     """Base url of the webgateway json api."""
@@ -91,6 +128,7 @@ def api_base(request, api_version=None, **kwargs):
           'url:servers': build_url(request, 'api_servers', v),
           'url:login': build_url(request, 'api_login', v),
           'url:save': build_url(request, 'api_save', v),
+          'url:batch': build_url(request, 'api_batch', v),
           'url:schema': OME_SCHEMA_URL}
     return rv
 
@@ -123,6 +161,25 @@ class ApiView(View):
     # urls extended by subclasses to add urls to marshalled objects
     urls = {}
 
+    def get_url_template(self, request, name, api_version, kwargs):
+        """
+        Return the url for name with OBJECT_ID placeholders unresolved.
+
+        Templates are built once per view instance (i.e. per request) so
+        that we only reverse() each url once when listing many objects.
+        """
+        if not hasattr(self, '_url_templates'):
+            self._url_templates = {}
+        key = (name, api_version, tuple(sorted(kwargs.items())))
+        if key not in self._url_templates:
+            kwargs = kwargs.copy()
+            for k, v in kwargs.items():
+                if v == 'OBJECT_ID':
+                    kwargs[k] = URL_ID_PLACEHOLDER
+            self._url_templates[key] = build_url(request, name, api_version,
+                                                 **kwargs)
+        return self._url_templates[key]
+
     @method_decorator(login_required(useragent='OMERO.webapi'))
     @method_decorator(json_response())
     def dispatch(self, *args, **kwargs):
@@ -137,34 +194,74 @@ class ApiView(View):
         Subclasses can configure self.urls to specify urls to add.
         See ProjectsView urls as example
         """
-        object_id = marshalled['@id']
+        object_id = str(marshalled['@id'])
         version = kwargs['api_version']
         if urls is not None:
             for key, args in urls.items():
-                name = args['name']
-                kwargs = args['kwargs'].copy()
                 # If kwargs has 'OBJECT_ID' placeholder, we replace with id
-                for k, v in kwargs.items():
-                    if v == 'OBJECT_ID':
-                        kwargs[k] = object_id
-                url = build_url(request, name, version, **kwargs)
-                marshalled[key] = url
+                url = self.get_url_template(request, args['name'], version,
+                                            args['kwargs'])
+                marshalled[key] = url.replace(URL_ID_PLACEHOLDER, object_id)
         return marshalled
 
+    def etag_response(self, etag, rv=None):
+        """
+        Return a JsonResponse of rv with the etag.
+
+        If rv is None, we return 304 'Not Modified'.
+        """
+        if rv is None:
+            rsp = HttpResponseNotModified()
+        elif isinstance(rv, dict):
+            rsp = JsonResponse(rv)
+        else:
+            rsp = rv
+        rsp['ETag'] = etag
+        # Content depends on the user's session and the Accept header
+        patch_vary_headers(rsp, ('Cookie', 'Accept'))
+        return rsp
+
 
 class ObjectView(ApiView):
     """Handle access to an individual Object to GET or DELETE it."""
 
     CAN_DELETE = True
 
+    # HQL expressions for the ETag of an object. Subclasses add
+    # expressions for any other objects that they marshal.
+    ETAG_EXPRESSIONS = ['obj.details.updateEvent.id']
+
     def get_opts(self, request):
         """Return a dict for use in conn.getObjects() based on request."""
         return {}
 
+    def get_etag(self, request, conn, object_id):
+        """
+        Return the ETag for the object or None if not found.
+
+        Uses a projection of ETAG_EXPRESSIONS, which is much cheaper
+        than loading and marshalling the object.
+        """
+        params = ParametersI()
+        params.addId(object_id)
+        query = "select %s from %s obj where obj.id = :id" % (
+            ', '.join(self.ETAG_EXPRESSIONS), self.OMERO_TYPE)
+        result = conn.getQueryService().projection(
+            query, params, conn.SERVICE_OPTS)
+        if not result:
+            return None
+        return make_etag(request, conn, [unwrap(v) for v in result[0]])
+
     def get(self, request, object_id, conn=None, **kwargs):
         """Simply GET a single Object and marshal it or 404 if not found."""
         opts = self.get_opts(request)
         object_id = int(object_id)
+        # child counts aren't included in the ETag
+        etag = None
+        if request.GET.get('childCount', False) != 'true':
+            etag = self.get_etag(request, conn, object_id)
+            if etag is not None and etag_matches(request, etag):
+                return self.etag_response(etag)
         query, params, wrapper = conn.buildQuery(
             self.OMERO_TYPE, [object_id], opts=opts)
         result = conn.getQueryService().findByQuery(
@@ -184,6 +281,8 @@ class ObjectView(ApiView):
             marshalled['omero:childCount'] = ch_count
 
         self.add_data(marshalled, request, conn, self.urls, **kwargs)
+        if etag is not None:
+            return self.etag_response(etag, {'data': marshalled})
         return {'data': marshalled}
 
     def delete(self, request, object_id, conn=None, **kwargs):
@@ -240,6 +339,13 @@ class ImageView(ObjectView):
 
     CAN_DELETE = False
 
+    ETAG_EXPRESSIONS = ObjectView.ETAG_EXPRESSIONS + [
+        '(select max(pix.details.updateEvent.id) from Pixels pix'
+        ' where pix.image.id = obj.id)',
+        '(select max(lc.details.updateEvent.id) from Channel ch'
+        ' join ch.logicalChannel lc where ch.pixels.image.id = obj.id)',
+    ]
+
     # Urls to add to marshalled object. See ProjectsView for more details
     urls = {
         'url:datasets': {'name': 'api_image_datasets',
@@ -341,6 +447,12 @@ class WellView(ObjectView):
 
     CAN_DELETE = False
 
+    ETAG_EXPRESSIONS = ObjectView.ETAG_EXPRESSIONS + [
+        '(select max(ws.image.details.updateEvent.id) from WellSample ws'
+        ' where ws.well.id = obj.id)',
+        '(select count(ws.id) from WellSample ws where ws.well.id = obj.id)',
+    ]
+
     # Urls to add to marshalled object. See ProjectsView for more details
     urls = {
         'url:plates': {'name': 'api_well_plates',
@@ -376,6 +488,12 @@ class RoiView(ObjectView):
 
     OMERO_TYPE = 'Roi'
 
+    ETAG_EXPRESSIONS = ObjectView.ETAG_EXPRESSIONS + [
+        '(select max(s.details.updateEvent.id) from Shape s'
+        ' where s.roi.id = obj.id)',
+        '(select count(s.id) from Shape s where s.roi.id = obj.id)',
+    ]
+
     def get_opts(self, request, **kwargs):
         """Add extra parameters to the opts dict."""
         opts = super(RoiView, self).get_opts(request, **kwargs)
@@ -411,9 +529,156 @@ class ExperimenterGroupView(ObjectView):
     }
 
 
+class BatchView(ApiView):
+    """
+    Handle GET or POST to load many Objects of various types at once.
+
+    Objects of each type are loaded with a single query, then marshalled
+    as they would be by the corresponding ObjectView. Results are in
+    the same order as requested, with an error for each Object that
+    could not be loaded.
+    """
+
+    # Views used to load & marshal each type, keyed by lowercase type
+    OBJECT_VIEWS = {}
+
+    @classmethod
+    def get_object_view(cls, obj_type):
+        """Return the ObjectView class for obj_type or None."""
+        if not cls.OBJECT_VIEWS:
+            for view in (ProjectView, DatasetView, ImageView, ScreenView,
+                         PlateView, PlateAcquisitionView, WellView, RoiView,
+                         ExperimenterView, ExperimenterGroupView):
+                cls.OBJECT_VIEWS[view.OMERO_TYPE.lower()] = view
+        # Handle schema types, e.g. http://...2016-06#Image
+        obj_type = str(obj_type).split('#')[-1].lower()
+        return cls.OBJECT_VIEWS.get(obj_type)
+
+    def get(self, request, conn=None, **kwargs):
+        """
+        GET Objects listed in query string, e.g. ?image=1&image=2&dataset=3.
+
+        Parameters that aren't object types such as childCount are ignored.
+        """
+        refs = []
+        for key in request.GET:
+            if self.get_object_view(key) is None:
+                continue
+            for obj_id in request.GET.getlist(key):
+                refs.append({'@type': key, '@id': obj_id})
+        return self.load_objects(request, conn, refs, **kwargs)
+
+    def post(self, request, conn=None, **kwargs):
+        """
+        POST a json list of Objects to load.
+
+        E.g. [{"@type": "Image", "@id": 1}, {"@type": "Dataset", "@id": 2}]
+        """
+        try:
+            refs = json.loads(request.body)
+        except ValueError:
+            raise BadRequestError('Request body is not valid json')
+        if not isinstance(refs, list):
+            raise BadRequestError('Request body must be a json list')
+        return self.load_objects(request, conn, refs, **kwargs)
+
+    def load_objects(self, request, conn, refs, **kwargs):
+        """Load and marshal each of the refs, returning {'data': list}."""
+        max_limit = max(1, api_settings.API_MAX_LIMIT)
+        if len(refs) > max_limit:
+            raise BadRequestError(
+                'Cannot load more than %s objects at once' % max_limit)
+        child_count = request.GET.get('childCount', False) == 'true'
+
+        # Validate refs and group ids by type
+        results = []
+        ids_by_type = {}
+        for ref in refs:
+            try:
+                obj_type = ref['@type']
+                obj_id = int(ref['@id'])
+            except (KeyError, TypeError, ValueError):
+                results.append({'message': 'Need @type and integer @id',
+                                'status': 400})
+                continue
+            view = self.get_object_view(obj_type)
+            if view is None:
+                results.append({'@type': obj_type, '@id': obj_id,
+                                'message': 'Unknown type: %s' % obj_type,
+                                'status': 400})
+                continue
+            ids_by_type.setdefault(view, set()).add(obj_id)
+            results.append((view, obj_id))
+
+        # One query per type
+        marshalled = {}
+        for view, ids in ids_by_type.items():
+            obj_view = view()
+            query, params, wrapper = conn.buildQuery(
+                view.OMERO_TYPE, list(ids), opts=obj_view.get_opts(request))
+            objects = conn.getQueryService().findAllByQuery(
+                query, params, conn.SERVICE_OPTS)
+            counts = {}
+            if child_count and wrapper.LINK_CLASS:
+                counts = get_child_counts(conn, wrapper.LINK_CLASS,
+                                          [o.id.val for o in objects])
+            for obj in objects:
+                encoder = get_encoder(obj.__class__)
+                m = encoder.encode(obj)
+                if child_count and wrapper.LINK_CLASS:
+                    m['omero:childCount'] = counts.get(obj.id.val, 0)
+                obj_view.add_data(m, request, conn, obj_view.urls, **kwargs)
+                marshalled[(view, obj.id.val)] = m
+
+        data = []
+        for r in results:
+            if isinstance(r, tuple):
+                view, obj_id = r
+                if r in marshalled:
+                    r = marshalled[r]
+                else:
+                    r = {'@type': view.OMERO_TYPE, '@id': obj_id,
+                         'message': '%s %s not found' % (view.OMERO_TYPE,
+                                                         obj_id),
+                         'status': 404}
+            data.append(r)
+        return {'data': data}
+
+
 class ObjectsView(ApiView):
     """Base class for listing objects."""
 
+    # Fields that can be requested with ?fields=name,owner
+    # Values are (hql, path) where path is the location of the
+    # value in the marshalled json. '@id' is always included.
+    PROJECTION_FIELDS = {
+        'name': ('obj.name', ('Name',)),
+        'description': ('obj.description', ('Description',)),
+        'owner': ('obj.details.owner.id', ('omero:details', 'owner', '@id')),
+        'group': ('obj.details.group.id', ('omero:details', 'group', '@id')),
+    }
+
+    def get_fields(self, request):
+        """
+        Return the fields dict for query_objects() or None.
+
+        Based on comma-separated ?fields= request parameter.
+        """
+        fields = request.GET.get('fields')
+        if fields is None:
+            return None
+        rv = {}
+        for name in fields.split(','):
+            name = name.strip()
+            if name in ('', 'id'):
+                continue
+            if name not in self.PROJECTION_FIELDS:
+                raise BadRequestError(
+                    "Unknown field '%s'. Supported fields: %s" % (
+                        name, ', '.join(sorted(self.PROJECTION_FIELDS))))
+            rv[name] = self.PROJECTION_FIELDS[name]
+        return rv
+
     def get_opts(self, request, **kwargs):
         """Return an options dict based on request parameters."""
         try:
@@ -424,6 +689,9 @@ class ObjectsView(ApiView):
             orphaned = request.GET.get('orphaned', False) == 'true'
         except ValueError as ex:
             raise BadRequestError(str(ex))
+        # ?cursor= (empty) starts keyset paging, response meta has 'next'
+        cursor = request.GET.get('cursor')
+        total_count = request.GET.get('totalCount', 'true') != 'false'
 
         # orphaned and child_count not used by every subclass
         opts = {'offset': offset,
@@ -431,6 +699,8 @@ class ObjectsView(ApiView):
                 'owner': owner,
                 'orphaned': orphaned,
                 'child_count': child_count,
+                'cursor': cursor,
+                'total_count': total_count,
                 }
         return opts
 
@@ -439,12 +709,62 @@ class ObjectsView(ApiView):
         opts = self.get_opts(request, **kwargs)
         group = getIntOrDefault(request, 'group', -1)
         normalize = request.GET.get('normalize', False) == 'true'
-        # Get the data
-        marshalled = query_objects(conn, self.OMERO_TYPE, group,
-                                   opts, normalize)
-        for m in marshalled['data']:
-            self.add_data(m, request, conn, self.urls, **kwargs)
-        return marshalled
+        fields = self.get_fields(request)
+        # child counts aren't included in the ETag
+        etag = None
+        values = None
+        if not opts.get('child_count'):
+            if request.META.get('HTTP_IF_NONE_MATCH'):
+                # A 304 must be based on current validators
+                values = get_validators(conn, self.OMERO_TYPE, group, opts)
+            elif opts.get('total_count', True) and \
+                    api_settings.API_COUNT_CACHE_TIMEOUT > 0:
+                # The validators are cached with the totalCount and set
+                # it, so they don't add a query. Otherwise the response
+                # has no ETag.
+                values = get_validators(conn, self.OMERO_TYPE, group,
+                                        opts, cached=True)
+        if values is not None:
+            etag = make_etag(request, conn, values)
+            if etag_matches(request, etag):
+                return self.etag_response(etag)
+        if self.is_streaming(request):
+            rsp = self.stream_objects(request, conn, group, opts,
+                                      fields, **kwargs)
+        else:
+            # Get the data
+            rsp = query_objects(conn, self.OMERO_TYPE, group,
+                                opts, normalize, fields)
+            for m in rsp['data']:
+                self.add_data(m, request, conn, self.urls, **kwargs)
+        if etag is not None:
+            return self.etag_response(etag, rsp)
+        return rsp
+
+    def is_streaming(self, request):
+        """Return True if client asked for newline-delimited json."""
+        if request.GET.get('stream', False) == 'true':
+            return True
+        accept = request.META.get('HTTP_ACCEPT', '')
+        return 'application/x-ndjson' in accept
+
+    def stream_objects(self, request, conn, group, opts, fields, **kwargs):
+        """
+        Return a streaming response of ALL objects as newline-delimited json.
+
+        'offset' and 'limit' are ignored and there is no 'meta'.
+        Objects are marshalled and sent as they are loaded, one page
+        at a time.
+        """
+        def ndjson():
+            for m in iter_objects(conn, self.OMERO_TYPE, group, opts,
+                                  fields):
+                self.add_data(m, request, conn, self.urls, **kwargs)
+                yield json.dumps(m) + '\n'
+        rsp = ConnCleaningHttpResponse(ndjson(),
+                                       content_type='application/x-ndjson')
+        rsp.conn = conn
+        return rsp
 
 
 class ProjectsView(ObjectsView):
@@ -661,6 +981,13 @@ class WellsView(ObjectsView):
 
     OMERO_TYPE = 'Well'
 
+    PROJECTION_FIELDS = {
+        'row': ('obj.row', ('Row',)),
+        'column': ('obj.column', ('Column',)),
+        'owner': ObjectsView.PROJECTION_FIELDS['owner'],
+        'group': ObjectsView.PROJECTION_FIELDS['group'],
+    }
+
     # Urls to add to marshalled object. See ProjectsView for more details
     urls = {
         'url:well': {'name': 'api_well',
@@ -742,6 +1069,13 @@ class ExperimentersView(ObjectsView):
 
     OMERO_TYPE = 'Experimenter'
 
+    PROJECTION_FIELDS = {
+        'omeName': ('obj.omeName', ('UserName',)),
+        'firstName': ('obj.firstName', ('FirstName',)),
+        'lastName': ('obj.lastName', ('LastName',)),
+        'email': ('obj.email', ('Email',)),
+    }
+
     # Urls to add to marshalled object. See ProjectsView for more details
     urls = {
         'url:experimenter': {'name': 'api_experimenter',
@@ -783,6 +1117,11 @@ class ExperimenterGroupsView(ObjectsView):
 
     OMERO_TYPE = 'ExperimenterGroup'
 
+    PROJECTION_FIELDS = {
+        'name': ObjectsView.PROJECTION_FIELDS['name'],
+        'description': ObjectsView.PROJECTION_FIELDS['description'],
+    }
+
     # Urls to add to marshalled object. See ProjectsView for more details
     urls = {
         'url:experimentergroup': {'name': 'api_experimentergroup',
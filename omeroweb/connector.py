@@ -20,11 +20,15 @@
 #
 
 import re
+import time
 import logging
+import threading
 
+from django.core.cache import cache
 from django.utils.encoding import force_text
 from future.utils import with_metaclass
 
+import omero
 from omero import client_wrapper
 from omeroweb.version import omeroweb_version as omero_version
 
@@ -208,6 +212,22 @@ class Connector(object):
         connection.close()
         return None
 
+    def keep_alive(self, useragent, userip=None):
+        """
+        Joins the OMERO session only to refresh its last access time,
+        without preparing the gateway for a view.
+        Returns True if the session is still valid.
+        """
+        connection = self.create_gateway(useragent, userip=userip)
+        try:
+            return connection.connect(sUuid=self.omero_session_key)
+        except Exception:
+            logger.debug('Cannot join session: %s', self.omero_session_key,
+                         exc_info=True)
+            return False
+        finally:
+            connection.close(hard=False)
+
     def is_server_up(self, useragent):
         connection = self.create_guest_connection(useragent)
         if connection is None:
@@ -258,3 +278,144 @@ class Connector(object):
         if client_version[0] == '5' and int(client_version[1]) >= 6:
             return int(server_version[1]) >= 5
         return server_version[:2] == client_version[:2]
+
+
+class PublicConnectionPool(object):
+    """
+    Keeps live connections of the OMERO.webpublic user in this process, so
+    that anonymous requests borrow a connection instead of joining or
+    creating an OMERO session. Idle connections are kept alive by a
+    background thread and dropped once they fail.
+    """
+
+    def __init__(self, size, ping_interval):
+        """
+        @param size:            Maximum number of idle connections
+        @param ping_interval:   Seconds between keep alive calls
+        """
+        self.size = size
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def borrow(self, server_id):
+        """
+        Returns an idle connection to the server or None.
+        The connection must be given back with L{release}.
+        """
+        with self._lock:
+            for idx in range(len(self._idle) - 1, -1, -1):
+                if self._idle[idx].server_id == server_id:
+                    return self._idle.pop(idx)
+        return None
+
+    def release(self, connection):
+        """
+        Takes a connection of the public user back into the pool.
+        Returns False if the connection can't be kept, e.g. if the pool
+        is full or a stateful service created by a view is still open,
+        in which case the caller should close it.
+        """
+        if self.size <= 0 or connection.c is None or \
+                not connection.isAnonymous() or \
+                getattr(connection, 'server_id', None) is None:
+            return False
+        for proxy in list(connection._proxies.values()):
+            if isinstance(proxy._obj,
+                          omero.api.StatefulServiceInterfacePrx):
+                proxy.close()
+        # Services created outside of the proxies are still open
+        if connection._tracked_services:
+            return False
+        # Views may have changed the group or user context
+        connection.SERVICE_OPTS = connection.createServiceOptsDict()
+        with self._lock:
+            if len(self._idle) >= self.size:
+                return False
+            self._idle.append(connection)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._keep_alive, name='PublicConnectionPool')
+                self._thread.daemon = True
+                self._thread.start()
+        return True
+
+    def _keep_alive(self):
+        while True:
+            time.sleep(self.ping_interval)
+            with self._lock:
+                idle = list(self._idle)
+            for connection in idle:
+                # Take the connection out while it is checked
+                with self._lock:
+                    if connection not in self._idle:
+                        continue
+                    self._idle.remove(connection)
+                alive = False
+                try:
+                    alive = connection.keepAlive()
+                except Exception:
+                    logger.debug('Public user connection failed.',
+                                 exc_info=True)
+                if alive:
+                    with self._lock:
+                        if len(self._idle) < self.size:
+                            self._idle.append(connection)
+                            continue
+                try:
+                    connection.close(hard=False)
+                except Exception:
+                    logger.debug('Failed to close public user connection.',
+                                 exc_info=True)
+
+
+class KeepAliveCoalescer(object):
+    """
+    Remembers when each OMERO session was last kept alive, so that the
+    keepalive pings of all the open pages of a user within a window result
+    in a single call to the server. The last pings are shared between web
+    workers through the Django cache if it is shared.
+    """
+
+    # Number of sessions remembered by this process before old ones are
+    # dropped
+    MAX_SESSIONS = 10000
+
+    def __init__(self, window):
+        """
+        @param window:          Seconds during which further pings of a
+                                session are not sent to the server
+        """
+        self.window = window
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def _cache_key(self, session_key):
+        return 'omero.web.keepalive.%s' % session_key
+
+    def due(self, session_key):
+        """
+        Returns True if the session should be kept alive now, or False if
+        it was kept alive within the window.
+        """
+        if self.window <= 0:
+            return True
+        now = time.time()
+        with self._lock:
+            last = self._last.get(session_key)
+            if last is not None and now - last < self.window:
+                return False
+            if len(self._last) >= self.MAX_SESSIONS:
+                self._last = dict(
+                    (k, v) for k, v in self._last.items()
+                    if now - v < self.window)
+            self._last[session_key] = now
+        # Another worker may have kept the session alive
+        return cache.add(self._cache_key(session_key), now, self.window)
+
+    def forget(self, session_key):
+        """Sends the next ping of the session to the server."""
+        with self._lock:
+            self._last.pop(session_key, None)
+        cache.delete(self._cache_key(session_key))
@@ -37,7 +37,7 @@ from django.core.urlresolvers import reverse, resolve, NoReverseMatch
 from django.core.cache import cache
 
 from omeroweb.utils import reverse_with_params
-from omeroweb.connector import Connector
+from omeroweb.connector import Connector, PublicConnectionPool
 from omero.gateway.utils import propertiesToDict
 
 logger = logging.getLogger(__name__)
@@ -75,15 +75,29 @@ def get_client_ip(request):
     return ip
 
 
+# Live connections of the OMERO.webpublic user of this process
+public_connection_pool = PublicConnectionPool(
+    settings.PUBLIC_POOL_SIZE, settings.PUBLIC_POOL_PING_INTERVAL)
+
+
+def close_connection(conn):
+    """
+    Closes the connection at the end of a request, or gives it back to
+    the pool if it is a connection of the OMERO.webpublic user.
+    """
+    if not public_connection_pool.release(conn):
+        conn.close(hard=False)
+
+
 class ConnCleaningHttpResponse(StreamingHttpResponse):
     """Extension of L{HttpResponse} which closes the OMERO connection."""
 
     def close(self):
         super(ConnCleaningHttpResponse, self).close()
         try:
-            logger.debug('Closing OMERO connection in %r' % self)
+            logger.debug('Closing OMERO connection in %r', self)
             if self.conn is not None and self.conn.c is not None:
-                self.conn.close(hard=False)
+                close_connection(self.conn)
         except Exception:
             logger.error('Failed to clean up connection.', exc_info=True)
 
@@ -176,9 +190,8 @@ class login_required(object):
 
         args = {'url': url}
 
-        logger.debug(
-            'Request is not Ajax, redirecting to %s?%s'
-            % (self.login_url, urlencode(args)))
+        logger.debug('Request is not Ajax, redirecting to %s?%s',
+                     self.login_url, urlencode(args))
         return HttpResponseRedirect(
             '%s?%s' % (self.login_url, urlencode(args)))
 
@@ -279,7 +292,7 @@ class login_required(object):
         if not settings.PUBLIC_CACHE_ENABLED \
                 or connector.omero_session_key is None:
             return
-        logger.debug('Setting OMERO.webpublic connector: %r' % connector)
+        logger.debug('Setting OMERO.webpublic connector: %r', connector)
         cache.set(settings.PUBLIC_CACHE_KEY, connector,
                   settings.PUBLIC_CACHE_TIMEOUT)
 
@@ -290,7 +303,7 @@ class login_required(object):
         """
         connection = self.get_authenticated_connection(server_id, request)
         is_valid_public_url = self.is_valid_public_url(server_id, request)
-        logger.debug('Is valid public URL? %s' % is_valid_public_url)
+        logger.debug('Is valid public URL? %s', is_valid_public_url)
         if connection is None and is_valid_public_url:
             # If OMERO.webpublic is enabled, pick up a username and
             # password from configuration and use those credentials to
@@ -302,12 +315,21 @@ class login_required(object):
             username = settings.PUBLIC_USER
             password = settings.PUBLIC_PASSWORD
             is_secure = settings.SECURE
-            logger.debug('Is SSL? %s' % is_secure)
+            logger.debug('Is SSL? %s', is_secure)
+            # Try and use a live connection of this process.
+            connection = public_connection_pool.borrow(server_id)
+            if connection is not None:
+                connector = Connector(server_id, is_secure)
+                connector.is_public = True
+                connector.omero_session_key = connection._sessionUuid
+                connector.user_id = connection.getUserId()
+                request.session['connector'] = connector
+                return connection
             # Try and use a cached OMERO.webpublic user session key.
             public_user_connector = self.get_public_user_connector()
             if public_user_connector is not None:
                 logger.debug('Attempting to use cached OMERO.webpublic '
-                             'connector: %r' % public_user_connector)
+                             'connector: %r', public_user_connector)
                 connection = public_user_connector.join_connection(
                     self.useragent)
                 if connection is not None:
@@ -335,11 +357,11 @@ class login_required(object):
             self.set_public_user_connector(connector)
         elif connection is not None:
             is_anonymous = connection.isAnonymous()
-            logger.debug('Is anonymous? %s' % is_anonymous)
+            logger.debug('Is anonymous? %s', is_anonymous)
             if is_anonymous and not is_valid_public_url:
                 if connection.c is not None:
                     logger.debug("Closing anonymous connection")
-                    connection.close(hard=False)
+                    close_connection(connection)
                 return None
         return connection
 
@@ -354,9 +376,9 @@ class login_required(object):
         session = request.session
         request = request.GET
         is_secure = settings.SECURE
-        logger.debug('Is SSL? %s' % is_secure)
+        logger.debug('Is SSL? %s', is_secure)
         connector = session.get('connector', None)
-        logger.debug('Connector: %s' % connector)
+        logger.debug('Connector: %s', connector)
 
         if server_id is None:
             # If no server id is passed, the db entry will not be used and
@@ -382,8 +404,8 @@ class login_required(object):
         else:
             # We have an OMERO session key in the current request use it
             # to try join an existing connection / OMERO session.
-            logger.debug('Have OMERO session key %s, attempting to join...'
-                         % omero_session_key)
+            logger.debug('Have OMERO session key %s, attempting to join...',
+                         omero_session_key)
             connector.user_id = None
             connector.omero_session_key = omero_session_key
             connection = connector.join_connection(self.useragent, userip)
@@ -417,7 +439,13 @@ class login_required(object):
             session['connector'] = connector
             return connection
 
-        logger.debug('Django session connector: %r' % connector)
+        logger.debug('Django session connector: %r', connector)
+        if connector is not None and connector.is_public:
+            # Use a live connection of the OMERO.webpublic user if we have
+            # one, instead of joining the session
+            connection = public_connection_pool.borrow(server_id)
+            if connection is not None:
+                return connection
         if connector is not None:
             # We have a connector, attempt to use it to join an existing
             # connection / OMERO session.
@@ -484,16 +512,22 @@ class login_required(object):
 
                     # kwargs['error'] = request.GET.get('error')
                     kwargs['url'] = url
+            retval = None
             try:
                 retval = f(request, *args, **kwargs)
             finally:
                 # If f() raised Exception, e.g. Http404() we must still cleanup
+                # A ConnCleaningHttpResponse closes its own connection once
+                # the content has been streamed.
+                if isinstance(retval, ConnCleaningHttpResponse) and \
+                        getattr(retval, 'conn', None) is not None:
+                    doConnectionCleanup = False
                 try:
                     logger.debug(
-                        'Doing connection cleanup? %s' % doConnectionCleanup)
+                        'Doing connection cleanup? %s', doConnectionCleanup)
                     if doConnectionCleanup:
                         if conn is not None and conn.c is not None:
-                            conn.close(hard=False)
+                            close_connection(conn)
                 except Exception:
                     logger.warn('Failed to clean up connection', exc_info=True)
             return retval
@@ -544,7 +578,7 @@ class render_response(object):
             # get template from view dict. Can be overridden from the **kwargs
             template = 'template' in context and context['template'] or None
             template = kwargs.get('template', template)
-            logger.debug("Rendering template: %s" % template)
+            logger.debug("Rendering template: %s", template)
 
             # allows us to return the dict as json  (NB: BlitzGateway objects
             # don't serialize)
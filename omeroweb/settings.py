@@ -29,6 +29,7 @@
 
 import os.path
 import sys
+import hashlib
 import logging
 import omero
 import omero.config
@@ -44,6 +45,7 @@ from omero_ext import portalocker
 from omero.util.concurrency import get_event
 from omeroweb.utils import sort_properties_to_tuple
 from omeroweb.connector import Server
+from omeroweb.version import omeroweb_version
 
 logger = logging.getLogger(__name__)
 
@@ -160,10 +162,50 @@ LOGGING = {
 
 
 CONFIG_XML = os.path.join(OMERODIR, 'etc', 'grid', 'config.xml')
+
+# Snapshot of config.xml and of the parsed settings, written by
+# 'omero web config' and 'omero web start', see write_settings_snapshot()
+SETTINGS_SNAPSHOT_PATH = os.path.join(
+    OMERODIR, 'var', 'omeroweb.settings.json')
+# Mappings of this module that are stored in the snapshot
+SNAPSHOT_MAPPINGS = ('INTERNAL_SETTINGS_MAPPING', 'CUSTOM_SETTINGS_MAPPINGS',
+                     'DEVELOPMENT_SETTINGS_MAPPINGS')
+
+
+def file_stamp(path):
+    """Returns [mtime, size] of the file or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def load_settings_snapshot(path, config_xml):
+    """
+    Returns the snapshot at path, or None if it is missing, invalid or
+    was written from a different version of config_xml.
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('config_xml') != file_stamp(config_xml):
+        return None
+    return snapshot
+
+
+CONFIG_XML_STAMP = file_stamp(CONFIG_XML)
+SETTINGS_SNAPSHOT = load_settings_snapshot(SETTINGS_SNAPSHOT_PATH, CONFIG_XML)
+if SETTINGS_SNAPSHOT is not None:
+    CUSTOM_SETTINGS = SETTINGS_SNAPSHOT['custom_settings']
+
 count = 10
 event = get_event("websettings")
 
-while True:
+while SETTINGS_SNAPSHOT is None:
     try:
         CUSTOM_SETTINGS = dict()
         if os.path.exists(CONFIG_XML):
@@ -521,6 +563,17 @@ CUSTOM_SETTINGS_MAPPINGS = {
          ("Workers silent for more than this many seconds are killed "
           "and restarted. Check Gunicorn Documentation "
           "https://docs.gunicorn.org/en/stable/settings.html#timeout")],
+    "omero.web.wsgi_preload":
+        ["WSGI_PRELOAD",
+         "false",
+         parse_boolean,
+         ("If true, Gunicorn loads OMERO.web once in the master process "
+          "before forking the workers (SYNC WORKERS only): settings are "
+          "read, the urls of all apps are resolved and the templates are "
+          "compiled, so that new workers, e.g. restarted after "
+          ":property:`omero.web.application_server.max_requests`, start "
+          "warm. Check Gunicorn Documentation "
+          "https://docs.gunicorn.org/en/stable/settings.html#preload-app")],
 
     # Public user
     "omero.web.public.enabled":
@@ -558,6 +611,20 @@ CUSTOM_SETTINGS_MAPPINGS = {
         ["PUBLIC_CACHE_KEY", "omero.web.public.cache.key", str, None],
     "omero.web.public.cache.timeout":
         ["PUBLIC_CACHE_TIMEOUT", 60 * 60 * 24, int, None],
+    "omero.web.public.pool_size":
+        ["PUBLIC_POOL_SIZE",
+         2,
+         int,
+         ("Number of live connections of the public user that each web "
+          "worker keeps for anonymous requests, so that they don't need "
+          "to join or create an OMERO session. Set to 0 to disable.")],
+    "omero.web.public.pool_ping_interval":
+        ["PUBLIC_POOL_PING_INTERVAL",
+         60,
+         int,
+         ("Number of seconds between the checks that keep the pooled "
+          "connections of the public user alive. Must be lower than the "
+          "idle timeout of OMERO sessions.")],
 
     # Social media integration
     "omero.web.sharing.twitter":
@@ -586,6 +653,14 @@ CUSTOM_SETTINGS_MAPPINGS = {
          60000,
          int,
          "Timeout interval between ping invocations in seconds"],
+    "omero.web.keepalive_window":
+        ["KEEPALIVE_WINDOW",
+         120,
+         int,
+         ("Number of seconds during which further keepalive pings of an "
+          "OMERO session, e.g. from other open pages of the same user, are "
+          "answered without contacting the server. Must be well below "
+          "the idle timeout of OMERO sessions. Set to 0 to disable.")],
     "omero.web.chunk_size":
         ["CHUNK_SIZE",
          1048576,
@@ -774,6 +849,93 @@ CUSTOM_SETTINGS_MAPPINGS = {
          int,
          ("Number of images displayed within a dataset or 'orphaned'"
           " container to prevent from loading them all at once.")],
+    "omero.web.history.calendar_cache_timeout":
+        ["HISTORY_CALENDAR_CACHE_TIMEOUT",
+         60,
+         int,
+         ("Number of seconds that the per-day counts shown in the history "
+          "calendar are cached for each user and month, using the cache "
+          "configured by :property:`omero.web.caches`.")],
+    "omero.web.activities.poll_interval":
+        ["ACTIVITIES_POLL_INTERVAL",
+         1.0,
+         float,
+         ("Minimum number of seconds between two checks of the status of "
+          "the same job in the Activities panel by a web worker.")],
+    "omero.web.activities.long_poll_timeout":
+        ["ACTIVITIES_LONG_POLL_TIMEOUT",
+         20,
+         int,
+         ("(ASYNC WORKERS only) Maximum number of seconds that a request "
+          "to the Activities long-poll url waits for a job to change. "
+          "Sync workers answer at once, since each waiting request would "
+          "hold a worker.")],
+    "omero.web.background_job_threads":
+        ["BACKGROUND_JOB_THREADS",
+         2,
+         int,
+         ("Number of threads of each web worker that run long operations "
+          "in the background, such as pasting rendering settings to many "
+          "images. The jobs are shown in the webclient Activities panel.")],
+    "omero.web.compatible_images_cache_timeout":
+        ["COMPATIBLE_IMAGES_CACHE_TIMEOUT",
+         60,
+         int,
+         ("Number of seconds that the images of a project that rendering "
+          "settings can be pasted to are cached, for each user, project and "
+          "pixels type, number of channels and channel labels of the "
+          "source image. Uses the cache configured by "
+          ":property:`omero.web.caches`.")],
+    "omero.web.search.cache_timeout":
+        ["SEARCH_CACHE_TIMEOUT",
+         300,
+         int,
+         ("Number of seconds that the hits of a search are cached for each "
+          "user, query and filters, so that loading more results or sorting "
+          "does not run the search again. Hits are stored in the cache "
+          "configured by :property:`omero.web.caches`.")],
+    "omero.web.tags.index_cache_timeout":
+        ["TAG_INDEX_CACHE_TIMEOUT",
+         3600,
+         int,
+         ("Number of seconds that the index of all the tags of a group, "
+          "used by the tagging dialog, is kept in the cache configured by "
+          ":property:`omero.web.caches`. The index is shared by the members "
+          "of the group and is reloaded whenever a tag or tag set changes.")],
+    "omero.web.access_log.sample_rate":
+        ["ACCESS_LOG_SAMPLE_RATE",
+         0.0,
+         float,
+         ("Fraction of requests, between 0 and 1, that are written to "
+          "var/log/OMEROweb.access.log as one line of JSON with the view, "
+          "status, duration, web cache hits and misses and the number and "
+          "duration of calls to OMERO services. Set to 0 to disable.")],
+    "omero.web.tree.query_threads":
+        ["TREE_QUERY_THREADS",
+         4,
+         int,
+         ("Maximum number of independent queries for the webclient tree "
+          "and the JSON API that each worker process runs concurrently, "
+          "e.g. to load Projects, Datasets, Screens and Plates or the "
+          "chunks of a long list of IDs at the same time. "
+          "Set to 1 to run queries one after another.")],
+    "omero.web.tree.count_cache_time":
+        ["COUNT_CACHE_TIME",
+         5,
+         int,
+         ("Number of seconds that each web worker keeps the counts shown "
+          "in the webclient, e.g. the number of children of Projects, "
+          "Datasets and Tags or of orphaned Images, for each group and "
+          "owner. Views that create or delete links clear the counts. "
+          "Set to 0 to disable.")],
+    "omero.web.thumbnails_version_cache_size":
+        ["THUMBNAILS_VERSION_CACHE_SIZE",
+         10000,
+         int,
+         ("Number of images for which each web worker keeps the version of "
+          "the most recent thumbnail in memory, so that the versions do not "
+          "have to be queried every time the centre panel is loaded. "
+          "Set to 0 to disable.")],
     "omero.web.thumbnails_batch":
         ["THUMBNAILS_BATCH",
          50,
@@ -1011,6 +1173,79 @@ def map_deprecated_settings(settings):
     return m
 
 
+def settings_fingerprint():
+    """
+    Returns a hash of the mappings stored in the snapshot, so that a
+    snapshot written by a different version of OMERO.web is not used.
+    """
+    rows = [omeroweb_version, OMERODIR, sys.version_info[:2]]
+    for name in SNAPSHOT_MAPPINGS:
+        for key, values in sorted(globals()[name].items()):
+            rows.append((name, key, values[0], repr(values[1]),
+                         getattr(values[2], '__name__', repr(values[2]))))
+    return hashlib.md5(repr(rows).encode('utf-8')).hexdigest()
+
+
+# Parsed values of SNAPSHOT_MAPPINGS as {mapping: {key: [is_set, value]}},
+# loaded from the snapshot or recorded while parsing the settings
+SNAPSHOT_LOADED = (
+    SETTINGS_SNAPSHOT is not None and
+    SETTINGS_SNAPSHOT.get('fingerprint') == settings_fingerprint())
+if SNAPSHOT_LOADED:
+    SNAPSHOT_VALUES = SETTINGS_SNAPSHOT['values']
+else:
+    SNAPSHOT_VALUES = dict((name, {}) for name in SNAPSHOT_MAPPINGS)
+
+
+def write_settings_snapshot():
+    """
+    Writes config.xml and the settings parsed from it to
+    SETTINGS_SNAPSHOT_PATH, so that web workers can load them without
+    locking and parsing config.xml. The snapshot is ignored once
+    config.xml is modified. Settings whose parsed value cannot be stored
+    as JSON are parsed again by each worker.
+    """
+    if SNAPSHOT_LOADED:
+        # Settings were loaded from an up to date snapshot
+        return
+    snapshot = {
+        'config_xml': CONFIG_XML_STAMP,
+        'fingerprint': settings_fingerprint(),
+        'custom_settings': snapshot_custom_settings(CUSTOM_SETTINGS),
+        'values': SNAPSHOT_VALUES,
+    }
+    tmp = '%s.%s' % (SETTINGS_SNAPSHOT_PATH, os.getpid())
+    # Like django_secret_key, only readable by the OMERO user
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                           0o600), 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, SETTINGS_SNAPSHOT_PATH)
+
+
+def snapshot_custom_settings(custom_settings):
+    """
+    Returns the settings of config.xml that OMERO.web reads, i.e. the
+    omero.web.* keys and the keys of the mappings of this module, but
+    not the other settings of the server such as database passwords.
+    """
+    keys = set(['Ice.Default.Host', 'omero.master.host'])
+    for name in SNAPSHOT_MAPPINGS + ('DEPRECATED_SETTINGS_MAPPINGS',):
+        keys.update(globals()[name])
+    return dict((key, value) for key, value in custom_settings.items()
+                if key.startswith('omero.web.') or key in keys)
+
+
+def _snapshot_value(value):
+    """Returns the value as stored as JSON, or raises ValueError."""
+    try:
+        stored = json.loads(json.dumps(value))
+    except TypeError as e:
+        raise ValueError(e)
+    if stored != value or type(stored) is not type(value):
+        raise ValueError("%r changes when stored as JSON" % (value,))
+    return stored
+
+
 def process_custom_settings(
         module, settings='CUSTOM_SETTINGS_MAPPINGS', deprecated=None):
     logging.info('Processing custom settings for module %s' % module.__name__)
@@ -1021,6 +1256,10 @@ def process_custom_settings(
     else:
         deprecated_map = {}
 
+    snapshot = None
+    if module.__name__ == __name__:
+        snapshot = SNAPSHOT_VALUES.get(settings)
+
     for key, values in getattr(module, settings, {}).items():
         # Django may import settings.py more than once, see:
         # http://blog.dscpl.com.au/2010/03/improved-wsgi-script-for-use-with.html
@@ -1030,6 +1269,13 @@ def process_custom_settings(
 
         global_name, default_value, mapping, description = values
 
+        if snapshot is not None and key in snapshot:
+            is_set, value = snapshot[key]
+            values.append(key not in CUSTOM_SETTINGS)
+            if is_set:
+                setattr(module, global_name, value)
+            continue
+
         try:
             global_value = CUSTOM_SETTINGS[key]
             values.append(False)
@@ -1050,6 +1296,12 @@ def process_custom_settings(
                         '%s and its deprecated key %s are both set, using %s',
                         key, dep_key, key)
             setattr(module, global_name, mapping(global_value))
+            if snapshot is not None:
+                try:
+                    snapshot[key] = [True, _snapshot_value(
+                        getattr(module, global_name))]
+                except ValueError:
+                    pass
         except ValueError as e:
             raise ValueError(
                 "Invalid %s (%s = %r). %s. %s" %
@@ -1059,7 +1311,8 @@ def process_custom_settings(
                 "ImportError: %s. %s (%s = %r).\n%s" %
                 (e.message, global_name, key, global_value, description))
         except LeaveUnset:
-            pass
+            if snapshot is not None:
+                snapshot[key] = [False, None]
 
 
 process_custom_settings(sys.modules[__name__], 'INTERNAL_SETTINGS_MAPPING')
@@ -1390,6 +1643,25 @@ SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
 # MIDDLEWARE: A tuple of middleware classes to use.
 MIDDLEWARE = sort_properties_to_tuple(MIDDLEWARE_CLASSES_LIST)  # noqa
 
+# Sampled access log, outermost to time the other middleware too
+if ACCESS_LOG_SAMPLE_RATE > 0:  # from CUSTOM_SETTINGS_MAPPINGS  # noqa
+    MIDDLEWARE = ('omeroweb.access_log.AccessLogMiddleware',) + MIDDLEWARE
+    LOGGING['formatters']['access'] = {'format': '%(message)s'}
+    LOGGING['handlers']['access'] = {
+        'level': 'INFO',
+        'class': LOGGING_CLASS,
+        'filename': os.path.join(
+            LOGDIR, 'OMEROweb.access.log').replace('\\', '/'),
+        'maxBytes': LOGSIZE,
+        'backupCount': 10,
+        'formatter': 'access',
+    }
+    LOGGING['loggers']['omeroweb.access'] = {
+        'handlers': ['access'],
+        'level': 'INFO',
+        'propagate': False,
+    }
+
 for k, v in DJANGO_ADDITIONAL_SETTINGS:  # noqa
     setattr(sys.modules[__name__], k, v)
 
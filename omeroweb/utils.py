@@ -20,15 +20,35 @@
 #
 
 import logging
+import os
+import threading
+import time
 
+from django.conf import settings
 from django.utils.http import urlencode
 from django.core.urlresolvers import reverse
 from django.core.urlresolvers import NoReverseMatch
 from past.builtins import basestring
 
+from omeroweb.access_log import get_request_stats, set_request_stats
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: nocover
+    ThreadPoolExecutor = None
+
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of IDs bound to a single 'in (:ids)' parameter, see
+# run_chunked()
+ID_CHUNK_SIZE = 1000
+
+# Thread pool shared by all requests in this process, see run_queries()
+_query_pool = None
+_query_pool_lock = threading.Lock()
+_query_thread = threading.local()
+
 
 def reverse_with_params(*args, **kwargs):
     """
@@ -51,3 +71,174 @@ def reverse_with_params(*args, **kwargs):
 def sort_properties_to_tuple(input_list, index="index", element="class"):
     return tuple(e[element] for e in sorted(
                  input_list, key=lambda k: k[index]))
+
+
+def is_preloaded(settings):
+    """
+    Returns True if Gunicorn preloads the application in the master
+    process before forking the workers. gevent workers must patch the
+    standard library before the application is imported, so only sync
+    workers are preloaded.
+
+    @param settings:    The settings, e.g. django.conf.settings
+    """
+    return bool(getattr(settings, 'WSGI_PRELOAD', False)) and \
+        getattr(settings, 'WSGI_WORKER_CLASS', None) == 'sync'
+
+
+def warm_up():
+    """
+    Resolves the urls of all apps, which imports their views, and compiles
+    the templates of all apps, so that the first request of a worker
+    does not have to. Used by omeroweb.wsgi when the application is
+    preloaded by Gunicorn in the master process, before forking workers.
+    """
+    from django.core.urlresolvers import get_resolver
+    from django.template import engines
+
+    start = time.time()
+    # Populating the reverse lookups imports every url conf and view
+    get_resolver().reverse_dict
+
+    count = 0
+    for engine in engines.all():
+        names = set()
+        for template_dir in engine.template_dirs:
+            for root, dirs, files in os.walk(template_dir):
+                for f in files:
+                    if f.endswith('.html'):
+                        names.add(os.path.relpath(
+                            os.path.join(root, f), template_dir))
+        for name in sorted(names):
+            try:
+                engine.get_template(name.replace(os.sep, '/'))
+                count += 1
+            except Exception:
+                logger.debug('Failed to compile template %s', name,
+                             exc_info=True)
+    logger.info('Warm-up: resolved urls and compiled %d templates in %.2fs',
+                count, time.time() - start)
+
+
+def _get_query_pool():
+    """
+    Returns the shared thread pool for run_queries() or None if
+    queries should run one after another.
+    """
+    global _query_pool
+    if ThreadPoolExecutor is None or settings.TREE_QUERY_THREADS <= 1:
+        return None
+    with _query_pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPoolExecutor(
+                max_workers=settings.TREE_QUERY_THREADS)
+    return _query_pool
+
+
+def _timed_query(key, func, kwargs, stats=None):
+    """
+    Runs a single query for run_queries(), logging how long it took.
+    The calls made by the query are counted in the access log stats of
+    the request, see L{omeroweb.access_log}.
+    """
+    # Queries may be nested, e.g. run inline by a query already running
+    # in the pool, which must still be seen as in the pool afterwards
+    in_pool = getattr(_query_thread, 'in_pool', False)
+    _query_thread.in_pool = True
+    previous_stats = set_request_stats(stats)
+    start = time.time()
+    try:
+        return func(**kwargs)
+    finally:
+        _query_thread.in_pool = in_pool
+        set_request_stats(previous_stats)
+        logger.debug('Query %s took %.3f s', key, time.time() - start)
+
+
+def run_queries(conn, queries):
+    """
+    Runs independent queries concurrently on a bounded thread pool,
+    sharing the same OMERO session, and waits for all of them.
+    The queries run one after another if threads are disabled with
+    omero.web.tree.query_threads or if we are already running in the
+    pool (to avoid waiting on ourselves).
+
+    @param conn OMERO gateway.
+    @type conn L{omero.gateway.BlitzGateway}
+    @param queries Functions to call, e.g.
+    {'projects': (marshal_projects, {'conn': conn, 'page': 1})}
+    @type queries L{dict}
+    @return Dict of the same keys with the results of each function.
+    Raises the first exception raised by any of the functions.
+    """
+    pool = _get_query_pool()
+    stats = get_request_stats()
+    if pool is None or len(queries) < 2 or \
+            getattr(_query_thread, 'in_pool', False):
+        return dict((key, _timed_query(key, func, kwargs, stats))
+                    for key, (func, kwargs) in queries.items())
+    # Load the event context and query service before threads use them
+    conn.getEventContext()
+    conn.getQueryService()
+    futures = dict((key, pool.submit(_timed_query, key, func, kwargs,
+                                     stats))
+                   for key, (func, kwargs) in queries.items())
+    return dict((key, future.result()) for key, future in futures.items())
+
+
+def run_chunked(conn, func, ids, id_key=None, offset=0, limit=None,
+                chunk_size=ID_CHUNK_SIZE):
+    """
+    Runs a query for a list of IDs of any length, binding at most
+    chunk_size IDs to each query. The chunks run concurrently with
+    L{run_queries} and their results are merged in the order of the
+    chunks.
+
+    For an ordered and paged query, func is called with 'offset' and
+    'limit' as well as 'ids', and id_key gives the ID of each result. The
+    page is always ordered by the query itself: if there are several
+    chunks, each one loads its first offset + limit results, then the
+    query runs again with the IDs of those results only, until they fit
+    in a single chunk. If that doesn't reduce the number of IDs, the page
+    is loaded with a single query binding all of them.
+
+    @param conn OMERO gateway.
+    @type conn L{omero.gateway.BlitzGateway}
+    @param func Function called as func(ids=[...]) returning a list
+    @param ids The IDs to query
+    @type ids L{list}
+    @param id_key Function returning the ID of a result, for paging
+    @param offset Index of the first result of the page
+    @param limit Number of results of the page or `None` for no paging
+    @return List of the results
+    """
+    ids = list(ids)
+    while True:
+        chunks = [ids[i:i + chunk_size]
+                  for i in range(0, len(ids), chunk_size)]
+        if not chunks:
+            return []
+        if len(chunks) == 1:
+            kwargs = {'ids': chunks[0]}
+            if limit is not None:
+                kwargs.update(offset=offset, limit=limit)
+            return list(func(**kwargs))
+
+        queries = {}
+        for idx, chunk in enumerate(chunks):
+            kwargs = {'ids': chunk}
+            if limit is not None:
+                kwargs.update(offset=0, limit=offset + limit)
+            queries['chunk%d' % idx] = (func, kwargs)
+        results = run_queries(conn, queries)
+        rv = []
+        for idx in range(len(chunks)):
+            rv.extend(results['chunk%d' % idx])
+        if limit is None:
+            return rv
+
+        # The page is within the first results of the chunks
+        candidates = [id_key(r) for r in rv]
+        if len(candidates) >= len(ids):
+            return list(func(ids=ids, offset=offset, limit=limit))
+        ids = candidates
@@ -23,8 +23,11 @@
 # Version: 1.0
 #
 
+import heapq
 import omero
 from omero.rtypes import rstring, rlong, unwrap
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.encoding import smart_str
 import logging
 
@@ -382,7 +385,7 @@ class BaseContainer(BaseController):
         if self.channel_metadata is None:
             self.channel_metadata = list()
 
-    def loadTagsRecursive(self, eid=None, offset=None, limit=1000):
+    def _getTagsOwnerId(self, eid=None):
         if eid is not None:
             if eid == -1:       # Load data for all users
                 if self.canUseOthersAnns():
@@ -393,9 +396,58 @@ class BaseContainer(BaseController):
                 self.experimenter = self.conn.getObject("Experimenter", eid)
         else:
             eid = self.conn.getEventContext().userId
+        return eid
+
+    def loadTagsRecursive(self, eid=None, offset=None, limit=1000):
+        eid = self._getTagsOwnerId(eid)
         self.tags_recursive, self.tags_recursive_owners = \
             self.conn.listTagsRecursive(eid, offset, limit)
 
+    def loadTagIndex(self, eid=None):
+        """
+        Loads all the tags like loadTagsRecursive(), without paging, from
+        an index of the group's tags kept in the cache. The index is
+        loaded again when the version returned by getTagIndexVersion()
+        changes, i.e. when a tag or tag set is created, edited or deleted.
+        """
+        eid = self._getTagsOwnerId(eid)
+        ctx = self.conn.getEventContext()
+        try:
+            gid = int(self.conn.SERVICE_OPTS.getOmeroGroup())
+        except (TypeError, ValueError):
+            gid = -1
+        # The index of a group is shared by its members
+        if gid != -1 and (ctx.isAdmin or gid in ctx.memberOfGroups):
+            scope = 'group%s' % gid
+        else:
+            scope = 'user%s.group%s' % (ctx.userId, gid)
+        cache_key = 'omero.web.tags.index.%s.%s' % (scope, eid)
+
+        version = self.conn.getTagIndexVersion(eid)
+        index = cache.get(cache_key)
+        if index is None or index['version'] != version:
+            tags, owners = self.conn.listTagsRecursive(eid)
+            index = {'version': version, 'tags': tags, 'owners': owners}
+            cache.set(cache_key, index, settings.TAG_INDEX_CACHE_TIMEOUT)
+        self.tags_recursive = index['tags']
+        self.tags_recursive_owners = index['owners']
+
+    def searchTags(self, query, limit=20):
+        """
+        Returns the number of loaded tags whose text contains the query,
+        ignoring case, and the first 'limit' of them. Tags with text
+        starting with the query come first, then sorted by text.
+        """
+        query = query.lower()
+        matches = []
+        for tag in self.tags_recursive:
+            text = (tag[2] or '').lower()
+            pos = text.find(query)
+            if pos >= 0:
+                matches.append(((pos != 0, text, tag[0]), tag))
+        top = heapq.nsmallest(limit, matches, key=lambda m: m[0])
+        return len(matches), [tag for key, tag in top]
+
     def getTagCount(self, eid=None):
         return self.conn.getTagCount(eid)
 
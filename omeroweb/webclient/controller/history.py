@@ -26,12 +26,22 @@
 import calendar
 import datetime
 import time
+import omero
 
 from past.builtins import long
 from django.conf import settings
+from django.core.cache import cache
+from omero.rtypes import rlong, rtime, unwrap, wrap
 
 from omeroweb.webclient.controller import BaseController
 
+# EventLog entity types counted in the calendar
+CALENDAR_TYPES = {
+    'ome.model.core.Image': 'image',
+    'ome.model.containers.Dataset': 'dataset',
+    'ome.model.containers.Project': 'project',
+}
+
 
 class BaseCalendar(BaseController):
 
@@ -111,50 +121,33 @@ class BaseCalendar(BaseController):
 
         self.cal_days = []
 
-        items = self.calendar_items(self.month, self.monthrange)
+        counts = self.calendar_counts(self.month, self.monthrange)
 
         for week, day in [(week, day) for week
                           in range(0, len(self.cal_weeks))
                           for day in range(0, 7)]:
-            imgCounter = dict()
-            dsCounter = dict()
-            prCounter = dict()
-            imgCounter = 0
-            dsCounter = 0
-            prCounter = 0
             d = int(self.cal_weeks[week][day])
             if d > 0:
-                t_items = {'image': [], 'dataset': [], 'project': []}
-                for item in items.get(d):
-                    if item.get('type') == 'ome.model.core.Image':
-                        try:
-                            t_items['image'].index(item.get('id'))
-                        except Exception:
-                            imgCounter += 1
-                            t_items['image'].append(item.get('id'))
-                    elif item.get('type') == 'ome.model.containers.Dataset':
-                        try:
-                            t_items['dataset'].index(item.get('id'))
-                        except Exception:
-                            dsCounter += 1
-                            t_items['dataset'].append(item.get('id'))
-                    elif item.get('type') == 'ome.model.containers.Project':
-                        try:
-                            t_items['project'].index(item.get('id'))
-                        except Exception:
-                            prCounter += 1
-                            t_items['project'].append(item.get('id'))
+                day_counts = counts.get(d, {})
                 self.cal_days.append({
                     'day': self.cal_weeks[week][day],
-                    'counter': {'imgCounter': imgCounter,
-                                'dsCounter': dsCounter,
-                                'prCounter': prCounter}})
+                    'counter': {'imgCounter': day_counts.get('image', 0),
+                                'dsCounter': day_counts.get('dataset', 0),
+                                'prCounter': day_counts.get('project', 0)}})
             else:
                 self.cal_days.append({
                     'day': self.cal_weeks[week][day], 'counter': {}})
             self.cal_weeks[week][day] = {'cell': self.cal_days[-1]}
 
-    def calendar_items(self, month, monthrange):
+    def calendar_counts(self, month, monthrange):
+        """
+        Returns the number of distinct Images, Datasets and Projects
+        with events on each day of the month, as
+        {day: {'image': 1, 'dataset': 2, 'project': 0}}.
+        Counts are grouped by the server with a single aggregate query
+        and cached per user and month. Items for a single day are
+        loaded by get_items().
+        """
         if month < 10:
             mn = '0%i' % month
         else:
@@ -167,19 +160,49 @@ class BaseCalendar(BaseController):
 
         start = long(time.mktime(d1.timetuple())+1e-6*d1.microsecond)*1000
         end = long(time.mktime(d2.timetuple())+1e-6*d2.microsecond)*1000
-        all_logs = self.conn.getEventsByPeriod(start, end, self.eid)
-
-        items = dict()
-        for d in range(1, monthrange+1):
-            items[d] = list()
-        for i in all_logs:
-            for d in items:
-                if time.gmtime(i.event.time.val / 1000).tm_mday == d:
-                    items[d].append({
-                        'id': i.entityId.val,
-                        'type': i.entityType.val,
-                        'action': i.action.val})
-        return items
+
+        try:
+            gid = long(self.conn.SERVICE_OPTS.getOmeroGroup())
+        except Exception:
+            gid = self.conn.getEventContext().groupId
+        eid = self.eid or self.conn.getEventContext().userId
+
+        cache_key = 'omero.web.history.calendar.%s.%s.%s.%s.%s' % (
+            self.conn.getUserId(), eid, gid, self.year, month)
+        counts = cache.get(cache_key)
+        if counts is not None:
+            return counts
+
+        params = omero.sys.ParametersI()
+        params.add('start', rtime(start))
+        params.add('end', rtime(end))
+        params.add('eid', rlong(eid))
+        params.add('types', wrap(list(CALENDAR_TYPES.keys())))
+        group_clause = ''
+        if gid != -1:
+            params.add('gid', rlong(gid))
+            group_clause = 'and ev.experimenterGroup.id = :gid'
+        q = """
+            select day(ev.time), el.entityType, count(distinct el.entityId)
+            from EventLog el join el.event ev
+            where ev.time >= :start and ev.time <= :end
+            and ev.experimenter.id = :eid
+            and el.entityType in (:types)
+            and el.action in ('INSERT', 'UPDATE')
+            %s
+            group by day(ev.time), el.entityType
+            """ % group_clause
+        service_opts = self.conn.createServiceOptsDict()
+        service_opts.setOmeroGroup(gid)
+
+        counts = dict()
+        for row in self.conn.getQueryService().projection(
+                q, params, service_opts):
+            day, entity_type, count = unwrap(row)
+            counts.setdefault(int(day), {})[
+                CALENDAR_TYPES[entity_type]] = count
+        cache.set(cache_key, counts, settings.HISTORY_CALENDAR_CACHE_TIMEOUT)
+        return counts
 
     def month_range(self, year, month):
         if month == 12:
@@ -25,10 +25,15 @@
 
 from past.builtins import long
 import time
+import json
+import hashlib
 import omero
 import logging
 
-from omero.rtypes import rtime
+from django.conf import settings
+from django.core.cache import cache
+from omero.rtypes import rtime, unwrap
+from omeroweb.webclient import tree
 from omeroweb.webclient.controller import BaseController
 from omeroweb.webclient.webclient_utils import getDateTime
 
@@ -111,23 +116,50 @@ class BaseSearch(BaseController):
         self.searchError = None
         self.iids = []
 
+        searchTypes = []
+        for dt in onlyTypes:
+            dt = str(dt)
+            if dt in ['projects', 'datasets', 'images', 'screens',
+                      'plateacquisitions', 'plates', 'wells'] and \
+                    dt not in searchTypes:
+                searchTypes.append(dt)
+
         try:
-            for dt in onlyTypes:
-                dt = str(dt)
-                if dt in ['projects', 'datasets', 'images', 'screens',
-                          'plateacquisitions', 'plates', 'wells']:
-                    self.containers[dt] = doSearch(dt)
-                    if dt == "wells":
-                        for well in self.containers[dt]:
-                            well.name = "%s - %s" %\
-                                        (well.listParents()[0].name,
-                                         well.getWellPos())
-                    if dt == 'images':
-                        self.iids = [i.id for i in self.containers[dt]]
-                    # If we get a full page of results, we know there are more
-                    if len(self.containers[dt]) == batchSize:
-                        self.moreResults = True
-                    resultCount += len(self.containers[dt])
+            # Re-use the hits of the same search by this user, e.g. when
+            # loading more results or sorting, instead of searching again
+            cacheKeys = dict(
+                (dt, self._cache_key(
+                    dt, query, created, sorted(fields), batchSize, searchGroup,
+                    ownedBy, useAcquisitionDate, rawQuery))
+                for dt in searchTypes)
+            cachedIds = cache.get_many(list(cacheKeys.values()))
+            queries = dict((dt, (doSearch, {'searchType': dt}))
+                           for dt in searchTypes
+                           if cacheKeys[dt] not in cachedIds)
+            # Search for each type concurrently
+            self.containers = tree.run_queries(self.conn, queries)
+            cache.set_many(
+                dict((cacheKeys[dt], [o.id for o in self.containers[dt]])
+                     for dt in queries),
+                settings.SEARCH_CACHE_TIMEOUT)
+            for dt in searchTypes:
+                if dt not in self.containers:
+                    self.containers[dt] = self._load_objects(
+                        dt[0:-1], cachedIds[cacheKeys[dt]], searchGroup)
+
+            wells = self.containers.get('wells', [])
+            wellNames = tree.marshal_well_names(
+                self.conn, [well.id for well in wells])
+            for well in wells:
+                well.name = wellNames.get(well.id, '')
+
+            for dt in searchTypes:
+                if dt == 'images':
+                    self.iids = [i.id for i in self.containers[dt]]
+                # If we get a full page of results, we know there are more
+                if len(self.containers[dt]) == batchSize:
+                    self.moreResults = True
+                resultCount += len(self.containers[dt])
         except Exception as x:
             logger.info("Search Exception: %s" % x.message)
             if isinstance(x, omero.ServerError):
@@ -143,3 +175,25 @@ class BaseSearch(BaseController):
                         " key-value annotations in the form: 'key:value'.")
 
         self.c_size = resultCount
+
+    def _cache_key(self, searchType, *args):
+        """ Key of the hits of a search for the current user """
+        key = json.dumps([self.conn.getUserId(),
+                          self.conn.SERVICE_OPTS.getOmeroGroup(),
+                          searchType, unwrap(list(args))],
+                         sort_keys=True, default=str)
+        return 'omero.web.search.%s' % hashlib.md5(
+            key.encode('utf-8')).hexdigest()
+
+    def _load_objects(self, objType, ids, searchGroup):
+        """ Loads the objects of cached search hits, in the same order """
+        if not ids:
+            return []
+        group = self.conn.SERVICE_OPTS.getOmeroGroup()
+        if searchGroup is not None:
+            self.conn.SERVICE_OPTS.setOmeroGroup(searchGroup)
+        try:
+            return list(self.conn.getObjects(objType, ids,
+                                             respect_order=True))
+        finally:
+            self.conn.SERVICE_OPTS.setOmeroGroup(group)
@@ -1104,19 +1104,37 @@ OME.copyRenderingSettings = function(rdef_url, selected) {
 };
 
 OME.applyOwnerRenderingSettings = function(rdef_url, selected) {
-    OME.pasteRenderingSettings(rdef_url, selected);
+    OME.applyRenderingSettings(rdef_url, selected);
 };
 
 OME.resetRenderingSettings = function(rdef_url, selected) {
     OME.applyRenderingSettings(rdef_url, selected);
 };
 
-// Paste settings from 'session' to selected Objects
+// Paste settings from 'session' to selected Objects.
+// This runs in the background and is shown in the Activities panel.
 OME.pasteRenderingSettings = function(rdef_url, selected) {
-    OME.applyRenderingSettings(rdef_url, selected);
+    OME.applyRenderingSettings(rdef_url, selected, true);
 };
 
-OME.applyRenderingSettings = function(rdef_url, selected) {
+// IDs of background paste jobs, to refresh thumbnails when they finish
+OME.rdefJobs = [];
+
+OME.rdefJobsUpdate = function() {
+    var finished = OME.rdefJobs.filter(function(jobId) {
+        // rows are rendered with the id of the job, without 'WebJob/'
+        var row = document.getElementById(jobId.split('/')[1]);
+        return row && !$(row).hasClass('in_progress');
+    });
+    if (finished.length > 0) {
+        OME.rdefJobs = OME.rdefJobs.filter(function(jobId) {
+            return finished.indexOf(jobId) === -1;
+        });
+        OME.refreshThumbnails();
+    }
+};
+
+OME.applyRenderingSettings = function(rdef_url, selected, background) {
 
     var ids = [];
 
@@ -1132,6 +1150,9 @@ OME.applyRenderingSettings = function(rdef_url, selected) {
     if (type === 'dataset' || type === 'plate' || type === 'acquisition') {
         data.to_type = type;
     }
+    if (background) {
+        data.background = 'true';
+    }
 
     var confirmMsg = "This will save new rendering settings to " +
         selected.length + " " + type +
@@ -1149,8 +1170,15 @@ OME.applyRenderingSettings = function(rdef_url, selected) {
                     url: rdef_url,
                     data: data,
                     success: function(data){
-                        // update thumbnails
-                        OME.refreshThumbnails();
+                        var jobId = background && JSON.parse(data).jobId;
+                        if (jobId) {
+                            // thumbnails are updated when the job finishes
+                            OME.rdefJobs.push(jobId);
+                            OME.refreshActivities();
+                        } else {
+                            // update thumbnails
+                            OME.refreshThumbnails();
+                        }
                     }
                 });
             }
@@ -20,6 +20,7 @@
 ''' Helper functions for views that handle object trees '''
 
 import time
+import logging
 import omero
 from builtins import bytes
 from past.utils import old_div
@@ -29,6 +30,14 @@ from django.conf import settings
 from datetime import datetime
 from copy import deepcopy
 from omero.gateway import _letterGridLabel
+from omeroweb.utils import run_chunked, run_queries
+from omeroweb.webgateway.webgateway_cache import count_cache, \
+    thumbnail_version_cache
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of image IDs per thumbnail version query
+THUMB_VERSION_BATCH = 1000
 
 
 def unwrap_to_str(rstr):
@@ -52,6 +61,59 @@ def build_clause(components, name='', join=','):
     return ' ' + name + ' ' + (' ' + join + ' ').join(components) + ' '
 
 
+def _child_counts(conn, link_class, parent_ids, service_opts,
+                  child_class=None):
+    ''' Counts the children of containers with a single grouped query,
+        instead of a count subselect for each container. Counts are kept
+        in the count cache for a few seconds.
+
+        @param conn OMERO gateway.
+        @type conn L{omero.gateway.BlitzGateway}
+        @param link_class The link to count, e.g. 'ProjectDatasetLink'
+        @type link_class L{string}
+        @param parent_ids The IDs of the containers
+        @type parent_ids L{list}
+        @param service_opts The service options of the query
+        @param child_class Only count children of this class, e.g.
+        'TagAnnotation', or `None` to count all links
+        @type child_class L{string}
+        @return Dict of container ID to child count
+    '''
+    if not parent_ids:
+        return {}
+    prefix = (conn.getUserId(), service_opts.getOmeroGroup(), None,
+              link_class, child_class)
+    keys = dict((pid, prefix + (pid,)) for pid in parent_ids)
+    cached = count_cache.get_many(list(keys.values()))
+    counts = dict((pid, cached[key]) for pid, key in keys.items()
+                  if key in cached)
+    missing = [pid for pid in parent_ids if pid not in counts]
+    if not missing:
+        return counts
+
+    qs = conn.getQueryService()
+    q = '''
+        select link.parent.id, count(link.id) from %s link
+        where link.parent.id in (:ids)
+        ''' % link_class
+    if child_class is not None:
+        q += ' and link.child.class=%s' % child_class
+    q += ' group by link.parent.id'
+
+    def load_counts(ids):
+        params = omero.sys.ParametersI()
+        params.addIds(ids)
+        return qs.projection(q, params, service_opts)
+
+    loaded = dict((pid, 0) for pid in missing)
+    loaded.update(unwrap(row) for row in run_chunked(
+        conn, load_counts, missing))
+    count_cache.set_many(dict((keys[pid], count)
+                              for pid, count in loaded.items()))
+    counts.update(loaded)
+    return counts
+
+
 def parse_permissions_css(permissions, ownerid, conn):
     ''' Parse numeric permissions into a string of space separated
         CSS classes.
@@ -345,18 +407,18 @@ def marshal_projects(conn, group_id=-1, experimenter_id=-1,
         select new map(project.id as id,
                project.name as name,
                project.details.owner.id as ownerId,
-               project as project_details_permissions,
-               (select count(id) from ProjectDatasetLink pdl
-                where pdl.parent = project.id) as childCount)
+               project as project_details_permissions)
         from Project project
         %s
         order by lower(project.name), project.id
         """ % (where_clause)
 
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"], e[0]["name"], e[0]["ownerId"],
-             e[0]["project_details_permissions"], e[0]["childCount"]]
+    rows = [unwrap(e)[0] for e in qs.projection(q, params, service_opts)]
+    counts = _child_counts(conn, 'ProjectDatasetLink',
+                           [e["id"] for e in rows], service_opts)
+    for e in rows:
+        e = [e["id"], e["name"], e["ownerId"],
+             e["project_details_permissions"], counts[e["id"]]]
         projects.append(_marshal_project(conn, e[0:5]))
     return projects
 
@@ -387,7 +449,8 @@ def _marshal_dataset(conn, row):
 
 
 def marshal_datasets(conn, project_id=None, orphaned=False, group_id=-1,
-                     experimenter_id=-1, page=1, limit=settings.PAGE):
+                     experimenter_id=-1, page=1, limit=settings.PAGE,
+                     dataset_ids=None):
     ''' Marshals datasets
 
         @param conn OMERO gateway.
@@ -412,6 +475,10 @@ def marshal_datasets(conn, project_id=None, orphaned=False, group_id=-1,
         @param limit The limit of results per page to get
         defaults to the value set in settings.PAGE
         @type page L{long}
+        @param dataset_ids The Dataset IDs to filter by or `None` to
+        not filter by IDs.
+        defaults to `None`
+        @type dataset_ids L{list}
     '''
     datasets = []
     params = omero.sys.ParametersI()
@@ -431,14 +498,18 @@ def marshal_datasets(conn, project_id=None, orphaned=False, group_id=-1,
         params.addId(experimenter_id)
         where_clause.append('dataset.details.owner.id = :id')
 
+    if dataset_ids is not None:
+        if not dataset_ids:
+            return datasets
+        params.add('dids', wrap([rlong(id) for id in dataset_ids]))
+        where_clause.append('dataset.id in (:dids)')
+
     qs = conn.getQueryService()
     q = """
         select new map(dataset.id as id,
                dataset.name as name,
                dataset.details.owner.id as ownerId,
-               dataset as dataset_details_permissions,
-               (select count(id) from DatasetImageLink dil
-                 where dil.parent=dataset.id) as childCount)
+               dataset as dataset_details_permissions)
                from Dataset dataset
         """
 
@@ -464,13 +535,15 @@ def marshal_datasets(conn, project_id=None, orphaned=False, group_id=-1,
         order by lower(dataset.name), dataset.id
         """ % build_clause(where_clause, 'where', 'and')
 
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["dataset_details_permissions"],
-             e[0]["childCount"]]
+    rows = [unwrap(e)[0] for e in qs.projection(q, params, service_opts)]
+    counts = _child_counts(conn, 'DatasetImageLink',
+                           [e["id"] for e in rows], service_opts)
+    for e in rows:
+        e = [e["id"],
+             e["name"],
+             e["ownerId"],
+             e["dataset_details_permissions"],
+             counts[e["id"]]]
         datasets.append(_marshal_dataset(conn, e[0:5]))
     return datasets
 
@@ -548,7 +621,7 @@ def _marshal_image_deleted(conn, image_id):
 def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
                    load_pixels=False, group_id=-1, experimenter_id=-1,
                    page=1, date=False, thumb_version=False,
-                   limit=settings.PAGE):
+                   limit=settings.PAGE, image_ids=None):
 
     ''' Marshals images
 
@@ -580,6 +653,10 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
         @param limit The limit of results per page to get
         defaults to the value set in settings.PAGE
         @type page L{long}
+        @param image_ids The Image IDs to filter by or `None` to
+        not filter by IDs.
+        defaults to `None`
+        @type image_ids L{list}
 
     '''
     images = []
@@ -600,6 +677,11 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
     if experimenter_id is not None and experimenter_id != -1:
         params.addId(experimenter_id)
         where_clause.append('image.details.owner.id = :id')
+    if image_ids is not None:
+        if not image_ids:
+            return images
+        params.add('imageIds', wrap([rlong(id) for id in image_ids]))
+        where_clause.append('image.id in (:imageIds)')
     qs = conn.getQueryService()
 
     extraValues = ""
@@ -684,7 +766,6 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
         if not image_rids:
             return images
 
-        params.add('iids', wrap([rlong(id) for id in image_rids]))
         where_clause.append('image.id in (:iids)')
 
     q += """
@@ -693,8 +774,28 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
         """ % (' from ' + ' '.join(from_join_clauses),
                build_clause(where_clause, 'where', 'and'))
 
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)[0]
+    if share_id is not None:
+        # Shares can hold any number of images
+        def load_share_images(ids, offset=0, limit=None):
+            chunk_params = omero.sys.ParametersI()
+            chunk_params.map = dict(params.map)
+            chunk_params.add('iids', wrap([rlong(id) for id in ids]))
+            if limit is not None:
+                chunk_params.page(offset, limit)
+            return [unwrap(e)[0]
+                    for e in qs.projection(q, chunk_params, service_opts)]
+
+        paging = {}
+        if page is not None and page > 0:
+            paging = {'offset': (page - 1) * limit, 'limit': limit}
+        rows = run_chunked(
+            conn, load_share_images, image_rids,
+            id_key=lambda e: e['id'], **paging)
+    else:
+        rows = [unwrap(e)[0]
+                for e in qs.projection(q, params, service_opts)]
+
+    for e in rows:
         d = [e["id"],
              e["name"],
              e["ownerId"],
@@ -722,26 +823,35 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
     if thumb_version and len(images) > 0:
         userId = conn.getUserId()
         iids = [i['id'] for i in images]
-        params = omero.sys.ParametersI()
-        params.addIds(iids)
-        params.add('thumbOwner', rlong(userId))
-        q = """select image.id, thumbs.version from Image image
-            join image.pixels pix join pix.thumbnails thumbs
-            where image.id in (:ids)
-            and thumbs.id = (
+        thumbVersions = thumbnail_version_cache.get(userId, iids)
+        missing = [iid for iid in iids if iid not in thumbVersions]
+        q = """select pix.image.id, thumbs.version from Thumbnail thumbs
+            join thumbs.pixels pix
+            where thumbs.id in (
                 select max(t.id)
                 from Thumbnail t
-                where t.pixels = pix.id
+                where t.pixels.image.id in (:ids)
                 and t.details.owner.id = :thumbOwner
+                group by t.pixels.id
             )
             """
-        thumbVersions = {}
-        for t in qs.projection(q, params, service_opts):
-            iid, tv = unwrap(t)
-            thumbVersions[iid] = tv
+
+        def load_thumb_versions(ids):
+            params = omero.sys.ParametersI()
+            params.addIds(ids)
+            params.add('thumbOwner', rlong(userId))
+            return qs.projection(q, params, service_opts)
+
+        loaded = dict(unwrap(t) for t in run_chunked(
+            conn, load_thumb_versions, missing,
+            chunk_size=THUMB_VERSION_BATCH))
+        # Images without a thumbnail are not cached, since their thumbnail
+        # may be created by another web worker
+        thumbnail_version_cache.set(userId, loaded)
+        thumbVersions.update(loaded)
         # For all images, set thumb version if we have it...
         for i in images:
-            if i['id'] in thumbVersions:
+            if thumbVersions.get(i['id']) is not None:
                 i['thumbVersion'] = thumbVersions[i['id']]
 
     # If there were any deleted images in the share, marshal and return
@@ -753,6 +863,107 @@ def marshal_images(conn, dataset_id=None, orphaned=False, share_id=None,
     return images
 
 
+def marshal_changes(conn, parent_type, parent_id, since=0, known_ids=None,
+                    group_id=-1, **kwargs):
+    ''' Marshals the children of a Project or Dataset that changed
+        since a previous refresh of the tree, identified by the highest
+        updateEvent id the client has seen.
+
+        Children that were linked to the container after the `since` event
+        are returned as 'added' and children updated after it as
+        'updated', using the same dictionaries as L{marshal_datasets} and
+        L{marshal_images}. Unlinked or deleted children can only be found
+        by comparing with the children known to the client, so they are
+        returned as 'removed' (see L{_marshal_image_deleted}) if
+        `known_ids` is given. 'token' is the value of `since` to use for
+        the next refresh.
+
+        @param conn OMERO gateway.
+        @type conn L{omero.gateway.BlitzGateway}
+        @param parent_type 'project' or 'dataset'
+        @type parent_type L{string}
+        @param parent_id The Project or Dataset ID
+        @type parent_id L{long}
+        @param since The highest updateEvent id seen by the client
+        defaults to 0
+        @type since L{long}
+        @param known_ids The IDs of the children known to the client
+        or `None` to not look for removed children.
+        @type known_ids L{list}
+        @param group_id The Group ID to filter by or -1 for all groups,
+        defaults to -1
+        @type group_id L{long}
+        @param kwargs Passed to L{marshal_images} for dataset children
+        @type kwargs L{dict}
+    '''
+    params = omero.sys.ParametersI()
+    service_opts = deepcopy(conn.SERVICE_OPTS)
+    if group_id is None:
+        group_id = -1
+    service_opts.setOmeroGroup(group_id)
+    params.add('pid', rlong(parent_id))
+
+    if parent_type == 'project':
+        # A Dataset also changes when images are added to it (childCount)
+        q = """
+            select link.child.id,
+                   link.details.creationEvent.id,
+                   link.child.details.updateEvent.id,
+                   (select max(dil.details.creationEvent.id)
+                    from DatasetImageLink dil
+                    where dil.parent = link.child.id)
+            from ProjectDatasetLink link
+            where link.parent.id = :pid
+            """
+    elif parent_type == 'dataset':
+        q = """
+            select link.child.id,
+                   link.details.creationEvent.id,
+                   link.child.details.updateEvent.id
+            from DatasetImageLink link
+            where link.parent.id = :pid
+            """
+    else:
+        raise ValueError("Unsupported parent type: %s" % parent_type)
+
+    token = since
+    added_ids = set()
+    updated_ids = set()
+    child_ids = set()
+    for row in conn.getQueryService().projection(q, params, service_opts):
+        values = unwrap(row)
+        child_id, link_event = values[0:2]
+        child_ids.add(child_id)
+        event_id = max(v or 0 for v in values[2:])
+        if link_event > since:
+            added_ids.add(child_id)
+        elif event_id > since:
+            updated_ids.add(child_id)
+        token = max(token, link_event, event_id)
+
+    changed_ids = list(added_ids | updated_ids)
+    if parent_type == 'project':
+        children = marshal_datasets(conn, project_id=parent_id,
+                                    group_id=group_id, page=None,
+                                    dataset_ids=changed_ids)
+    else:
+        children = marshal_images(conn, dataset_id=parent_id,
+                                  group_id=group_id, page=None,
+                                  image_ids=changed_ids, **kwargs)
+
+    removed = []
+    if known_ids is not None:
+        removed = [_marshal_image_deleted(conn, child_id)
+                   for child_id in known_ids if child_id not in child_ids]
+
+    return {
+        'added': [c for c in children if c['id'] in added_ids],
+        'updated': [c for c in children if c['id'] in updated_ids],
+        'removed': removed,
+        'token': token
+    }
+
+
 def _marshal_screen(conn, row):
     ''' Given a Screen row (list) marshals it into a dictionary.  Order and
         type of columns in row is:
@@ -821,21 +1032,21 @@ def marshal_screens(conn, group_id=-1, experimenter_id=-1, page=1,
         select new map(screen.id as id,
                screen.name as name,
                screen.details.owner.id as ownerId,
-               screen as screen_details_permissions,
-               (select count(spl.id) from ScreenPlateLink spl
-                where spl.parent=screen.id) as childCount)
+               screen as screen_details_permissions)
                from Screen screen
                %s
                order by lower(screen.name), screen.id
         """ % where_clause
 
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["screen_details_permissions"],
-             e[0]["childCount"]]
+    rows = [unwrap(e)[0] for e in qs.projection(q, params, service_opts)]
+    counts = _child_counts(conn, 'ScreenPlateLink',
+                           [e["id"] for e in rows], service_opts)
+    for e in rows:
+        e = [e["id"],
+             e["name"],
+             e["ownerId"],
+             e["screen_details_permissions"],
+             counts[e["id"]]]
         screens.append(_marshal_screen(conn, e[0:5]))
 
     return screens
@@ -1206,11 +1417,7 @@ def marshal_tags(conn, tag_id=None, group_id=-1, experimenter_id=-1, page=1,
                    aalink.child.description as description,
                    aalink.child.details.owner.id as ownerId,
                    aalink.child as tag_details_permissions,
-                   aalink.child.ns as ns,
-                   (select count(aalink2)
-                    from AnnotationAnnotationLink aalink2
-                    where aalink2.child.class=TagAnnotation
-                    and aalink2.parent.id=aalink.child.id) as childCount)
+                   aalink.child.ns as ns)
             from AnnotationAnnotationLink aalink
             where aalink.parent.class=TagAnnotation
             and aalink.child.class=TagAnnotation
@@ -1236,11 +1443,7 @@ def marshal_tags(conn, tag_id=None, group_id=-1, experimenter_id=-1, page=1,
                    tag.description as description,
                    tag.details.owner.id as ownerId,
                    tag as tag_details_permissions,
-                   tag.ns as ns,
-                   (select count(aalink2)
-                    from AnnotationAnnotationLink aalink2
-                    where aalink2.child.class=TagAnnotation
-                    and aalink2.parent.id=tag.id) as childCount)
+                   tag.ns as ns)
             from TagAnnotation tag
             '''
 
@@ -1268,15 +1471,18 @@ def marshal_tags(conn, tag_id=None, group_id=-1, experimenter_id=-1, page=1,
         order by tag.id
         """ % build_clause(where_clause, 'where', 'and')
 
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["textValue"],
-             e[0]["description"],
-             e[0]["ownerId"],
-             e[0]["tag_details_permissions"],
-             e[0]["ns"],
-             e[0]["childCount"]]
+    rows = [unwrap(e)[0] for e in qs.projection(q, params, service_opts)]
+    counts = _child_counts(conn, 'AnnotationAnnotationLink',
+                           [e["id"] for e in rows], service_opts,
+                           child_class='TagAnnotation')
+    for e in rows:
+        e = [e["id"],
+             e["textValue"],
+             e["description"],
+             e["ownerId"],
+             e["tag_details_permissions"],
+             e["ns"],
+             counts[e["id"]]]
         tags.append(_marshal_tag(conn, e[0:7]))
 
     return tags
@@ -1293,6 +1499,19 @@ def marshal_tagged(conn, tag_id, group_id=-1, experimenter_id=-1, page=1,
                    load_pixels=False, date=False, limit=settings.PAGE):
     ''' Marshals tagged data
 
+        See tagged_queries() for parameters. Each type of tagged object
+        is loaded concurrently with run_queries().
+    '''
+    return run_queries(conn, tagged_queries(
+        conn, tag_id, group_id=group_id, experimenter_id=experimenter_id,
+        page=page, load_pixels=load_pixels, date=date, limit=limit))
+
+
+def tagged_queries(conn, tag_id, group_id=-1, experimenter_id=-1, page=1,
+                   load_pixels=False, date=False, limit=settings.PAGE):
+    ''' Returns the queries that marshal tagged data, for run_queries().
+        Keys are the same as those returned by marshal_tagged().
+
         @param conn OMERO gateway.
         @type conn L{omero.gateway.BlitzGateway}
         @param tag_id The tag ID to filter by
@@ -1310,7 +1529,6 @@ def marshal_tagged(conn, tag_id, group_id=-1, experimenter_id=-1, page=1,
         defaults to the value set in settings.PAGE
         @type page L{long}
     '''
-    tagged = {}
     params = omero.sys.ParametersI()
     service_opts = deepcopy(conn.SERVICE_OPTS)
 
@@ -1339,219 +1557,234 @@ def marshal_tagged(conn, tag_id, group_id=-1, experimenter_id=-1, page=1,
     params.add('tid', rlong(tag_id))
 
     # Projects
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.name as name,
-            lower(obj.name) as lowername,
-            obj.details.owner.id as ownerId,
-            obj as project_details_permissions,
-            (select count(id) from ProjectDatasetLink dil
-                where dil.parent=obj.id) as childCount)
-            from Project obj
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        ''' % common_clause
-
-    projects = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["project_details_permissions"],
-             e[0]["childCount"]]
-        projects.append(_marshal_project(conn, e[0:5]))
-    tagged['projects'] = projects
+    def load_projects():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.name as name,
+                lower(obj.name) as lowername,
+                obj.details.owner.id as ownerId,
+                obj as project_details_permissions,
+                (select count(id) from ProjectDatasetLink dil
+                    where dil.parent=obj.id) as childCount)
+                from Project obj
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            ''' % common_clause
+
+        projects = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["name"],
+                 e[0]["ownerId"],
+                 e[0]["project_details_permissions"],
+                 e[0]["childCount"]]
+            projects.append(_marshal_project(conn, e[0:5]))
+        return projects
 
     # Datasets
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.name as name,
-            lower(obj.name) as lowername,
-            obj.details.owner.id as ownerId,
-            obj as dataset_details_permissions,
-            (select count(id) from DatasetImageLink dil
-                where dil.parent=obj.id) as childCount)
-            from Dataset obj
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        ''' % common_clause
-
-    datasets = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["dataset_details_permissions"],
-             e[0]["childCount"]]
-        datasets.append(_marshal_dataset(conn, e[0:5]))
-    tagged['datasets'] = datasets
+    def load_datasets():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.name as name,
+                lower(obj.name) as lowername,
+                obj.details.owner.id as ownerId,
+                obj as dataset_details_permissions,
+                (select count(id) from DatasetImageLink dil
+                    where dil.parent=obj.id) as childCount)
+                from Dataset obj
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            ''' % common_clause
+
+        datasets = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["name"],
+                 e[0]["ownerId"],
+                 e[0]["dataset_details_permissions"],
+                 e[0]["childCount"]]
+            datasets.append(_marshal_dataset(conn, e[0:5]))
+        return datasets
 
     # Images
-    extraValues = ""
-    extraObjs = ""
-    if load_pixels:
-        extraValues = """
-             ,
-             pix.sizeX as sizeX,
-             pix.sizeY as sizeY,
-             pix.sizeZ as sizeZ
-             """
-        extraObjs = " left outer join obj.pixels pix"
-    if date:
-        extraValues += """,
-            obj.details.creationEvent.time as date,
-            obj.acquisitionDate as acqDate
-            """
-
-    q = """
-        select distinct new map(obj.id as id,
-               obj.name as name,
-               lower(obj.name) as lowername,
-               obj.details.owner.id as ownerId,
-               obj as image_details_permissions,
-               obj.fileset.id as filesetId %s)
-            from Image obj %s
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        """ % (extraValues, extraObjs, common_clause)
-
-    images = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        row = [e[0]["id"],
-               e[0]["name"],
-               e[0]["ownerId"],
-               e[0]["image_details_permissions"],
-               e[0]["filesetId"]]
-        kwargs = {}
+    def load_images():
+        extraValues = ""
+        extraObjs = ""
         if load_pixels:
-            d = [e[0]["sizeX"], e[0]["sizeY"], e[0]["sizeZ"]]
-            kwargs['row_pixels'] = d
+            extraValues = """
+                 ,
+                 pix.sizeX as sizeX,
+                 pix.sizeY as sizeY,
+                 pix.sizeZ as sizeZ
+                 """
+            extraObjs = " left outer join obj.pixels pix"
         if date:
-            kwargs['acqDate'] = e[0]['acqDate']
-            kwargs['date'] = e[0]['date']
-        images.append(_marshal_image(conn, row, **kwargs))
-    tagged['images'] = images
+            extraValues += """,
+                obj.details.creationEvent.time as date,
+                obj.acquisitionDate as acqDate
+                """
 
-    # Screens
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.name as name,
-            lower(obj.name) as lowername,
-            obj.details.owner.id as ownerId,
-            obj as screen_details_permissions,
-            (select count(id) from ScreenPlateLink spl
-                where spl.parent=obj.id) as childCount)
-            from Screen obj
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        ''' % common_clause
+        q = """
+            select distinct new map(obj.id as id,
+                   obj.name as name,
+                   lower(obj.name) as lowername,
+                   obj.details.owner.id as ownerId,
+                   obj as image_details_permissions,
+                   obj.fileset.id as filesetId %s)
+                from Image obj %s
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            """ % (extraValues, extraObjs, common_clause)
+
+        images = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            row = [e[0]["id"],
+                   e[0]["name"],
+                   e[0]["ownerId"],
+                   e[0]["image_details_permissions"],
+                   e[0]["filesetId"]]
+            kwargs = {}
+            if load_pixels:
+                d = [e[0]["sizeX"], e[0]["sizeY"], e[0]["sizeZ"]]
+                kwargs['row_pixels'] = d
+            if date:
+                kwargs['acqDate'] = e[0]['acqDate']
+                kwargs['date'] = e[0]['date']
+            images.append(_marshal_image(conn, row, **kwargs))
+        return images
 
-    screens = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["screen_details_permissions"],
-             e[0]["childCount"]]
-        screens.append(_marshal_screen(conn, e[0:5]))
-    tagged['screens'] = screens
+    # Screens
+    def load_screens():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.name as name,
+                lower(obj.name) as lowername,
+                obj.details.owner.id as ownerId,
+                obj as screen_details_permissions,
+                (select count(id) from ScreenPlateLink spl
+                    where spl.parent=obj.id) as childCount)
+                from Screen obj
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            ''' % common_clause
+
+        screens = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["name"],
+                 e[0]["ownerId"],
+                 e[0]["screen_details_permissions"],
+                 e[0]["childCount"]]
+            screens.append(_marshal_screen(conn, e[0:5]))
+        return screens
 
     # Plate
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.name as name,
-            lower(obj.name) as lowername,
-            obj.details.owner.id as ownerId,
-            obj as plate_details_permissions,
-            (select count(id) from PlateAcquisition pa
-                where pa.plate.id=obj.id) as childCount)
-            from Plate obj
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        ''' % common_clause
-
-    plates = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["plate_details_permissions"],
-             e[0]["childCount"]]
-        plates.append(_marshal_plate(conn, e[0:5]))
-    tagged['plates'] = plates
+    def load_plates():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.name as name,
+                lower(obj.name) as lowername,
+                obj.details.owner.id as ownerId,
+                obj as plate_details_permissions,
+                (select count(id) from PlateAcquisition pa
+                    where pa.plate.id=obj.id) as childCount)
+                from Plate obj
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            ''' % common_clause
+
+        plates = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["name"],
+                 e[0]["ownerId"],
+                 e[0]["plate_details_permissions"],
+                 e[0]["childCount"]]
+            plates.append(_marshal_plate(conn, e[0:5]))
+        return plates
 
     # Plate Acquisitions
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.name as name,
-            lower(obj.name) as lowername,
-            obj.details.owner.id as ownerId,
-            obj as plateacquisition_details_permissions,
-            obj.startTime as startTime,
-            obj.endTime as endTime)
-        from PlateAcquisition obj
-            join obj.annotationLinks alink
-            where alink.child.id=:tid
-        %s
-        ''' % common_clause
-
-    plate_acquisitions = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["name"],
-             e[0]["ownerId"],
-             e[0]["plateacquisition_details_permissions"],
-             e[0]["startTime"],
-             e[0]["endTime"]]
-        plate_acquisitions.append(_marshal_plate_acquisition(conn, e[0:6]))
-    tagged['acquisitions'] = plate_acquisitions
+    def load_acquisitions():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.name as name,
+                lower(obj.name) as lowername,
+                obj.details.owner.id as ownerId,
+                obj as plateacquisition_details_permissions,
+                obj.startTime as startTime,
+                obj.endTime as endTime)
+            from PlateAcquisition obj
+                join obj.annotationLinks alink
+                where alink.child.id=:tid
+            %s
+            ''' % common_clause
+
+        plate_acquisitions = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["name"],
+                 e[0]["ownerId"],
+                 e[0]["plateacquisition_details_permissions"],
+                 e[0]["startTime"],
+                 e[0]["endTime"]]
+            plate_acquisitions.append(_marshal_plate_acquisition(conn, e[0:6]))
+        return plate_acquisitions
 
     # Wells
-    q = '''
-        select distinct new map(obj.id as id,
-            obj.details.owner.id as ownerId,
-            obj as well_details_permissions,
-            obj.row as row,
-            obj.column as column,
-            plate.id as plateId,
-            plate.columnNamingConvention as colnames,
-            plate.rowNamingConvention as rownames,
-            plate.name as platename)
-        from Well obj
-            join obj.annotationLinks alink
-            join obj.plate plate
-            where alink.child.id=:tid
-        order by obj.row, obj.column
-        '''
-    # E.g. sort A1, A2, B1, B2
-
-    wells = []
-    for e in qs.projection(q, params, service_opts):
-        e = unwrap(e)
-        e = [e[0]["id"],
-             e[0]["ownerId"],
-             e[0]["well_details_permissions"],
-             e[0]["row"],
-             e[0]["column"],
-             e[0]["plateId"],
-             e[0]["rownames"],
-             e[0]["colnames"],
-             e[0]["platename"]]
-        wells.append(_marshal_well(conn, e[0:9]))
-    tagged['wells'] = wells
+    def load_wells():
+        q = '''
+            select distinct new map(obj.id as id,
+                obj.details.owner.id as ownerId,
+                obj as well_details_permissions,
+                obj.row as row,
+                obj.column as column,
+                plate.id as plateId,
+                plate.columnNamingConvention as colnames,
+                plate.rowNamingConvention as rownames,
+                plate.name as platename)
+            from Well obj
+                join obj.annotationLinks alink
+                join obj.plate plate
+                where alink.child.id=:tid
+            order by obj.row, obj.column
+            '''
+        # E.g. sort A1, A2, B1, B2
+
+        wells = []
+        for e in qs.projection(q, params, service_opts):
+            e = unwrap(e)
+            e = [e[0]["id"],
+                 e[0]["ownerId"],
+                 e[0]["well_details_permissions"],
+                 e[0]["row"],
+                 e[0]["column"],
+                 e[0]["plateId"],
+                 e[0]["rownames"],
+                 e[0]["colnames"],
+                 e[0]["platename"]]
+            wells.append(_marshal_well(conn, e[0:9]))
+        return wells
 
-    return tagged
+    return {
+        'projects': (load_projects, {}),
+        'datasets': (load_datasets, {}),
+        'images': (load_images, {}),
+        'screens': (load_screens, {}),
+        'plates': (load_plates, {}),
+        'acquisitions': (load_acquisitions, {}),
+        'wells': (load_wells, {}),
+    }
 
 
 def _marshal_well(conn, row):
@@ -1579,10 +1812,50 @@ def _marshal_well(conn, row):
     well['plateId'] = unwrap(plateId)
     well['permsCss'] = \
         parse_permissions_css(perms, unwrap(owner_id), conn)
+    well['name'] = _well_name(platename, row, col, rownames, colnames)
+    return well
+
+
+def _well_name(platename, row, col, rownames, colnames):
+    ''' Returns the display name of a Well, e.g. 'plate - A1', using the
+        naming convention of the Plate
+    '''
     rowname = str(row + 1) if rownames == 'number' else _letterGridLabel(row)
     colname = _letterGridLabel(col) if colnames == 'letter' else str(col + 1)
-    well['name'] = "%s - %s%s" % (platename, rowname, colname)
-    return well
+    return "%s - %s%s" % (platename, rowname, colname)
+
+
+def marshal_well_names(conn, well_ids, group_id=-1):
+    ''' Loads the display names of Wells, e.g. 'plate - A1', with a single
+        query instead of loading the Plate of each Well.
+
+        @param conn OMERO gateway.
+        @type conn L{omero.gateway.BlitzGateway}
+        @param well_ids The Well IDs
+        @type well_ids L{list}
+        @param group_id The Group ID to filter by or -1 for all groups,
+        defaults to -1
+        @type group_id L{long}
+        @return Dict of Well ID to name
+    '''
+    names = {}
+    if not well_ids:
+        return names
+    params = omero.sys.ParametersI()
+    params.addIds(well_ids)
+    service_opts = deepcopy(conn.SERVICE_OPTS)
+    service_opts.setOmeroGroup(group_id)
+    q = """
+        select well.id, well.row, well.column, plate.name,
+               plate.rowNamingConvention, plate.columnNamingConvention
+        from Well well
+        join well.plate plate
+        where well.id in (:ids)
+        """
+    for row in conn.getQueryService().projection(q, params, service_opts):
+        well_id, row, col, platename, rownames, colnames = unwrap(row)
+        names[well_id] = _well_name(platename, row, col, rownames, colnames)
+    return names
 
 
 def _marshal_share(conn, row):
@@ -1813,19 +2086,46 @@ def init_params(group_id, page, limit):
     return params
 
 
-def _marshal_exp_obj(experimenter):
-    exp = {}
-    exp['id'] = experimenter.id.val
-    exp['omeName'] = experimenter.omeName.val
-    exp['firstName'] = unwrap(experimenter.firstName)
-    exp['lastName'] = unwrap(experimenter.lastName)
-    return exp
+def _marshal_annotation_link(dtype, row):
+    ''' Given an annotation link row (dict) marshals it into the 'link'
+        of an annotation, like L{_marshal_annotation} does for a link
+        object. The keys of the row are the ones loaded by
+        L{marshal_annotations}.
+
+        @param dtype The type of the parent, e.g. 'Image'
+        @type dtype L{string}
+        @param row The annotation link row to marshal
+        @type row L{dict}
+    '''
+    link = {}
+    link['id'] = row['id']
+    link['owner'] = {'id': row['ownerId']}
+    link['parent'] = {'id': row['parentId'],
+                      'class': '%sI' % dtype}
+    # Well has no name
+    if dtype != 'Well':
+        link['parent']['name'] = row.get('parentName')
+    link['date'] = _marshal_date(row['date'])
+    p = row['oal_details_permissions']
+    link['permissions'] = {'canDelete': p['canDelete'],
+                           'canAnnotate': p['canAnnotate'],
+                           'canLink': p['canLink'],
+                           'canEdit': p['canEdit']}
+    return link
 
 
 def marshal_annotations(conn, project_ids=None, dataset_ids=None,
                         image_ids=None, screen_ids=None, plate_ids=None,
                         run_ids=None, well_ids=None, ann_type=None, ns=None,
                         group_id=-1, page=1, limit=settings.PAGE):
+    ''' Marshals the annotations linked to the given objects, one
+        dictionary per link, and the owners of the annotations and links.
+
+        Links are loaded as scalar fields, then each annotation is loaded
+        and marshalled once however many objects it is linked to. Paging
+        is by annotation: all the links of the annotations of a page are
+        returned.
+    '''
 
     annotations = []
     qs = conn.getQueryService()
@@ -1866,37 +2166,97 @@ def marshal_annotations(conn, project_ids=None, dataset_ids=None,
     obj_ids = [project_ids, dataset_ids, image_ids,
                screen_ids, plate_ids, run_ids, well_ids]
 
-    experimenters = {}
+    params = omero.sys.ParametersI()
+    if ns is not None:
+        params.add('ns', wrap(ns))
 
+    # Load the links of the selected objects as scalar fields only
+    links = []
     for dtype, ids in zip(dtypes, obj_ids):
         if ids is None or len(ids) == 0:
             continue
-        params = init_params(group_id, page, limit)
-        params.addIds(ids)
-        if ns is not None:
-            params.add('ns', wrap(ns))
+        # Well has no name
+        parent_name = 'pa.name as parentName,' if dtype != 'Well' else ''
         q = """
-            select oal from %sAnnotationLink as oal
-            join fetch oal.details.creationEvent
-            join fetch oal.details.owner
-            left outer join fetch oal.child as ch
-            left outer join fetch oal.parent as pa
+            select new map(oal.id as id,
+                   oal.details.owner.id as ownerId,
+                   oal.details.creationEvent.time as date,
+                   oal as oal_details_permissions,
+                   pa.id as parentId, %s
+                   ch.id as annId,
+                   ch.ns as annNs)
+            from %sAnnotationLink as oal
+            join oal.child as ch
+            join oal.parent as pa
+            where %s
+            """ % (parent_name, dtype, ' and '.join(where_clause))
+
+        def load_links(ids, q=q):
+            chunk_params = omero.sys.ParametersI()
+            chunk_params.map = dict(params.map)
+            chunk_params.addIds(ids)
+            return qs.projection(q, chunk_params, service_opts)
+
+        links.extend((dtype, unwrap(row)[0])
+                     for row in run_chunked(conn, load_links, ids))
+
+    # Page by annotation, not by link: annotations are ordered by namespace
+    # (null last) like 'order by ch.ns', then by id
+    ann_ns = {}
+    for dtype, link in links:
+        ann_ns[link['annId']] = link['annNs']
+    ann_ids = sorted(ann_ns, key=lambda ann_id: (
+        ann_ns[ann_id] is None, ann_ns[ann_id] or '', ann_id))
+    if page is not None and page > 0:
+        ann_ids = ann_ids[(page - 1) * limit:page * limit]
+
+    # Load and marshal each annotation only once, however many of the
+    # selected objects it is linked to
+    def load_annotations(ids):
+        chunk_params = omero.sys.ParametersI()
+        chunk_params.addIds(ids)
+        return qs.findAllByQuery(
+            """
+            select ch from Annotation as ch
             join fetch ch.details.creationEvent
-            join fetch ch.details.owner
             left outer join fetch ch.file as file
-            where %s order by ch.ns
-            """ % (dtype, ' and '.join(where_clause))
-
-        for link in qs.findAllByQuery(q, params, service_opts):
-            ann = link.child
-            d = _marshal_annotation(conn, ann, link)
+            where ch.id in (:ids)
+            """, chunk_params, service_opts)
+
+    marshalled = {}
+    owner_ids = set()
+    for ann in run_chunked(conn, load_annotations, ann_ids):
+        d = _marshal_annotation(conn, ann)
+        marshalled[d['id']] = d
+        owner_ids.add(d['owner']['id'])
+
+    links_by_ann = {}
+    for dtype, link in links:
+        if link['annId'] in marshalled:
+            links_by_ann.setdefault(link['annId'], []).append(
+                _marshal_annotation_link(dtype, link))
+            owner_ids.add(link['ownerId'])
+    for ann_id in ann_ids:
+        for link in links_by_ann.get(ann_id, []):
+            d = dict(marshalled[ann_id])
+            d['link'] = link
             annotations.append(d)
-            exp = _marshal_exp_obj(link.details.owner)
-            experimenters[exp['id']] = exp
-            exp = _marshal_exp_obj(ann.details.owner)
-            experimenters[exp['id']] = exp
 
-    experimenters = list(experimenters.values())
+    def load_experimenters(ids):
+        chunk_params = omero.sys.ParametersI()
+        chunk_params.addIds(ids)
+        return qs.projection(
+            """
+            select new map(e.id as id,
+                   e.omeName as omeName,
+                   e.firstName as firstName,
+                   e.lastName as lastName)
+            from Experimenter as e
+            where e.id in (:ids)
+            """, chunk_params, service_opts)
+
+    experimenters = [unwrap(e)[0] for e in run_chunked(
+        conn, load_experimenters, sorted(owner_ids))]
     # sort by id mostly for testing
     experimenters.sort(key=lambda x: x['id'])
 
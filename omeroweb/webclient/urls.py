@@ -66,6 +66,8 @@ urlpatterns = [
         views.activities,
         {'template': 'json'},
         name="activities_json"),
+    url(r'^activities_poll/$', views.activities_poll,
+        name="activities_poll"),
     url(r'^activities_update/(?:(?P<action>clean)/)?$',
         views.activities_update,
         name="activities_update"),
@@ -293,6 +295,9 @@ urlpatterns = [
 
     url(r'^api/images/$', views.api_image_list, name='api_images'),
 
+    # Children of a project or dataset changed since a previous refresh
+    url(r'^api/changes/$', views.api_tree_changes, name='api_tree_changes'),
+
     # special case: share_id not allowed in query string since we
     # just want to allow share connection for this url ONLY.
     url(r'^api/share_images/(?P<share_id>[0-9]+)/$', views.api_image_list,
@@ -32,12 +32,13 @@ import traceback
 import json
 import re
 import sys
+import threading
 import warnings
 from past.builtins import unicode
 from future.utils import bytes_to_native_str
 
 from io import StringIO
-from time import time
+from time import mktime, sleep, time
 
 from omeroweb.version import omeroweb_buildyear as build_year
 from omeroweb.version import omeroweb_version as omero_version
@@ -82,7 +83,9 @@ from omeroweb.webadmin.forms import LoginForm
 
 from omeroweb.webgateway import views as webgateway_views
 from omeroweb.webgateway.marshal import chgrpMarshal
+from omeroweb.webgateway.jobs import background_jobs, JOB_STATUS_TIME
 from omeroweb.webgateway.util import get_longs as webgateway_get_longs
+from omeroweb.webgateway.webgateway_cache import count_cache
 
 from omeroweb.feedback.views import handlerInternalError
 
@@ -91,6 +94,8 @@ from omeroweb.webclient.decorators import render_response
 from omeroweb.webclient.show import Show, IncorrectMenuError, \
     paths_to_object, paths_to_tag
 from omeroweb.decorators import ConnCleaningHttpResponse, parse_url
+from omeroweb.decorators import get_client_ip
+from omeroweb.connector import KeepAliveCoalescer
 from omeroweb.webgateway.util import getIntOrDefault
 
 from omero.model import ProjectI, DatasetI, ImageI, \
@@ -112,6 +117,9 @@ logger = logging.getLogger(__name__)
 
 logger.info("INIT '%s'" % os.getpid())
 
+# Coalesces the keepalive pings of the open pages of each OMERO session
+keepalive_coalescer = KeepAliveCoalescer(settings.KEEPALIVE_WINDOW)
+
 
 def get_long_or_default(request, name, default):
     """
@@ -283,12 +291,25 @@ class WebclientLoginView(LoginView):
         return render(request, self.template, context)
 
 
-@login_required(ignore_login_fail=True)
-def keepalive_ping(request, conn=None, **kwargs):
-    """ Keeps the OMERO session alive by pinging the server """
-
-    # login_required handles ping, timeout etc, so we don't need to do
-    # anything else
+def keepalive_ping(request, **kwargs):
+    """
+    Keeps the OMERO session alive by pinging the server.
+    This doesn't use login_required, which prepares a connection for a view:
+    the session is only joined to refresh its last access time, at most
+    once per omero.web.keepalive_window for all the open pages of a user.
+    """
+    connector = request.session.get('connector')
+    if connector is None or connector.omero_session_key is None:
+        return HttpResponse("Connection Failed")
+    # Sessions of the public user are created again when needed
+    if connector.is_public:
+        return HttpResponse("OK")
+    session_key = connector.omero_session_key
+    if not keepalive_coalescer.due(session_key):
+        return HttpResponse("OK")
+    if not connector.keep_alive('OMERO.web', get_client_ip(request)):
+        keepalive_coalescer.forget(session_key)
+        return HttpResponse("Connection Failed")
     return HttpResponse("OK")
 
 
@@ -612,60 +633,38 @@ def api_container_list(request, conn=None, **kwargs):
     if not conn.isValidGroup(group_id):
         return HttpResponseForbidden("Not a member of Group: %s" % group_id)
 
-    r = dict()
-    try:
+    # Each of these is independent, so we run them concurrently
+    common = {'conn': conn,
+              'group_id': group_id,
+              'experimenter_id': experimenter_id,
+              'page': page,
+              'limit': limit}
+    queries = {
         # Get the projects
-        r['projects'] = tree.marshal_projects(
-            conn=conn,
-            group_id=group_id,
-            experimenter_id=experimenter_id,
-            page=page,
-            limit=limit)
-
+        'projects': (tree.marshal_projects, common),
         # Get the orphaned datasets (without project parents)
-        r['datasets'] = tree.marshal_datasets(
-            conn=conn,
-            orphaned=True,
-            group_id=group_id,
-            experimenter_id=experimenter_id,
-            page=page,
-            limit=limit)
-
+        'datasets': (tree.marshal_datasets, dict(common, orphaned=True)),
         # Get the screens for the current user
-        r['screens'] = tree.marshal_screens(
-            conn=conn,
-            group_id=group_id,
-            experimenter_id=experimenter_id,
-            page=page,
-            limit=limit)
-
+        'screens': (tree.marshal_screens, common),
         # Get the orphaned plates (without project parents)
-        r['plates'] = tree.marshal_plates(
-            conn=conn,
-            orphaned=True,
-            group_id=group_id,
-            experimenter_id=experimenter_id,
-            page=page,
-            limit=limit)
-        # Get the orphaned images container
-        try:
-            orph_t = request \
-                .session['server_settings']['ui']['tree']['orphans']
-        except Exception:
-            orph_t = {'enabled': True}
-        if (conn.isAdmin() or
-                conn.isLeader(gid=request.session.get('active_group')) or
-                experimenter_id == conn.getUserId() or
-                orph_t.get('enabled', True)):
-
-            orphaned = tree.marshal_orphaned(
-                conn=conn,
-                group_id=group_id,
-                experimenter_id=experimenter_id,
-                page=page,
-                limit=limit)
-            orphaned['name'] = orph_t.get('name', "Orphaned Images")
-            r['orphaned'] = orphaned
+        'plates': (tree.marshal_plates, dict(common, orphaned=True)),
+    }
+    # Get the orphaned images container
+    try:
+        orph_t = request \
+            .session['server_settings']['ui']['tree']['orphans']
+    except Exception:
+        orph_t = {'enabled': True}
+    if (conn.isAdmin() or
+            conn.isLeader(gid=request.session.get('active_group')) or
+            experimenter_id == conn.getUserId() or
+            orph_t.get('enabled', True)):
+        queries['orphaned'] = (tree.marshal_orphaned, common)
+
+    try:
+        r = tree.run_queries(conn, queries)
+        if 'orphaned' in r:
+            r['orphaned']['name'] = orph_t.get('name', "Orphaned Images")
     except ApiUsageException as e:
         return HttpResponseBadRequest(e.serverStackTrace)
     except ServerError as e:
@@ -765,6 +764,61 @@ def api_image_list(request, conn=None, **kwargs):
     return JsonResponse({'images': images})
 
 
+@login_required()
+def api_tree_changes(request, conn=None, **kwargs):
+    ''' Get the children of a Project or Dataset that changed since
+        the 'since' token returned by a previous call.
+        Children known to the client can be given as 'ids' (GET or POST)
+        to find the ones that were removed.
+    '''
+    data = request.POST if request.method == 'POST' else request.GET
+    try:
+        group_id = get_long_or_default(request, 'group', -1)
+        since = long(data.get('since', 0))
+        known_ids = None
+        if 'ids' in data:
+            known_ids = [long(i) for i in data.getlist('ids') if i != '']
+        load_pixels = get_bool_or_default(request, 'sizeXYZ', False)
+        thumb_version = get_bool_or_default(request, 'thumbVersion', False)
+        date = get_bool_or_default(request, 'date', False)
+        project_id = get_long_or_default(request, 'project', None)
+        dataset_id = get_long_or_default(request, 'dataset', None)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid parameter value')
+
+    if (project_id is None) == (dataset_id is None):
+        return HttpResponseBadRequest('Need one of project or dataset')
+
+    if not conn.isValidGroup(group_id):
+        return HttpResponseForbidden("Not a member of Group: %s" % group_id)
+
+    kwargs = {}
+    if project_id is not None:
+        parent_type, parent_id = 'project', project_id
+    else:
+        parent_type, parent_id = 'dataset', dataset_id
+        kwargs = {'load_pixels': load_pixels,
+                  'thumb_version': thumb_version,
+                  'date': date}
+
+    try:
+        changes = tree.marshal_changes(conn=conn,
+                                       parent_type=parent_type,
+                                       parent_id=parent_id,
+                                       since=since,
+                                       known_ids=known_ids,
+                                       group_id=group_id,
+                                       **kwargs)
+    except ApiUsageException as e:
+        return HttpResponseBadRequest(e.serverStackTrace)
+    except ServerError as e:
+        return HttpResponseServerError(e.serverStackTrace)
+    except IceException as e:
+        return HttpResponseServerError(e.message)
+
+    return JsonResponse(changes)
+
+
 @login_required()
 def api_plate_list(request, conn=None, **kwargs):
     # Get parameters
@@ -851,9 +905,6 @@ def get_object_links(conn, parent_type, parent_id, child_type, child_ids):
     if not link_type:
         raise Http404("json data needs 'parent_type' and 'child_type'")
 
-    params = omero.sys.ParametersI()
-    params.addIds(child_ids)
-
     qs = conn.getQueryService()
     # Need to fetch child and parent, otherwise
     # AnnotationAnnotationLink is not loaded
@@ -862,10 +913,16 @@ def get_object_links(conn, parent_type, parent_id, child_type, child_ids):
         where olink.child.id in (:ids)
         """ % link_type
     if parent_id:
-        params.add('pid', rlong(parent_id))
         q += " and olink.parent.id = :pid"
 
-    res = qs.findAllByQuery(q, params, conn.SERVICE_OPTS)
+    def load_links(ids):
+        params = omero.sys.ParametersI()
+        params.addIds(ids)
+        if parent_id:
+            params.add('pid', rlong(parent_id))
+        return qs.findAllByQuery(q, params, conn.SERVICE_OPTS)
+
+    res = tree.run_chunked(conn, load_links, child_ids)
 
     if parent_id is not None and len(res) == 0:
         raise Http404("No link found for %s-%s to %s-%s"
@@ -932,9 +989,12 @@ def api_links(request, conn=None, **kwargs):
         json_data = json.loads(bytes_to_native_str(request.body))
 
     if request.method == 'POST':
-        return _api_links_POST(conn, json_data)
+        rv = _api_links_POST(conn, json_data)
     elif request.method == 'DELETE':
-        return _api_links_DELETE(conn, json_data)
+        rv = _api_links_DELETE(conn, json_data)
+    # Child counts and orphans have changed
+    count_cache.clear()
+    return rv
 
 
 def _api_links_POST(conn, json_data, **kwargs):
@@ -1156,25 +1216,28 @@ def api_tags_and_tagged_list_GET(request, conn=None, **kwargs):
     try:
         # Get ALL data (all owners) under specified tags
         if tag_id is not None:
-            tagged = tree.marshal_tagged(conn=conn,
-                                         experimenter_id=experimenter_id,
-                                         tag_id=tag_id,
-                                         group_id=group_id,
-                                         page=page,
-                                         load_pixels=load_pixels,
-                                         date=date,
-                                         limit=limit)
+            queries = tree.tagged_queries(conn=conn,
+                                          experimenter_id=experimenter_id,
+                                          tag_id=tag_id,
+                                          group_id=group_id,
+                                          page=page,
+                                          load_pixels=load_pixels,
+                                          date=date,
+                                          limit=limit)
         else:
-            tagged = {}
+            queries = {}
 
         # Get 'tags' under tag_id
-        tagged['tags'] = tree.marshal_tags(conn=conn,
-                                           orphaned=orphaned,
-                                           experimenter_id=experimenter_id,
-                                           tag_id=tag_id,
-                                           group_id=group_id,
-                                           page=page,
-                                           limit=limit)
+        queries['tags'] = (tree.marshal_tags, {
+            'conn': conn,
+            'orphaned': orphaned,
+            'experimenter_id': experimenter_id,
+            'tag_id': tag_id,
+            'group_id': group_id,
+            'page': page,
+            'limit': limit})
+        # Run all the queries concurrently
+        tagged = tree.run_queries(conn, queries)
     except ApiUsageException as e:
         return HttpResponseBadRequest(e.serverStackTrace)
     except ServerError as e:
@@ -2397,6 +2460,10 @@ def annotate_map(request, conn=None, **kwargs):
 def marshal_tagging_form_data(request, conn=None, **kwargs):
     """
     Provides json data to ome.tagging_form.js
+
+    Tags are loaded from an index of the group's tags, see
+    BaseContainer.loadTagIndex(). jsonmode=search returns the number of tags
+    matching 'query' and the first 'limit' of them.
     """
 
     group = get_long_or_default(request, 'group', -1)
@@ -2413,10 +2480,24 @@ def marshal_tagging_form_data(request, conn=None, **kwargs):
         return dict(tag_count=tag_count)
 
     manager = BaseContainer(conn)
-    manager.loadTagsRecursive(eid=-1, offset=offset, limit=limit)
+    manager.loadTagIndex(eid=-1)
     all_tags = manager.tags_recursive
     all_tags_owners = manager.tags_recursive_owners
 
+    if jsonmode == 'search':
+        # tags with text starting with or containing the query
+        query = request.GET.get('query', '')
+        count, tags = manager.searchTags(
+            query, get_long_or_default(request, 'limit', 20))
+        return dict(
+            count=count,
+            tags=list((i, t, o, s) for i, d, t, o, s in tags),
+            desc=dict((i, d) for i, d, t, o, s in tags),
+            owners=dict((o, all_tags_owners[o]) for i, d, t, o, s in tags))
+
+    if offset is not None:
+        all_tags = all_tags[offset:offset + limit]
+
     if jsonmode == 'tags':
         # send tag information without descriptions
         r = list((i, t, o, s) for i, d, t, o, s in all_tags)
@@ -2635,6 +2716,11 @@ def manage_action_containers(request, action, o_type=None, o_id=None,
                         "tagset","share", "sharecomment"
     """
     template = None
+    if request.method == 'POST':
+        # Creating, moving or deleting objects changes child counts and
+        # orphans. Deletes run in the background: their counts are picked
+        # up when the cached counts expire.
+        count_cache.clear()
 
     manager = None
     if o_type in ("dataset", "project", "image", "screen", "plate",
@@ -2966,14 +3052,11 @@ def get_original_file(request, fileId, download=False, conn=None, **kwargs):
         rsp.conn = conn
         return rsp
 
-    rsp = ConnCleaningHttpResponse(
-        orig_file.getFileInChunks(buf=settings.CHUNK_SIZE))
-    rsp.conn = conn
+    rsp = webgateway_views.original_file_response(request, orig_file, conn)
     mimetype = orig_file.mimetype
     if mimetype == "text/x-python":
         mimetype = "text/plain"  # allows display in browser
     rsp['Content-Type'] = mimetype
-    rsp['Content-Length'] = orig_file.getSize()
 
     if download:
         downloadName = orig_file.name.replace(" ", "_")
@@ -3083,11 +3166,9 @@ def download_annotation(request, annId, conn=None, **kwargs):
         rsp.conn = conn
         return rsp
 
-    rsp = ConnCleaningHttpResponse(
-        ann.getFileInChunks(buf=settings.CHUNK_SIZE))
-    rsp.conn = conn
+    rsp = webgateway_views.original_file_response(
+        request, ann.getFile(), conn, size=ann.getFileSize())
     rsp['Content-Type'] = 'application/force-download'
-    rsp['Content-Length'] = ann.getFileSize()
     rsp['Content-Disposition'] = ('attachment; filename=%s'
                                   % (ann.getFileName().replace(" ", "_")))
     return rsp
@@ -3290,12 +3371,334 @@ def getObjectUrl(conn, obj):
 
 ######################
 # Activities window & Progressbar
+
+# Results of recent _poll_callback() calls by this process
+_callback_polls = {}
+_callback_polls_lock = threading.Lock()
+
+
 def update_callback(request, cbString, **kwargs):
     """Update a callback handle with  key/value pairs"""
     for key, value in kwargs.items():
         request.session['callback'][cbString][key] = value
 
 
+def _poll_callback(conn, cbString, callbackDict):
+    """
+    Checks the handle of an unfinished job in request.session['callback'].
+    Returns (state, updates) without modifying the session, where state is
+    'in progress', 'new' if the job has just completed or None, and updates
+    is a dict of new values for the job.
+    """
+    updates = {}
+    state = None
+    job_type = callbackDict['job_type']
+    status = callbackDict['status']
+    if status in ("failed", "finished"):
+        return state, updates
+
+    # update chgrp
+    if job_type == 'chgrp':
+        rsp = None
+        try:
+            prx = omero.cmd.HandlePrx.checkedCast(
+                conn.c.ic.stringToProxy(cbString))
+            rsp = prx.getResponse()
+            close_handle = False
+            try:
+                # if response is None, then we're still in progress,
+                # otherwise...
+                if rsp is not None:
+                    close_handle = True
+                    state = 'new'
+                    if isinstance(rsp, omero.cmd.ERR):
+                        rsp_params = ", ".join(
+                            ["%s: %s" % (k, v) for k, v in
+                             rsp.parameters.items()])
+                        logger.error("chgrp failed with: %s"
+                                     % rsp_params)
+                        updates.update(
+                            status="failed",
+                            report="%s %s" % (rsp.name, rsp_params),
+                            error=1)
+                    elif isinstance(rsp, omero.cmd.OK):
+                        updates.update(
+                            status="finished")
+                else:
+                    state = 'in progress'
+            finally:
+                prx.close(close_handle)
+        except Exception:
+            logger.info(
+                "Activities chgrp handle not found: %s" % cbString)
+            return state, updates
+    elif job_type == 'send_email':
+        rsp = None
+        try:
+            prx = omero.cmd.HandlePrx.checkedCast(
+                conn.c.ic.stringToProxy(cbString))
+            callback = omero.callbacks.CmdCallbackI(
+                conn.c, prx, foreground_poll=True)
+            rsp = callback.getResponse()
+            close_handle = False
+            try:
+                # if response is None, then we're still in progress,
+                # otherwise...
+                if rsp is not None:
+                    close_handle = True
+                    state = 'new'
+
+                    if isinstance(rsp, omero.cmd.ERR):
+                        rsp_params = ", ".join(
+                            ["%s: %s" % (k, v)
+                             for k, v in rsp.parameters.items()])
+                        logger.error("send_email failed with: %s"
+                                     % rsp_params)
+                        updates.update(
+                            status="failed",
+                            report={'error': rsp_params},
+                            error=1)
+                    else:
+                        total = (rsp.success + len(rsp.invalidusers) +
+                                 len(rsp.invalidemails))
+                        updates.update(
+                            status="finished",
+                            rsp={'success': rsp.success,
+                                 'total': total})
+                        if (len(rsp.invalidusers) > 0 or
+                                len(rsp.invalidemails) > 0):
+                            invalidusers = [
+                                e.getFullName() for e in list(
+                                    conn.getObjects(
+                                        "Experimenter",
+                                        rsp.invalidusers))]
+                            updates.update(
+                                report={
+                                    'invalidusers': invalidusers,
+                                    'invalidemails': rsp.invalidemails
+                                })
+                else:
+                    state = 'in progress'
+            finally:
+                callback.close(close_handle)
+        except Exception:
+            logger.error(traceback.format_exc())
+            logger.info("Activities send_email handle not found: %s"
+                        % cbString)
+
+    # update delete
+    elif job_type == 'delete':
+        try:
+            handle = omero.cmd.HandlePrx.checkedCast(
+                conn.c.ic.stringToProxy(cbString))
+            cb = omero.callbacks.CmdCallbackI(
+                conn.c, handle, foreground_poll=True)
+            rsp = cb.getResponse()
+            close_handle = False
+            try:
+                if not rsp:  # Response not available
+                    updates.update(
+                        error=0,
+                        status="in progress",
+                        dreport=_formatReport(handle))
+                    state = 'in progress'
+                else:  # Response available
+                    close_handle = True
+                    state = 'new'
+                    rsp = cb.getResponse()
+                    err = isinstance(rsp, omero.cmd.ERR)
+                    if err:
+                        updates.update(
+                            error=1,
+                            status="failed",
+                            dreport=_formatReport(handle))
+                    else:
+                        updates.update(
+                            error=0,
+                            status="finished",
+                            dreport=_formatReport(handle))
+            finally:
+                cb.close(close_handle)
+        except Ice.ObjectNotExistException:
+            updates.update(
+                error=0,
+                status="finished",
+                dreport=None)
+        except Exception as x:
+            logger.error(traceback.format_exc())
+            logger.error("Status job '%s'error:" % cbString)
+            updates.update(
+                error=1,
+                status="failed",
+                dreport=str(x))
+
+    # update jobs running in the background of a web worker
+    elif job_type == 'rdef':
+        job = background_jobs.status(cbString)
+        if job is None:
+            # the job may run in another web worker
+            age = datetime.datetime.now() - \
+                callbackDict['start_time']
+            if age.total_seconds() > JOB_STATUS_TIME:
+                job = {'status': 'failed',
+                       'error': 'Job status not found'}
+        if job is None or job['status'] == 'in progress':
+            state = 'in progress'
+            return state, updates
+        state = 'new'
+        background_jobs.forget(cbString)
+        if job['status'] == 'failed':
+            updates.update(status="failed",
+                           error=1,
+                           report=job.get('error'))
+        else:
+            result = job.get('result') or {}
+            updates.update(status="finished",
+                           updated=result.get('true', []),
+                           not_updated=result.get('false', []))
+
+    # update scripts
+    elif job_type == 'script':
+        # if error on runScript, the cbString is not a ProcessCallback...
+        if not cbString.startswith('ProcessCallback'):
+            return state, updates
+        logger.info("Check callback on script: %s" % cbString)
+        try:
+            proc = omero.grid.ScriptProcessPrx.checkedCast(
+                conn.c.ic.stringToProxy(cbString))
+        except IceException:
+            updates.update(status="failed",
+                           Message="No process found for job",
+                           error=1)
+            return state, updates
+        cb = omero.scripts.ProcessCallbackI(conn.c, proc)
+        # check if we get something back from the handle...
+        if cb.block(0):  # ms.
+            cb.close()
+            try:
+                # we can only retrieve this ONCE - must save results
+                results = proc.getResults(0, conn.SERVICE_OPTS)
+                updates.update(status="finished")
+                state = 'new'
+            except Exception:
+                updates.update(status="finished",
+                               Message="Failed to get results")
+                logger.info(
+                    "Failed on proc.getResults() for OMERO.script")
+                return state, updates
+            # value could be rstring, rlong, robject
+            rMap = {}
+            for key, value in results.items():
+                v = value.getValue()
+                if key in ("stdout", "stderr", "Message"):
+                    if key in ('stderr', 'stdout'):
+                        # just save the id of original file
+                        v = v.id.val
+                    update_kwargs = {key: v}
+                    updates.update(**update_kwargs)
+                else:
+                    if hasattr(v, "id"):
+                        # do we have an object (ImageI,
+                        # FileAnnotationI etc)
+                        obj_data = {
+                            'id': v.id.val,
+                            'type': v.__class__.__name__[:-1]}
+                        obj_data['browse_url'] = getObjectUrl(conn, v)
+                        if v.isLoaded() and hasattr(v, "file"):
+                            # try:
+                            mimetypes = {
+                                'image/png': 'png',
+                                'image/jpeg': 'jpeg',
+                                'text/plain': 'text'}
+                            if v.file.mimetype.val in mimetypes:
+                                obj_data['fileType'] = mimetypes[
+                                    v.file.mimetype.val]
+                                obj_data['fileId'] = v.file.id.val
+                            obj_data['name'] = v.file.name.val
+                            # except Exception:
+                            #    pass
+                        if v.isLoaded() and hasattr(v, "name"):
+                            # E.g Image, OriginalFile etc
+                            name = unwrap(v.name)
+                            if name is not None:
+                                # E.g. FileAnnotation has null name
+                                obj_data['name'] = name
+                        rMap[key] = obj_data
+                    else:
+                        rMap[key] = unwrap(v)
+            updates.update(results=rMap)
+        else:
+            state = 'in progress'
+    return state, updates
+
+
+def _poll_callbacks(conn, callbacks):
+    """
+    Checks the handles of all unfinished jobs concurrently, see
+    _poll_callback(). Each handle is checked at most once every
+    omero.web.activities.poll_interval seconds by this web worker, e.g. when
+    several browser tabs poll, the last result is reused.
+    Returns a dict of handle to (state, updates).
+    """
+    now = time()
+    rv = {}
+    queries = {}
+    with _callback_polls_lock:
+        for cbString, (checked, result) in list(_callback_polls.items()):
+            if checked < now - settings.ACTIVITIES_POLL_INTERVAL:
+                del _callback_polls[cbString]
+        for cbString, callbackDict in callbacks.items():
+            if callbackDict['status'] in ("failed", "finished"):
+                continue
+            if cbString in _callback_polls:
+                rv[cbString] = _callback_polls[cbString][1]
+            else:
+                queries[cbString] = (_poll_callback, {
+                    'conn': conn,
+                    'cbString': cbString,
+                    'callbackDict': callbackDict})
+    results = tree.run_queries(conn, queries)
+    with _callback_polls_lock:
+        for cbString, result in results.items():
+            _callback_polls[cbString] = (now, result)
+    rv.update(results)
+    return rv
+
+
+def _update_callbacks(request, conn):
+    """
+    Updates the jobs in request.session['callback'] with their current
+    status. The session is only modified if any job changed.
+    Returns a tuple of (number of jobs in progress, list of handles of
+    jobs that have just completed, number of failed jobs).
+    """
+    in_progress = 0
+    new_results = []
+    callbacks = request.session.get('callback')
+    for cbString, (state, updates) in _poll_callbacks(
+            conn, callbacks).items():
+        if state == 'in progress':
+            in_progress += 1
+        elif state == 'new':
+            new_results.append(cbString)
+        callbackDict = callbacks[cbString]
+        updates = dict((k, v) for k, v in updates.items()
+                       if callbackDict.get(k) != v)
+        if updates:
+            update_callback(request, cbString, last_update=time(), **updates)
+            request.session.modified = True
+    failure = len([cb for cb in callbacks.values()
+                   if cb['status'] == "failed"])
+    return in_progress, new_results, failure
+
+
+def _callback_json(callbackDict):
+    """ Returns a json compatible copy of a job in the session """
+    rv = copy.copy(callbackDict)
+    rv['start_time'] = str(callbackDict['start_time'])
+    return rv
+
+
 @login_required()
 @render_response()
 def activities(request, conn=None, **kwargs):
@@ -3308,9 +3711,6 @@ def activities(request, conn=None, **kwargs):
     bar.
     """
 
-    in_progress = 0
-    failure = 0
-    new_results = []
     _purgeCallback(request)
 
     # If we have a jobId (not added to request.session) just process it...
@@ -3332,239 +3732,7 @@ def activities(request, conn=None, **kwargs):
         return rv
 
     # test each callback for failure, errors, completion, results etc
-    for cbString in request.session.get('callback').keys():
-        callbackDict = request.session['callback'][cbString]
-        job_type = callbackDict['job_type']
-
-        status = callbackDict['status']
-        if status == "failed":
-            failure += 1
-
-        request.session.modified = True
-
-        # update chgrp
-        if job_type == 'chgrp':
-            if status not in ("failed", "finished"):
-                rsp = None
-                try:
-                    prx = omero.cmd.HandlePrx.checkedCast(
-                        conn.c.ic.stringToProxy(cbString))
-                    rsp = prx.getResponse()
-                    close_handle = False
-                    try:
-                        # if response is None, then we're still in progress,
-                        # otherwise...
-                        if rsp is not None:
-                            close_handle = True
-                            new_results.append(cbString)
-                            if isinstance(rsp, omero.cmd.ERR):
-                                rsp_params = ", ".join(
-                                    ["%s: %s" % (k, v) for k, v in
-                                     rsp.parameters.items()])
-                                logger.error("chgrp failed with: %s"
-                                             % rsp_params)
-                                update_callback(
-                                    request, cbString,
-                                    status="failed",
-                                    report="%s %s" % (rsp.name, rsp_params),
-                                    error=1)
-                            elif isinstance(rsp, omero.cmd.OK):
-                                update_callback(
-                                    request, cbString,
-                                    status="finished")
-                        else:
-                            in_progress += 1
-                    finally:
-                        prx.close(close_handle)
-                except Exception:
-                    logger.info(
-                        "Activities chgrp handle not found: %s" % cbString)
-                    continue
-        elif job_type == 'send_email':
-            if status not in ("failed", "finished"):
-                rsp = None
-                try:
-                    prx = omero.cmd.HandlePrx.checkedCast(
-                        conn.c.ic.stringToProxy(cbString))
-                    callback = omero.callbacks.CmdCallbackI(
-                        conn.c, prx, foreground_poll=True)
-                    rsp = callback.getResponse()
-                    close_handle = False
-                    try:
-                        # if response is None, then we're still in progress,
-                        # otherwise...
-                        if rsp is not None:
-                            close_handle = True
-                            new_results.append(cbString)
-
-                            if isinstance(rsp, omero.cmd.ERR):
-                                rsp_params = ", ".join(
-                                    ["%s: %s" % (k, v)
-                                     for k, v in rsp.parameters.items()])
-                                logger.error("send_email failed with: %s"
-                                             % rsp_params)
-                                update_callback(
-                                    request, cbString,
-                                    status="failed",
-                                    report={'error': rsp_params},
-                                    error=1)
-                            else:
-                                total = (rsp.success + len(rsp.invalidusers) +
-                                         len(rsp.invalidemails))
-                                update_callback(
-                                    request, cbString,
-                                    status="finished",
-                                    rsp={'success': rsp.success,
-                                         'total': total})
-                                if (len(rsp.invalidusers) > 0 or
-                                        len(rsp.invalidemails) > 0):
-                                    invalidusers = [
-                                        e.getFullName() for e in list(
-                                            conn.getObjects(
-                                                "Experimenter",
-                                                rsp.invalidusers))]
-                                    update_callback(
-                                        request, cbString,
-                                        report={
-                                            'invalidusers': invalidusers,
-                                            'invalidemails': rsp.invalidemails
-                                        })
-                        else:
-                            in_progress += 1
-                    finally:
-                        callback.close(close_handle)
-                except Exception:
-                    logger.error(traceback.format_exc())
-                    logger.info("Activities send_email handle not found: %s"
-                                % cbString)
-
-        # update delete
-        elif job_type == 'delete':
-            if status not in ("failed", "finished"):
-                try:
-                    handle = omero.cmd.HandlePrx.checkedCast(
-                        conn.c.ic.stringToProxy(cbString))
-                    cb = omero.callbacks.CmdCallbackI(
-                        conn.c, handle, foreground_poll=True)
-                    rsp = cb.getResponse()
-                    close_handle = False
-                    try:
-                        if not rsp:  # Response not available
-                            update_callback(
-                                request, cbString,
-                                error=0,
-                                status="in progress",
-                                dreport=_formatReport(handle))
-                            in_progress += 1
-                        else:  # Response available
-                            close_handle = True
-                            new_results.append(cbString)
-                            rsp = cb.getResponse()
-                            err = isinstance(rsp, omero.cmd.ERR)
-                            if err:
-                                update_callback(
-                                    request, cbString,
-                                    error=1,
-                                    status="failed",
-                                    dreport=_formatReport(handle))
-                                failure += 1
-                            else:
-                                update_callback(
-                                    request, cbString,
-                                    error=0,
-                                    status="finished",
-                                    dreport=_formatReport(handle))
-                    finally:
-                        cb.close(close_handle)
-                except Ice.ObjectNotExistException:
-                    update_callback(
-                        request, cbString,
-                        error=0,
-                        status="finished",
-                        dreport=None)
-                except Exception as x:
-                    logger.error(traceback.format_exc())
-                    logger.error("Status job '%s'error:" % cbString)
-                    update_callback(
-                        request, cbString,
-                        error=1,
-                        status="failed",
-                        dreport=str(x))
-                    failure += 1
-
-        # update scripts
-        elif job_type == 'script':
-            # if error on runScript, the cbString is not a ProcessCallback...
-            if not cbString.startswith('ProcessCallback'):
-                continue  # ignore
-            if status not in ("failed", "finished"):
-                logger.info("Check callback on script: %s" % cbString)
-                try:
-                    proc = omero.grid.ScriptProcessPrx.checkedCast(
-                        conn.c.ic.stringToProxy(cbString))
-                except IceException:
-                    update_callback(request, cbString, status="failed",
-                                    Message="No process found for job",
-                                    error=1)
-                    continue
-                cb = omero.scripts.ProcessCallbackI(conn.c, proc)
-                # check if we get something back from the handle...
-                if cb.block(0):  # ms.
-                    cb.close()
-                    try:
-                        # we can only retrieve this ONCE - must save results
-                        results = proc.getResults(0, conn.SERVICE_OPTS)
-                        update_callback(request, cbString, status="finished")
-                        new_results.append(cbString)
-                    except Exception:
-                        update_callback(request, cbString, status="finished",
-                                        Message="Failed to get results")
-                        logger.info(
-                            "Failed on proc.getResults() for OMERO.script")
-                        continue
-                    # value could be rstring, rlong, robject
-                    rMap = {}
-                    for key, value in results.items():
-                        v = value.getValue()
-                        if key in ("stdout", "stderr", "Message"):
-                            if key in ('stderr', 'stdout'):
-                                # just save the id of original file
-                                v = v.id.val
-                            update_kwargs = {key: v}
-                            update_callback(request, cbString, **update_kwargs)
-                        else:
-                            if hasattr(v, "id"):
-                                # do we have an object (ImageI,
-                                # FileAnnotationI etc)
-                                obj_data = {
-                                    'id': v.id.val,
-                                    'type': v.__class__.__name__[:-1]}
-                                obj_data['browse_url'] = getObjectUrl(conn, v)
-                                if v.isLoaded() and hasattr(v, "file"):
-                                    # try:
-                                    mimetypes = {
-                                        'image/png': 'png',
-                                        'image/jpeg': 'jpeg',
-                                        'text/plain': 'text'}
-                                    if v.file.mimetype.val in mimetypes:
-                                        obj_data['fileType'] = mimetypes[
-                                            v.file.mimetype.val]
-                                        obj_data['fileId'] = v.file.id.val
-                                    obj_data['name'] = v.file.name.val
-                                    # except Exception:
-                                    #    pass
-                                if v.isLoaded() and hasattr(v, "name"):
-                                    # E.g Image, OriginalFile etc
-                                    name = unwrap(v.name)
-                                    if name is not None:
-                                        # E.g. FileAnnotation has null name
-                                        obj_data['name'] = name
-                                rMap[key] = obj_data
-                            else:
-                                rMap[key] = unwrap(v)
-                    update_callback(request, cbString, results=rMap)
-                else:
-                    in_progress += 1
+    in_progress, new_results, failure = _update_callbacks(request, conn)
 
     # having updated the request.session, we can now prepare the data for http
     # response
@@ -3577,8 +3745,8 @@ def activities(request, conn=None, **kwargs):
     # return json (used for testing)
     if 'template' in kwargs and kwargs['template'] == 'json':
         for cbString in request.session.get('callback').keys():
-            rv[cbString]['start_time'] = str(
-                request.session['callback'][cbString]['start_time'])
+            rv[cbString] = _callback_json(
+                request.session['callback'][cbString])
         rv['inprogress'] = in_progress
         rv['failure'] = failure
         rv['jobs'] = len(request.session['callback'])
@@ -3615,6 +3783,63 @@ def activities(request, conn=None, **kwargs):
     return context
 
 
+@login_required()
+def activities_poll(request, conn=None, **kwargs):
+    """
+    Long-poll for the Activities panel. Waits up to 'wait' seconds (at most
+    omero.web.activities.long_poll_timeout) until any job changes and
+    returns json with only the jobs that changed since 'since', which is
+    the 'time' of the previous response. Only gevent workers wait, sync
+    workers return at once.
+    """
+    try:
+        since = float(request.GET.get('since', 0))
+        wait = min(float(request.GET.get('wait', 0)),
+                   settings.ACTIVITIES_LONG_POLL_TIMEOUT)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid parameter value')
+
+    # Sync workers can't wait without holding a worker for the request
+    if settings.WSGI_WORKER_CLASS != 'gevent':
+        wait = 0
+
+    _purgeCallback(request)
+    return JsonResponse(_poll_changes(request, conn, since, wait))
+
+
+def _poll_changes(request, conn, since, wait):
+    """
+    Updates the jobs in request.session['callback'] until any job changed
+    since 'since' or for 'wait' seconds at most, see activities_poll().
+    Returns a json compatible dict with only the jobs that changed.
+    """
+    callbacks = request.session.get('callback', {})
+
+    def last_update(callbackDict):
+        return callbackDict.get('last_update') or mktime(
+            callbackDict['start_time'].timetuple())
+
+    deadline = time() + wait
+    while True:
+        in_progress, new_results, failure = _update_callbacks(request, conn)
+        # after the update, which stamps 'last_update' on changed jobs
+        checked = time()
+        changed = [cbString for cbString, callbackDict in callbacks.items()
+                   if last_update(callbackDict) > since]
+        if changed or in_progress == 0 or checked >= deadline:
+            break
+        sleep(min(settings.ACTIVITIES_POLL_INTERVAL, deadline - checked))
+
+    return {
+        'time': checked,
+        'changed': dict((cbString, _callback_json(callbacks[cbString]))
+                        for cbString in changed),
+        'new_results': new_results,
+        'inprogress': in_progress,
+        'failure': failure,
+        'jobs': len(callbacks)}
+
+
 @login_required()
 def activities_update(request, action, **kwargs):
     """
@@ -53,6 +53,8 @@ from django.utils.encoding import smart_str
 from django.conf import settings
 
 from omero.gateway.utils import toBoolean
+from omeroweb.access_log import get_request_stats
+from omeroweb.webgateway.webgateway_cache import count_cache
 from omeroweb.webgateway.templatetags.common_filters import (
     lengthunit,
     lengthformat,
@@ -506,7 +508,55 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
 
         return tags, owners
 
+    def getTagIndexVersion(self, eid=None):
+        """
+        Returns a tuple that changes whenever the tags returned by
+        L{listTagsRecursive} change: the most recent update event and the
+        count of the Tags, and the most recent ID and the count of the
+        links between Tag sets and Tags.
+        """
+        params = omero.sys.ParametersI()
+        params.map = {}
+        params.map['ns'] = rstring(omero.constants.metadata.NSINSIGHTTAGSET)
+        owner_clause = ""
+        if eid is not None:
+            params.map["eid"] = rlong(int(eid))
+            owner_clause = " where ann.details.owner.id = :eid"
+
+        q = self.getQueryService()
+        sql = """
+            select max(ann.details.updateEvent.id), count(ann.id)
+            from TagAnnotation ann
+            """ + owner_clause
+        tags = q.projection(sql, params, self.SERVICE_OPTS)[0]
+        sql = """
+            select max(aal.id), count(aal.id)
+            from AnnotationAnnotationLink aal
+            inner join aal.parent ann
+            where ann.ns=:ns
+            """
+        if eid is not None:
+            sql += " and ann.details.owner.id = :eid"
+        links = q.projection(sql, params, self.SERVICE_OPTS)[0]
+        return tuple(unwrap(v) for v in tags + links)
+
+    def _countKey(self, eid, *container):
+        """
+        Key of a count in the count cache, for the current user and group.
+
+        @param eid:         Owner ID or None
+        @param container:   What is counted, e.g. ('orphans', 'Image')
+        @return:            Tuple
+        """
+        return (self.getUserId(), self.SERVICE_OPTS.getOmeroGroup(),
+                None if eid is None else int(eid)) + container
+
     def getTagCount(self, eid=None):
+        key = self._countKey(eid, 'TagAnnotation')
+        count = count_cache.get(key)
+        if count is not None:
+            return count
+
         params = omero.sys.ParametersI()
         params.orphan()
         params.map = {}
@@ -522,7 +572,9 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
             params.map["eid"] = rlong(int(eid))
             sql += " where ann.details.owner.id = :eid"
 
-        return unwrap(q.projection(sql, params, self.SERVICE_OPTS)[0][0])
+        count = unwrap(q.projection(sql, params, self.SERVICE_OPTS)[0][0])
+        count_cache.set(key, count)
+        return count
 
     def countOrphans(self, obj_type, eid=None):
         links = {'Dataset': ('ProjectDatasetLink', DatasetWrapper),
@@ -534,18 +586,10 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
                 "'%s' is not valid object type. Must use one of %s"
                 % (obj_type, links.keys()))
 
-        q = self.getQueryService()
-        p = omero.sys.Parameters()
-        p.map = {}
-
-        links = {'Dataset': ('ProjectDatasetLink', DatasetWrapper),
-                 'Image': ('DatasetImageLink', ImageWrapper),
-                 'Plate': ('ScreenPlateLink', PlateWrapper)}
-
-        if obj_type not in links:
-            raise TypeError(
-                "'%s' is not valid object type. Must use one of %s"
-                % (obj_type, links.keys()))
+        key = self._countKey(eid, 'orphans', obj_type)
+        count = count_cache.get(key)
+        if count is not None:
+            return count
 
         q = self.getQueryService()
         p = omero.sys.Parameters()
@@ -571,11 +615,13 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
                     "select ws from WellSample as ws "
                     "where ws.image=obj.id %s)" % eidWsFilter)
 
+        count = 0
         rslt = q.projection(sql, p, self.SERVICE_OPTS)
         if len(rslt) > 0:
             if len(rslt[0]) > 0:
-                return rslt[0][0].val
-        return 0
+                count = rslt[0][0].val
+        count_cache.set(key, count)
+        return count
 
     def listImagesInDataset(self, oid, eid=None, page=None,
                             load_pixels=False):
@@ -1012,9 +1058,19 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
         @return             A map from id integer to count integer
         @rtype              L{(Long, Long)}
         """
-        container = self.getContainerService()
-        return container.getCollectionCount(
-            parent, child, ids, None, self.SERVICE_OPTS)
+        keys = dict((i, self._countKey(None, parent, child, i)) for i in ids)
+        cached = count_cache.get_many(list(keys.values()))
+        counts = dict((i, cached[key]) for i, key in keys.items()
+                      if key in cached)
+        missing = [i for i in ids if i not in counts]
+        if missing:
+            container = self.getContainerService()
+            loaded = container.getCollectionCount(
+                parent, child, missing, None, self.SERVICE_OPTS)
+            count_cache.set_many(dict((keys[i], c) for i, c in loaded.items()
+                                      if i in keys))
+            counts.update(loaded)
+        return counts
 
     ################################################
     #   Validators
@@ -2011,29 +2067,29 @@ class OmeroWebGateway(omero.gateway.BlitzGateway):
         @return:            Counter
         @rtype:             Long
         """
-        tm = self.getTimelineService()
-        p = omero.sys.Parameters()
-        p.map = {}
-        f = omero.sys.Filter()
-        f.ownerId = rlong(eid)
-        # f.groupId = rlong(self.getEventContext().groupId)
-        p.theFilter = f
+        # All types are counted at once, so that the counts of each type
+        # and the total come from the same cached call
+        key = self._countKey(eid, 'period', int(start), int(end))
+        c = count_cache.get(key)
+        if c is None:
+            tm = self.getTimelineService()
+            p = omero.sys.Parameters()
+            p.map = {}
+            f = omero.sys.Filter()
+            f.ownerId = rlong(eid)
+            # f.groupId = rlong(self.getEventContext().groupId)
+            p.theFilter = f
+            c = tm.countByPeriod(
+                ['Image', 'Dataset', 'Project'], rtime(int(start)),
+                rtime(int(end)), p, self.SERVICE_OPTS)
+            count_cache.set(key, c)
         if otype == 'image':
-            return tm.countByPeriod(
-                ['Image'], rtime(int(start)), rtime(int(end)), p,
-                self.SERVICE_OPTS)['Image']
+            return c['Image']
         elif otype == 'dataset':
-            return tm.countByPeriod(
-                ['Dataset'], rtime(int(start)), rtime(int(end)), p,
-                self.SERVICE_OPTS)['Dataset']
+            return c['Dataset']
         elif otype == 'project':
-            return tm.countByPeriod(
-                ['Project'], rtime(int(start)), rtime(int(end)), p,
-                self.SERVICE_OPTS)['Project']
+            return c['Project']
         else:
-            c = tm.countByPeriod(
-                ['Image', 'Dataset', 'Project'], rtime(int(start)),
-                rtime(int(end)), p, self.SERVICE_OPTS)
             return c['Image']+c['Dataset']+c['Project']
 
     def getEventsByPeriod(self, start, end, eid):
@@ -2113,8 +2169,21 @@ class OmeroWebSafeCallWrapper(OmeroGatewaySafeCallWrapper):  # pragma: no cover
     """
     Function or method wrapper that handles L{Ice.ObjectNotExistException}
     by re-creating the server side proxy.
+    Calls are timed for requests sampled by the access log.
     """
 
+    def __call__(self, *args, **kwargs):
+        stats = get_request_stats()
+        if stats is None:
+            return super(OmeroWebSafeCallWrapper, self).__call__(
+                *args, **kwargs)
+        start = time.time()
+        try:
+            return super(OmeroWebSafeCallWrapper, self).__call__(
+                *args, **kwargs)
+        finally:
+            stats.ice_call(self.attr, time.time() - start)
+
     def handle_exception(self, e, *args, **kwargs):
         if e.__class__ is Ice.ObjectNotExistException:
             # Restored proxy object re-creation logic from the pre-#5835
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+   Module to run long operations in the background of a web worker and to
+   report their status, e.g. in the webclient 'Activities' panel.
+"""
+
+import logging
+import threading
+import traceback
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: nocover
+    ThreadPoolExecutor = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds that the status of a job is kept after it was submitted
+JOB_STATUS_TIME = 3600 * 12  # 12 hours
+
+
+class BackgroundJobs(object):
+    """
+    Runs functions on a thread pool of this process. The status of each
+    job is kept in memory and also stored in the Django cache, so that
+    other web workers can report it if the cache is shared between them.
+    """
+
+    def __init__(self, max_workers):
+        """
+        @param max_workers:     Number of jobs that can run at once
+        """
+        self._max_workers = max_workers
+        self._pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=max(self._max_workers, 1))
+        return self._pool
+
+    def _cache_key(self, job_id):
+        return 'omero.web.job.%s' % job_id
+
+    def _set_status(self, job_id, **kwargs):
+        with self._lock:
+            status = self._jobs.setdefault(job_id, {})
+            status.update(kwargs)
+            status = dict(status)
+        cache.set(self._cache_key(job_id), status, JOB_STATUS_TIME)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) in the background.
+        If threads are not available the function is run at once.
+
+        @param func:            Function to call
+        @return:                Job ID, e.g. 'WebJob/<uuid>'
+        """
+        job_id = 'WebJob/%s' % uuid.uuid4()
+        self._set_status(job_id, status='in progress')
+
+        def run():
+            try:
+                rv = func(*args, **kwargs)
+                self._set_status(job_id, status='finished', result=rv)
+            except Exception as x:
+                logger.error(traceback.format_exc())
+                self._set_status(job_id, status='failed', error=str(x))
+
+        if ThreadPoolExecutor is None:
+            run()
+        else:
+            self._get_pool().submit(run)
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the status of a job as a dict with 'status' of
+        'in progress', 'finished' or 'failed' and the 'result' or 'error'
+        of the job, or None if the job is not known.
+
+        @param job_id:          Job ID returned by L{submit}
+        @return:                Dict or None
+        """
+        with self._lock:
+            status = self._jobs.get(job_id)
+            if status is not None:
+                return dict(status)
+        return cache.get(self._cache_key(job_id))
+
+    def forget(self, job_id):
+        """
+        Removes a finished job from memory.
+
+        @param job_id:          Job ID returned by L{submit}
+        """
+        with self._lock:
+            status = self._jobs.get(job_id)
+            if status is not None and status['status'] != 'in progress':
+                del self._jobs[job_id]
+
+
+background_jobs = BackgroundJobs(
+    getattr(settings, 'BACKGROUND_JOB_THREADS', 2))
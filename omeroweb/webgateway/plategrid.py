@@ -13,14 +13,26 @@
 import logging
 
 import omero.sys
-from omero.rtypes import rint
+from io import BytesIO
+from omero.rtypes import rint, rlong, unwrap
 try:
     import long
 except ImportError:
     long = int
 
+try:
+    from PIL import Image
+except ImportError:  # pragma: nocover
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
 logger = logging.getLogger(__name__)
 
+# Maximum number of thumbnails loaded at once for the plate atlas
+ATLAS_THUMBNAIL_BATCH = 100
+
 
 class PlateGrid(object):
     """
@@ -88,3 +100,71 @@ class PlateGrid(object):
                               'collabels': self.plate.getColumnLabels(),
                               'rowlabels': self.plate.getRowLabels()}
         return self._metadata
+
+    @property
+    def version(self):
+        """
+        Returns a string that changes whenever an image, rendering setting or
+        thumbnail of the plate is updated, to use in cache keys.
+        """
+        params = omero.sys.ParametersI()
+        params.addId(self.plate.id)
+        # Separate subqueries, since joining the rendering settings and
+        # thumbnails of all users would multiply the rows for each image
+        images = "select ws.image.id from WellSample ws "\
+                 "where ws.well.plate.id = :id"
+        query = "select (select max(img.details.updateEvent.id) "\
+                "from Image img where img.id in (%s)), "\
+                "(select max(rdef.details.updateEvent.id) "\
+                "from RenderingDef rdef where rdef.pixels.image.id in (%s)), "\
+                "(select max(tb.details.updateEvent.id) "\
+                "from Thumbnail tb where tb.pixels.image.id in (%s)) "\
+                "from Plate plate where plate.id = :id" % (
+                    images, images, images)
+        rows = self._conn.getQueryService().projection(
+            query, params, self._conn.SERVICE_OPTS)
+        return '-'.join([str(v) for v in unwrap(rows[0])]) if rows else ''
+
+    def atlas(self, size=96):
+        """
+        Returns a JPEG of the thumbnails of all the wells for the field,
+        tiled by row and column in cells of size x size pixels, in the same
+        layout as the 'grid' of L{metadata}. The thumbnails are loaded in
+        batches with getThumbnailSet.
+        Returns None if PIL is not available.
+
+        @param size:    Longest side of each thumbnail
+        @return:        JPEG data
+        """
+        if Image is None:
+            logger.error('PIL is required to create the plate atlas')
+            return None
+        grid = self.metadata['grid']
+        cells = dict(((r, c), well['id'])
+                     for r, row in enumerate(grid)
+                     for c, well in enumerate(row) if well is not None)
+        image_ids = sorted(set(cells.values()))
+        thumbs = {}
+        for i in range(0, len(image_ids), ATLAS_THUMBNAIL_BATCH):
+            thumbs.update(self._conn.getThumbnailSet(
+                [rlong(iid) for iid in
+                 image_ids[i:i + ATLAS_THUMBNAIL_BATCH]], size))
+
+        columns = len(grid[0]) if grid else 0
+        atlas = Image.new('RGB', (columns * size, len(grid) * size),
+                          (255, 255, 255))
+        for (r, c), iid in cells.items():
+            jpeg = thumbs.get(iid)
+            if not jpeg:
+                continue
+            try:
+                thumb = Image.open(BytesIO(jpeg))
+            except IOError:
+                logger.debug('Invalid thumbnail for image %s' % iid)
+                continue
+            # centre the thumbnail in its cell
+            atlas.paste(thumb, (c * size + (size - thumb.size[0]) // 2,
+                                r * size + (size - thumb.size[1]) // 2))
+        rv = BytesIO()
+        atlas.save(rv, 'jpeg', quality=90)
+        return rv.getvalue()
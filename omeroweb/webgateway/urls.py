@@ -274,6 +274,18 @@ webgateway_plategrid_json = url(
 """
 """
 
+webgateway_plate_atlas = url(
+    r'^plate_atlas/(?P<pid>[0-9]+)/(?:(?P<field>[0-9]+)/)?$',
+    views.plate_atlas, name="webgateway_plate_atlas")
+"""
+Returns a single jpeg of the thumbnails of all the wells of a Plate for a
+field, tiled in the layout of the grid returned by webgateway_plategrid_json.
+    - webgateway/plate_atlas/<pid>/<field>/?size=96 params are:
+    - pid:      Plate ID
+    - field:    Field index, 0 by default
+    - size:     Size of each square cell in pixels
+"""
+
 
 webgateway_get_thumbnails_json = url(
     r'^get_thumbnails/(?:(?P<w>[0-9]+)/)?$',
@@ -496,6 +508,7 @@ urlpatterns = [
     webgateway_listimages_json,
     webgateway_listwellimages_json,
     webgateway_plategrid_json,
+    webgateway_plate_atlas,
     imageData_json,
     wellData_json,
     webgateway_search_json,
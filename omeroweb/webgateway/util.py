@@ -18,6 +18,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import hashlib
 import tempfile
 import zipfile
 import shutil
@@ -29,6 +31,8 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 LUTS_IN_PNG = [
     '/luts/ncsa_paledit/16_colors.lut',
     '/luts/3-3-2_rgb.lut',
@@ -238,3 +242,82 @@ def points_string_to_XY_list(string):
         x, y = xy.split(",")
         xyList.append((float(x.strip()), float(y.strip())))
     return xyList
+
+
+def parse_byte_range(header, size):
+    """
+    Parses an HTTP Range header for a file of the given size.
+    Only a single range is supported: None is returned for a missing,
+    malformed or multi-part range so that the whole file is served.
+
+    @param header:      Value of the Range header, e.g. 'bytes=0-499'
+    @param size:        Size of the file in bytes
+    @return:            Tuple of (first, last) byte positions, inclusive
+    @raise ValueError:  If the range cannot be satisfied (416)
+    """
+    if not header:
+        return None
+    m = BYTE_RANGE_RE.match(header.strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Range not satisfiable: %s" % header)
+        return (max(size - length, 0), size - 1)
+    first = int(first)
+    if last != '' and int(last) < first:
+        # e.g. bytes=500-100 is invalid and ignored
+        return None
+    if first >= size:
+        raise ValueError("Range not satisfiable: %s" % header)
+    last = size - 1 if last == '' else min(int(last), size - 1)
+    return (first, last)
+
+
+def original_file_etag(orig_file):
+    """
+    Returns a strong ETag for an OriginalFile, based on its checksum
+    and size. If the file has no checksum, the ID, size and modification
+    time are used instead.
+
+    @param orig_file:   L{omero.gateway.OriginalFileWrapper}
+    @return:            Quoted ETag string
+    """
+    obj = orig_file._obj
+    size = obj.size.val if obj.size is not None else ''
+    if obj.hash is not None and obj.hash.val:
+        return '"%s-%s"' % (obj.hash.val, size)
+    mtime = obj.mtime.val if obj.mtime is not None else ''
+    key = '%s-%s-%s' % (orig_file.getId(), size, mtime)
+    return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def get_file_range_in_chunks(orig_file, first, last, buf=2621440):
+    """
+    Returns a generator yielding chunks of the file data from the
+    byte position first up to and including last, read through a
+    RawFileStore from that offset.
+
+    @param orig_file:   L{omero.gateway.OriginalFileWrapper}
+    @param first:       First byte position
+    @param last:        Last byte position, inclusive
+    @param buf:         Chunk size
+    """
+    conn = orig_file._conn
+    # Can't use BlitzGateway.createRawFileStore as it always returns the
+    # same store
+    rfs = conn.c.sf.createRawFileStore()
+    try:
+        rfs.setFileId(orig_file.getId(), conn.SERVICE_OPTS)
+        pos = first
+        while pos <= last:
+            nread = min(buf, last - pos + 1)
+            yield rfs.read(pos, nread)
+            pos += nread
+    finally:
+        rfs.close()
@@ -30,6 +30,7 @@ from django.views.decorators.debug import sensitive_post_parameters
 from django.utils.decorators import method_decorator
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.conf import settings
+from django.core.cache import cache as django_cache
 from wsgiref.util import FileWrapper
 from omero.rtypes import rlong, unwrap
 from omero.constants.namespaces import NSBULKANNOTATIONS
@@ -72,6 +73,7 @@ import glob
 from omeroweb.webgateway.webgateway_cache import (
     webgateway_cache,
     CacheBase,
+    thumbnail_version_cache,
     webgateway_tempfile,
 )
 
@@ -79,6 +81,7 @@ import logging
 import os
 import traceback
 import time
+import datetime
 import zipfile
 import shutil
 
@@ -86,6 +89,9 @@ from omeroweb.decorators import login_required, ConnCleaningHttpResponse
 from omeroweb.connector import Connector
 from omeroweb.webgateway.util import zip_archived_files, LUTS_IN_PNG
 from omeroweb.webgateway.util import get_longs, getIntOrDefault
+from omeroweb.webgateway.util import get_file_range_in_chunks, \
+    original_file_etag, parse_byte_range
+from omeroweb.webgateway.jobs import background_jobs
 
 cache = CacheBase()
 logger = logging.getLogger(__name__)
@@ -379,6 +385,8 @@ def _render_thumbnail(request, iid, w=None, h=None, conn=None, _defcb=None,
                     raise Http404('Failed to render thumbnail')
             else:
                 prevent_cache = img._thumbInProgress
+                # the thumbnail may have been created or updated
+                thumbnail_version_cache.clear(long(iid))
         if not prevent_cache:
             webgateway_cache.setThumb(request, server_id, user_id, iid,
                                       jpeg_data, size)
@@ -829,9 +837,8 @@ def _get_prepared_image(request, iid, server_id=None, conn=None,
     @return:            Tuple (L{omero.gateway.ImageWrapper} image, quality)
     """
     r = request.GET
-    logger.debug('Preparing Image:%r saveDefs=%r '
-                 'retry=%r request=%r conn=%s' % (iid, saveDefs, retry,
-                                                  r, str(conn)))
+    logger.debug('Preparing Image:%r saveDefs=%r retry=%r request=%r conn=%s',
+                 iid, saveDefs, retry, r, conn)
     img = conn.getObject("Image", iid)
     if img is None:
         return
@@ -852,7 +859,7 @@ def _get_prepared_image(request, iid, server_id=None, conn=None,
             logger.debug('Failed to set quantization maps')
 
     if 'c' in r:
-        logger.debug("c="+r['c'])
+        logger.debug("c=%s", r['c'])
         activechannels, windows, colors = _split_channel_info(r['c'])
         allchannels = range(1, img.getSizeC() + 1)
         # If saving, apply to all channels
@@ -1564,6 +1571,50 @@ def plateGrid_json(request, pid, field=0, conn=None, **kwargs):
     return rv
 
 
+@login_required()
+def plate_atlas(request, pid, field=0, conn=None, **kwargs):
+    """
+    Returns a single JPEG with the thumbnails of all the wells of a plate
+    for the field, tiled by row and column in square cells of 'size'
+    pixels, in the same layout as the grid of L{plateGrid_json}.
+
+    @param request:     http request
+    @param pid:         Plate ID
+    @param field:       Field index
+    @param conn:        L{omero.gateway.BlitzGateway}
+    @return:            http response containing jpeg
+    """
+    try:
+        field = long(field or 0)
+    except ValueError:
+        field = 0
+    server_settings = request.session.get('server_settings', {}) \
+                                     .get('browser', {})
+    size = getIntOrDefault(request, 'size', None) or \
+        server_settings.get('thumb_default_size', 96)
+    if size <= 0 or size > 256:
+        return HttpResponseBadRequest('size must be between 1 and 256')
+    server_id = request.session['connector'].server_id
+
+    plateGrid = PlateGrid(conn, pid, field)
+    plate = plateGrid.plate
+    if plate is None:
+        raise Http404('Plate not found')
+
+    # cached per user, invalidated by the version
+    cache_key = 'plateatlas-%d-%s-%s' % (field, size, plateGrid.version)
+    user_id = conn.getUserId()
+    jpeg_data = webgateway_cache.getPlateAtlas(
+        request, server_id, user_id, plate, cache_key)
+    if jpeg_data is None:
+        jpeg_data = plateGrid.atlas(size)
+        if jpeg_data is None:
+            return HttpResponseServerError('Failed to create plate atlas')
+        webgateway_cache.setPlateAtlas(
+            request, server_id, user_id, plate, jpeg_data, cache_key)
+    return HttpResponse(jpeg_data, content_type='image/jpeg')
+
+
 @login_required()
 @jsonp
 def get_thumbnails_json(request, w=None, conn=None, **kwargs):
@@ -1872,7 +1923,6 @@ def search_json(request, conn=None, **kwargs):
     @param request:     http request
     @param conn:        L{omero.gateway.BlitzGateway}
     @return:            json search results
-    TODO: cache
     """
     server_id = request.session['connector'].server_id
     opts = searchOptFromRequest(request)
@@ -1883,47 +1933,87 @@ def search_json(request, conn=None, **kwargs):
     def urlprefix(iid):
         return reverse('webgateway_render_thumbnail', args=(iid,))
     xtra = {'thumbUrlPrefix': kwargs.get('urlprefix', urlprefix)}
-    try:
-        if opts['ctx'] == 'imgs':
-            sr = conn.searchObjects(["image"], opts['search'],
-                                    conn.SERVICE_OPTS)
-        else:
-            # searches P/D/I
-            sr = conn.searchObjects(None, opts['search'], conn.SERVICE_OPTS)
-    except ApiUsageException:
-        return HttpJavascriptResponseServerError('"parse exception"')
+
+    # The ordered hits of each query are kept for a while, so that
+    # paging through the results does not run the search again
+    handle = 'omero.web.search_json.%s' % md5(repr([
+        server_id, conn.getUserId(), conn.SERVICE_OPTS.getOmeroGroup(),
+        opts['ctx'], opts['search']]).encode('utf-8')).hexdigest()
+    hits = django_cache.get(handle)
+    sr = None
+    if hits is None:
+        try:
+            if opts['ctx'] == 'imgs':
+                sr = conn.searchObjects(["image"], opts['search'],
+                                        conn.SERVICE_OPTS)
+            else:
+                # searches P/D/I
+                sr = conn.searchObjects(None, opts['search'],
+                                        conn.SERVICE_OPTS)
+        except ApiUsageException:
+            return HttpJavascriptResponseServerError('"parse exception"')
+        hits = [(e.OMERO_CLASS, e.id) for e in sr]
+        django_cache.set(handle, hits, settings.SEARCH_CACHE_TIMEOUT)
+
+    bottom = min(opts['start'], len(hits))
+    if opts['limit'] == 0:
+        top = len(hits)
+    else:
+        top = min(len(hits), bottom + opts['limit'])
+
+    def load_page():
+        """ Loads the wrappers of the hits in the requested page """
+        if sr is not None:
+            return sr[bottom:top]
+        objs = {}
+        for otype in set(h[0] for h in hits[bottom:top]):
+            ids = [h[1] for h in hits[bottom:top] if h[0] == otype]
+            for obj in conn.getObjects(otype, ids):
+                objs[(otype, obj.id)] = obj
+        return [objs[h] for h in hits[bottom:top] if h in objs]
 
     def marshal():
-        rv = []
         if (opts['grabData'] and opts['ctx'] == 'imgs'):
-            bottom = min(opts['start'], len(sr)-1)
-            if opts['limit'] == 0:
-                top = len(sr)
-            else:
-                top = min(len(sr), bottom + opts['limit'])
-            for i in range(bottom, top):
-                e = sr[i]
-            # for e in sr:
-                try:
-                    rv.append(imageData_json(
-                        request, server_id, iid=e.id,
-                        key=opts['key'], conn=conn, _internal=True))
-                except AttributeError as x:
-                    logger.debug('(iid %i) ignoring Attribute Error: %s'
-                                 % (e.id, str(x)))
-                    pass
-                except omero.ServerError as x:
-                    logger.debug('(iid %i) ignoring Server Error: %s'
-                                 % (e.id, str(x)))
-            return rv
+            return imagesData_json(request, [h[1] for h in hits[bottom:top]],
+                                   key=opts['key'], conn=conn)
         else:
-            return map(lambda x: x.simpleMarshal(
-                xtra=xtra, parents=opts['parents']), sr)
+            return [x.simpleMarshal(xtra=xtra, parents=opts['parents'])
+                    for x in load_page()]
     rv = timeit(marshal)()
     logger.debug(rv)
     return rv
 
 
+def imagesData_json(request, image_ids, key=None, conn=None):
+    """
+    Returns a list of dicts with image information, as L{imageData_json},
+    for many images. The images are loaded with a single query.
+    Images that can't be marshalled are skipped.
+
+    @param request:     http request
+    @param image_ids:   Image IDs
+    @param key:         key of specific attributes to select
+    @param conn:        L{omero.gateway.BlitzGateway}
+    @return:            List of Dicts
+    """
+    rv = []
+    if not image_ids:
+        return rv
+    getDefaults = request.GET.get('getDefaults') == 'true'
+    for image in conn.getObjects("Image", image_ids, respect_order=True):
+        try:
+            if getDefaults:
+                image.resetDefaults(save=False)
+            rv.append(imageMarshal(image, key=key, request=request))
+        except AttributeError as x:
+            logger.debug('(iid %i) ignoring Attribute Error: %s'
+                         % (image.id, str(x)))
+        except omero.ServerError as x:
+            logger.debug('(iid %i) ignoring Server Error: %s'
+                         % (image.id, str(x)))
+    return rv
+
+
 @require_POST
 @login_required()
 def save_image_rdef_json(request, iid, conn=None, **kwargs):
@@ -1979,6 +2069,80 @@ def listLuts_json(request, conn=None, **kwargs):
     return {"luts": rv, "png_luts": LUTS_IN_PNG}
 
 
+def _channel_signatures(conn, where, params):
+    """
+    Returns the pixels type, number of channels and sorted channel labels,
+    as in L{omero.gateway.ChannelWrapper.getLabel}, of the Images matching
+    the 'where' clause, loaded with a single query.
+
+    @param conn:        L{omero.gateway.BlitzGateway}
+    @param where:       HQL where clause on 'image'
+    @param params:      L{omero.sys.ParametersI} for the query
+    @return:            Dict of Image ID to (type, sizeC, labels) tuple
+    """
+    q = """
+        select distinct image.id, pix.pixelsType.value, pix.sizeC,
+               index(ch), lc.name, lc.emissionWave.value
+        from Image image
+        join image.pixels pix
+        join pix.channels ch
+        join ch.logicalChannel lc
+        where %s
+        """ % where
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    images = {}
+    for row in conn.getQueryService().projection(q, params, ctx):
+        iid, ptype, size_c, idx, name, wave = unwrap(row)
+        label = name
+        if label is None or len(label.strip()) == 0:
+            label = wave
+            if label is not None and int(label) == label:
+                label = int(label)
+        if label is None or len(str(label).strip()) == 0:
+            label = idx
+        images.setdefault(iid, (ptype, size_c, []))[2].append(str(label))
+    return dict((iid, (ptype, size_c, tuple(sorted(labels))))
+                for iid, (ptype, size_c, labels) in images.items())
+
+
+def _list_compatible_imgs(conn, pid, iid):
+    """
+    Lists the IDs of the images of a project that have the same pixels
+    type, number of channels and channel labels as the given image,
+    including the image itself. The result is cached per project and
+    source image signature.
+
+    @param conn:        L{omero.gateway.BlitzGateway}
+    @param pid:         Project ID
+    @param iid:         Image ID
+    @return:            List of Image IDs
+    """
+    params = omero.sys.ParametersI()
+    params.addId(iid)
+    signature = _channel_signatures(conn, 'image.id = :id', params).get(iid)
+    if signature is None:
+        return []
+
+    key = 'omero.web.compatible_imgs.%s' % md5(repr([
+        conn.getUserId(), pid, signature]).encode('utf-8')).hexdigest()
+    imgs = django_cache.get(key)
+    if imgs is None:
+        params = omero.sys.ParametersI()
+        params.addId(pid)
+        signatures = _channel_signatures(
+            conn,
+            """image.id in (
+                select dil.child.id from DatasetImageLink dil,
+                    ProjectDatasetLink pdl
+                where dil.parent.id = pdl.child.id and pdl.parent.id = :id)
+            """, params)
+        imgs = sorted(i for i, sig in signatures.items() if sig == signature)
+        django_cache.set(key, imgs,
+                         settings.COMPATIBLE_IMAGES_CACHE_TIMEOUT)
+    return imgs
+
+
 @login_required()
 def list_compatible_imgs_json(request, iid, conn=None, **kwargs):
     """
@@ -2002,31 +2166,11 @@ def list_compatible_imgs_json(request, iid, conn=None, **kwargs):
         img = conn.getObject("Image", iid)
 
     if img is not None:
-        # List all images in project
+        pr = img.getProject()
         imgs = []
-        for ds in img.getProject().listChildren():
-            imgs.extend(ds.listChildren())
-        # Filter the ones that would pass the applySettingsToImages call
-        img_ptype = img.getPrimaryPixels().getPixelsType().getValue()
-        img_ccount = img.getSizeC()
-        img_ew = [x.getLabel() for x in img.getChannels()]
-        img_ew.sort()
-
-        def compat(i):
-            if long(i.getId()) == long(iid):
-                return False
-            pp = i.getPrimaryPixels()
-            if (pp is None or
-                i.getPrimaryPixels().getPixelsType().getValue() != img_ptype or
-                    i.getSizeC() != img_ccount):
-                return False
-            ew = [x.getLabel() for x in i.getChannels()]
-            ew.sort()
-            if ew != img_ew:
-                return False
-            return True
-        imgs = filter(compat, imgs)
-        json_data = json.dumps([x.getId() for x in imgs])
+        if pr is not None:
+            imgs = _list_compatible_imgs(conn, pr.getId(), long(iid))
+        json_data = json.dumps([x for x in imgs if x != long(iid)])
 
     if r.get('callback', None):
         json_data = '%s(%s)' % (r['callback'], json_data)
@@ -2088,6 +2232,9 @@ def copy_image_rdef_json(request, conn=None, **kwargs):
     If 'to_type' is in request, this can be 'dataset', 'plate', 'acquisition'
     Returns json dict of Boolean:[Image-IDs] for images that have successfully
     had the rendering settings applied, or not.
+    If 'background' is 'true' in the POST, the settings are applied in the
+    background and the 'jobId' is returned at once. The job is shown in the
+    webclient Activities panel.
 
     @param request:     http request
     @param server_id:
@@ -2096,7 +2243,6 @@ def copy_image_rdef_json(request, conn=None, **kwargs):
     """
 
     server_id = request.session['connector'].server_id
-    json_data = False
 
     fromid = request.GET.get('fromid', None)
     toids = request.POST.getlist('toids')
@@ -2190,43 +2336,80 @@ def copy_image_rdef_json(request, conn=None, **kwargs):
     if rdef is None:
         rdef = request.session.get('rdef')
     if request.method == "POST":
-        originalSettings = None
-        fromImage = None
-        if fromid is None:
-            # if we have rdef, save to source image, then use that image as
-            # 'fromId', then revert.
-            if rdef is not None and len(toids) > 0:
-                fromImage = conn.getObject("Image", rdef['imageId'])
-                if fromImage is not None:
-                    # copy orig settings
-                    originalSettings = getRenderingSettings(fromImage)
-                    applyRenderingSettings(fromImage, rdef)
-                    fromid = fromImage.getId()
-
-        # If we have both, apply settings...
         try:
-            fromid = long(fromid)
             toids = [long(x) for x in toids]
-        except TypeError:
-            fromid = None
         except ValueError:
-            fromid = None
-        if fromid is not None and len(toids) > 0:
-            fromimg = conn.getObject("Image", fromid)
-            userid = fromimg.getOwner().getId()
-            json_data = conn.applySettingsToSet(fromid, to_type, toids)
-            if json_data and True in json_data:
-                for iid in json_data[True]:
-                    img = conn.getObject("Image", iid)
-                    img is not None and webgateway_cache.invalidateObject(
-                        server_id, userid, img)
-
-        # finally - if we temporarily saved rdef to original image, revert
-        # if we're sure that from-image is not in the target set (Dataset etc)
-        if to_type == "Image" and fromid not in toids:
-            if originalSettings is not None and fromImage is not None:
-                applyRenderingSettings(fromImage, originalSettings)
-        return json_data
+            toids = []
+
+        def paste(conn, fromid):
+            originalSettings = None
+            fromImage = None
+            json_data = False
+            if fromid is None:
+                # if we have rdef, save to source image, then use that image
+                # as 'fromId', then revert.
+                if rdef is not None and len(toids) > 0:
+                    fromImage = conn.getObject("Image", rdef['imageId'])
+                    if fromImage is not None:
+                        # copy orig settings
+                        originalSettings = getRenderingSettings(fromImage)
+                        applyRenderingSettings(fromImage, rdef)
+                        fromid = fromImage.getId()
+
+            # If we have both, apply settings...
+            try:
+                fromid = long(fromid)
+            except TypeError:
+                fromid = None
+            except ValueError:
+                fromid = None
+            if fromid is not None and len(toids) > 0:
+                fromimg = conn.getObject("Image", fromid)
+                userid = fromimg.getOwner().getId()
+                json_data = conn.applySettingsToSet(fromid, to_type, toids)
+                if json_data and True in json_data:
+                    webgateway_cache.invalidateImages(
+                        server_id, userid, json_data[True])
+
+            # finally - if we temporarily saved rdef to original image,
+            # revert if we're sure that from-image is not in the target set
+            # (Dataset etc)
+            if to_type == "Image" and fromid not in toids:
+                if originalSettings is not None and fromImage is not None:
+                    applyRenderingSettings(fromImage, originalSettings)
+            return json_data
+
+        if request.POST.get('background') != 'true':
+            return paste(conn, fromid)
+
+        # Paste in the background on a connection to the same session and
+        # return the job handle, which is shown in the Activities panel
+        connector = request.session['connector']
+        group_id = conn.SERVICE_OPTS.getOmeroGroup()
+
+        def paste_job():
+            job_conn = connector.join_connection('OMERO.web')
+            if job_conn is None:
+                raise Exception('Failed to join session')
+            try:
+                job_conn.SERVICE_OPTS.setOmeroGroup(group_id)
+                rv = paste(job_conn, fromid)
+                # True/False keys are not json compatible
+                return dict((str(k).lower(), v)
+                            for k, v in (rv or {}).items())
+            finally:
+                job_conn.close(hard=False)
+
+        jobId = background_jobs.submit(paste_job)
+        request.session.setdefault('callback', {})[jobId] = {
+            'job_type': 'rdef',
+            'job_name': 'Paste Rendering Settings',
+            'dtype': to_type.capitalize(),
+            'obj_ids': toids,
+            'start_time': datetime.datetime.now(),
+            'status': 'in progress'}
+        request.session.modified = True
+        return {'jobId': jobId, 'status': 'in progress'}
 
     else:
         return HttpResponseNotAllowed(["POST"])
@@ -2461,6 +2644,63 @@ def download_as(request, iid=None, conn=None, **kwargs):
     return rsp
 
 
+def original_file_response(request, orig_file, conn, size=None):
+    """
+    Returns a L{ConnCleaningHttpResponse} streaming an OriginalFile, with
+    an ETag based on the file's checksum. A single byte 'Range' is
+    returned as '206 Partial Content', read from the requested offset,
+    unless an 'If-Range' header doesn't match the ETag. The caller adds
+    the Content-Type and Content-Disposition headers.
+
+    @param request:     http request
+    @param orig_file:   L{omero.gateway.OriginalFileWrapper}
+    @param conn:        L{omero.gateway.BlitzGateway}, closed with response
+    @param size:        Size of the file if known
+    @return:            http response
+    """
+    if size is None:
+        size = orig_file.getSize()
+    etag = original_file_etag(orig_file)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (
+            etag in [t.strip() for t in if_none_match.split(',')]):
+        rsp = ConnCleaningHttpResponse(status=304)
+        rsp.conn = conn
+        rsp['ETag'] = etag
+        return rsp
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_byte_range(
+                request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            rsp = ConnCleaningHttpResponse(status=416)
+            rsp.conn = conn
+            rsp['Content-Range'] = 'bytes */%s' % size
+            rsp['Accept-Ranges'] = 'bytes'
+            return rsp
+
+    if byte_range is None:
+        rsp = ConnCleaningHttpResponse(
+            orig_file.getFileInChunks(buf=settings.CHUNK_SIZE))
+        rsp['Content-Length'] = size
+    else:
+        first, last = byte_range
+        rsp = ConnCleaningHttpResponse(
+            get_file_range_in_chunks(orig_file, first, last,
+                                     buf=settings.CHUNK_SIZE),
+            status=206)
+        rsp['Content-Length'] = last - first + 1
+        rsp['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+    rsp.conn = conn
+    rsp['Accept-Ranges'] = 'bytes'
+    rsp['ETag'] = etag
+    return rsp
+
+
 @login_required(doConnectionCleanup=False)
 def archived_files(request, iid=None, conn=None, **kwargs):
     """
@@ -2544,10 +2784,7 @@ def archived_files(request, iid=None, conn=None, **kwargs):
 
     if len(files) == 1:
         orig_file = files[0]
-        rsp = ConnCleaningHttpResponse(
-            orig_file.getFileInChunks(buf=settings.CHUNK_SIZE))
-        rsp.conn = conn
-        rsp['Content-Length'] = orig_file.getSize()
+        rsp = original_file_response(request, orig_file, conn)
         # ',' in name causes duplicate headers
         fname = orig_file.getName().replace(" ", "_").replace(",", ".")
         rsp['Content-Disposition'] = 'attachment; filename=%s' % (fname)
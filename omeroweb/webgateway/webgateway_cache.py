@@ -14,6 +14,7 @@
 # Author: Carlos Neves <carlos(at)glencoesoftware.com>
 
 from django.conf import settings
+from omeroweb.access_log import record_cache
 import omero
 import logging
 from random import random
@@ -30,6 +31,8 @@ import os
 import re
 import shutil
 import stat
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +48,8 @@ IMG_CACHE_SIZE = 512*1024  # KB == 512MB
 JSON_CACHE_TIME = 3600  # 1 hour
 JSON_CACHE_SIZE = 1*1024  # KB == 1MB
 TMPDIR_TIME = 3600 * 12  # 12 hours
+THUMB_VERSION_CACHE_TIME = 300  # 5 minutes
+COUNT_CACHE_SIZE = 10000  # entries
 
 
 class CacheBase (object):  # pragma: nocover
@@ -194,7 +199,7 @@ class FileCache(CacheBase):
         @param fname:   File name of data to delete
         """
 
-        logger.debug('requested delete for "%s"' % fname)
+        logger.debug('requested delete for "%s"', fname)
         if os.path.isdir(fname):
             shutil.rmtree(fname, ignore_errors=True)
         else:
@@ -324,7 +329,7 @@ class FileCache(CacheBase):
             for f in files:
                 if not self._check_entry(os.path.join(p, f)):
                     count += 1
-        logger.debug('purge finished, removed %d files' % count)
+        logger.debug('purge finished, removed %d files', count)
 
     def _createdir(self):
         """
@@ -486,7 +491,7 @@ class WebGatewayCache (object):
             if self.tryLock():
                 self.handleEvent(client_base, e)
             else:
-                logger.debug("## ! ignoring event %s" % str(e.event.id.val))
+                logger.debug("## ! ignoring event %s", e.event.id.val)
 
     def clear(self):
         """
@@ -496,16 +501,28 @@ class WebGatewayCache (object):
         self._img_cache.wipe()
         self._thumb_cache.wipe()
 
+    def _cache_get(self, cache, key):
+        """ Calls cache.get(key) and records the hit or miss """
+
+        rv = cache.get(key)
+        if rv is None:
+            logger.debug('  fail: %s', key)
+            record_cache('miss')
+        else:
+            logger.debug('cached: %s', key)
+            record_cache('hit')
+        return rv
+
     def _cache_set(self, cache, key, obj):
         """ Calls cache.set(key, obj) """
 
-        logger.debug('   set: %s' % key)
+        logger.debug('   set: %s', key)
         cache.set(key, obj)
 
     def _cache_clear(self, cache, key):
         """ Calls cache.delete(key) """
 
-        logger.debug(' clear: %s' % key)
+        logger.debug(' clear: %s', key)
         cache.delete(key)
 
     def invalidateObject(self, client_base, user_id, obj):
@@ -521,9 +538,28 @@ class WebGatewayCache (object):
         if obj.OMERO_CLASS == 'Image':
             self.clearImage(None, client_base, user_id, obj)
         else:
-            logger.debug('unhandled object type: %s' % obj.OMERO_CLASS)
+            logger.debug('unhandled object type: %s', obj.OMERO_CLASS)
             self.clearJson(client_base, obj)
 
+    def invalidateImages(self, client_base, user_id, iids):
+        """
+        Invalidates all caches for these Images, as L{clearImage} does,
+        using only their IDs so that the Images don't need to be loaded.
+
+        @param client_base:     The server_id
+        @param user_id:         OMERO user ID to partition caching upon
+        @param iids:            Image IDs
+        """
+        for iid in iids:
+            self._cache_clear(self._img_cache,
+                              self._imageIdKey(client_base, iid))
+            self.clearThumb(None, client_base, user_id, iid)
+            thumbnail_version_cache.clear(iid)
+            self._cache_clear(self._json_cache,
+                              'json_%s/Image_%s/' % (client_base, iid))
+        if iids:
+            self.clearPlateAtlases(client_base, user_id)
+
     ##
     # Thumb
 
@@ -579,12 +615,7 @@ class WebGatewayCache (object):
         """
 
         k = self._thumbKey(r, client_base, user_id, iid, size)
-        r = self._thumb_cache.get(k)
-        if r is None:
-            logger.debug('  fail: %s' % k)
-        else:
-            logger.debug('cached: %s' % k)
-        return r
+        return self._cache_get(self._thumb_cache, k)
 
     def clearThumb(self, r, client_base, user_id, iid, size=None):
         """
@@ -637,19 +668,23 @@ class WebGatewayCache (object):
             rv = 'img_%s/%s/%s/{0}-c%s-m%s-q%s-r%s-t%s' % (
                 client_base, pre, str(iid), c, m, q, region, tile)
             if p:
-                logger.debug('rv: {0} {1}'.format(rv, type(rv)))
-                logger.debug('p: {0} {1}'.format(str(p), type(p)))
-                logger.debug('t: {0} {1}'.format(str(t), type(t)))
-                pt = '%s-%s' % (p, str(t))
-                return rv.format(pt)
+                return rv.format('%s-%s' % (p, t))
             else:
-                logger.debug('rv: {0} {1}'.format(rv, type(rv)))
-                logger.debug('z: {0} {1}'.format(str(z), type(z)))
-                logger.debug('t: {0} {1}'.format(str(t), type(t)))
-                zt = '%sx%s' % (str(z), str(t))
-                return rv.format(zt)
+                return rv.format('%sx%s' % (z, t))
         else:
-            return 'img_%s/%s/%s' % (client_base, pre, str(iid))
+            return self._imageIdKey(client_base, iid)
+
+    def _imageIdKey(self, client_base, iid):
+        """
+        Returns the key for caching an Image with default rendering settings
+
+        @param client_base:     server_id for cache key
+        @param iid:             Image ID
+        """
+        pre = str(iid)[:-4]
+        if len(pre) == 0:
+            pre = '0'
+        return 'img_%s/%s/%s' % (client_base, pre, str(iid))
 
     def setImage(self, r, client_base, img, z, t, obj, ctx=''):
         """
@@ -682,12 +717,7 @@ class WebGatewayCache (object):
         @rtype:                 String
         """
         k = self._imageKey(r, client_base, img, z, t) + ctx
-        r = self._img_cache.get(k)
-        if r is None:
-            logger.debug('  fail: %s' % k)
-        else:
-            logger.debug('cached: %s' % k)
-        return r
+        return self._cache_get(self._img_cache, k)
 
     def clearImage(self, r, client_base, user_id, img, skipJson=False):
         """
@@ -710,6 +740,8 @@ class WebGatewayCache (object):
         self._cache_clear(self._img_cache, k)
         # do the thumb too
         self.clearThumb(r, client_base, user_id, img.getId())
+        thumbnail_version_cache.clear(img.getId())
+        self.clearPlateAtlases(client_base, user_id)
         # and json data
         if not skipJson:
             self.clearJson(client_base, img)
@@ -769,12 +801,7 @@ class WebGatewayCache (object):
         @rtype:                 String or None
         """
         k = self._jsonKey(r, client_base, obj, ctx)
-        r = self._json_cache.get(k)
-        if r is None:
-            logger.debug('  fail: %s' % k)
-        else:
-            logger.debug('cached: %s' % k)
-        return r
+        return self._cache_get(self._json_cache, k)
 
     def setJson(self, r, client_base, obj, data, ctx=''):
         """
@@ -803,6 +830,59 @@ class WebGatewayCache (object):
         # if obj.OMERO_CLASS == 'Dataset':
         #    self.clearDatasetContents(None, client_base, obj)
 
+    def _plateAtlasKey(self, client_base, user_id, plate=None, ctx=''):
+        """
+        Creates a cache key for the atlas of a plate. Atlases are made of
+        each user's thumbnails, so they are kept per user, like thumbnails.
+        Without a plate, returns the key of all the atlases of the user.
+        """
+        if plate is None:
+            return 'atlas_%s/%s/' % (client_base, user_id)
+        return 'atlas_%s/%s/%s_%s/%s' % (client_base, user_id,
+                                         plate.OMERO_CLASS, plate.id, ctx)
+
+    def setPlateAtlas(self, r, client_base, user_id, plate, data, ctx=''):
+        """
+        Adds the JPEG atlas of a plate to the image cache
+
+        @param r:               http request - not used
+        @param client_base:     server_id for cache key
+        @param user_id:         OMERO user ID to partition caching upon
+        @param plate:           PlateWrapper for cache key
+        @param data:            Data to cache
+        @param ctx:             context string used for cache key
+        @rtype:                 True
+        """
+        k = self._plateAtlasKey(client_base, user_id, plate, ctx)
+        self._cache_set(self._img_cache, k, data)
+        return True
+
+    def getPlateAtlas(self, r, client_base, user_id, plate, ctx=''):
+        """
+        Gets the JPEG atlas of a plate from the image cache
+
+        @param r:               http request - not used
+        @param client_base:     server_id for cache key
+        @param user_id:         OMERO user ID to partition caching upon
+        @param plate:           PlateWrapper for cache key
+        @param ctx:             context string used for cache key
+        @rtype:                 String or None
+        """
+        k = self._plateAtlasKey(client_base, user_id, plate, ctx)
+        return self._cache_get(self._img_cache, k)
+
+    def clearPlateAtlases(self, client_base, user_id):
+        """
+        Clears all the plate atlases of a user, e.g. after the rendering
+        settings or thumbnails of images changed. The plate of an image is
+        not known here, but the atlases are created again when needed.
+
+        @param client_base:     server_id for cache key
+        @param user_id:         OMERO user ID to partition caching upon
+        """
+        self._cache_clear(self._img_cache,
+                          self._plateAtlasKey(client_base, user_id))
+
     def setDatasetContents(self, r, client_base, ds, data):
         """
         Adds data to the json cache using 'contents' as context
@@ -841,6 +921,159 @@ class WebGatewayCache (object):
         return True
 
 
+class ThumbnailVersionCache (object):
+    """
+    In memory LRU of the version of the most recent thumbnail of images,
+    for each thumbnail owner. Kept per process, so entries expire after
+    L{THUMB_VERSION_CACHE_TIME} to pick up thumbnails created elsewhere.
+    """
+
+    def __init__(self, size, timeout=THUMB_VERSION_CACHE_TIME):
+        """
+        @param size:            Maximum number of images to keep
+        @param timeout:         Seconds before an entry expires
+        """
+        self._size = size
+        self._timeout = timeout
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, iids):
+        """
+        Gets the cached thumbnail versions of images.
+
+        @param user_id:         Thumbnail owner ID
+        @param iids:            Image IDs
+        @return:                Dict of image ID to version, or None if
+                                the image has no thumbnail, for the images
+                                that are cached
+        """
+        rv = {}
+        if self._size <= 0:
+            return rv
+        now = time.time()
+        with self._lock:
+            for iid in iids:
+                entry = self._items.get(iid)
+                if entry is None or user_id not in entry[1]:
+                    continue
+                if entry[0] < now:
+                    del self._items[iid]
+                    continue
+                rv[iid] = entry[1][user_id]
+                # mark as recently used
+                self._items[iid] = self._items.pop(iid)
+        return rv
+
+    def set(self, user_id, versions):
+        """
+        Puts thumbnail versions into the cache.
+
+        @param user_id:         Thumbnail owner ID
+        @param versions:        Dict of image ID to version or None
+        """
+        if self._size <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            for iid, version in versions.items():
+                entry = self._items.pop(iid, None)
+                if entry is None or entry[0] < now:
+                    entry = (now + self._timeout, {})
+                entry[1][user_id] = version
+                self._items[iid] = entry
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self, iid):
+        """
+        Clears the versions of all thumbnails of an image, e.g. after a
+        new thumbnail has been rendered.
+
+        @param iid:             Image ID
+        """
+        with self._lock:
+            self._items.pop(iid, None)
+
+
+class CountCache (object):
+    """
+    Short lived, in memory cache of the object counts shown by the
+    webclient, e.g. the number of children of containers or of orphaned
+    images. Keys are tuples of (user, group, owner, container...).
+    Kept per process: views that create or delete links clear it, other
+    processes pick up changes when entries expire after a few seconds.
+    """
+
+    def __init__(self, timeout, size=COUNT_CACHE_SIZE):
+        """
+        @param timeout:         Seconds before an entry expires, 0 to
+                                disable the cache
+        @param size:            Maximum number of entries to keep
+        """
+        self._timeout = timeout
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        Gets the cached counts.
+
+        @param keys:            Cache keys
+        @return:                Dict of key to count for the keys that
+                                are cached
+        """
+        rv = {}
+        if self._timeout <= 0:
+            return rv
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._items.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._items[key]
+                    continue
+                rv[key] = entry[1]
+        return rv
+
+    def get(self, key):
+        """ Gets a cached count or None """
+        return self.get_many([key]).get(key)
+
+    def set_many(self, counts):
+        """
+        Puts counts into the cache.
+
+        @param counts:          Dict of key to count
+        """
+        if self._timeout <= 0:
+            return
+        expires = time.time() + self._timeout
+        with self._lock:
+            for key, count in counts.items():
+                self._items.pop(key, None)
+                self._items[key] = (expires, count)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def set(self, key, count):
+        """ Puts a count into the cache """
+        self.set_many({key: count})
+
+    def clear(self):
+        """ Clears all counts, e.g. after links were created or deleted """
+        with self._lock:
+            self._items.clear()
+
+
+thumbnail_version_cache = ThumbnailVersionCache(
+    getattr(settings, 'THUMBNAILS_VERSION_CACHE_SIZE', 0))
+
+count_cache = CountCache(getattr(settings, 'COUNT_CACHE_TIME', 0))
+
 webgateway_cache = WebGatewayCache(FileCache)
 
 
@@ -1001,7 +1234,7 @@ class WebGatewayTempFile (object):
             t = os.stat(fn)[stat.ST_SIZE]
             if (t == fsize):
                 cnt -= 1
-                logger.debug('countdown %d' % cnt)
+                logger.debug('countdown %d', cnt)
             else:
                 fsize = t
                 cnt = 30
@@ -41,6 +41,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omeroweb.settings")
 # setting points here.
 application = get_wsgi_application()
 
+# If Gunicorn preloads the application, do the work of the first request
+# once in the master process so that the forked workers start warm.
+from django.conf import settings  # noqa
+from omeroweb.utils import is_preloaded, warm_up  # noqa
+if is_preloaded(settings):
+    warm_up()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
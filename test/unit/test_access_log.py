@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Simple unit tests for the "omeroweb.access_log" module.
+"""
+
+import json
+import threading
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+from django.test import override_settings
+
+from omeroweb.access_log import AccessLogMiddleware, get_request_stats, \
+    record_cache
+from omeroweb.utils import run_queries
+
+
+class MockConnection(object):
+
+    def getEventContext(self):
+        return None
+
+    def getQueryService(self):
+        return None
+
+
+class TestAccessLog(object):
+
+    def setup_method(self, method):
+        self.r = RequestFactory().get('/rand')
+
+    def view(self, request):
+        stats = get_request_stats()
+        if stats is not None:
+            stats.ice_call('getObject', 0.5)
+            stats.ice_call('projection', 0.25)
+        record_cache('hit')
+        record_cache('miss')
+        record_cache('miss')
+        return HttpResponse('ok')
+
+    @override_settings(ACCESS_LOG_SAMPLE_RATE=0)
+    def test_not_sampled(self, monkeypatch):
+        middleware = AccessLogMiddleware(self.view)
+        logged = []
+        monkeypatch.setattr(middleware, 'log',
+                            lambda *args: logged.append(args))
+        assert middleware(self.r).content == b'ok'
+        assert logged == []
+        assert get_request_stats() is None
+
+    @override_settings(ACCESS_LOG_SAMPLE_RATE=1)
+    def test_sampled(self, monkeypatch):
+        middleware = AccessLogMiddleware(self.view)
+        records = []
+        monkeypatch.setattr('omeroweb.access_log.logger.info',
+                            lambda msg: records.append(json.loads(msg)))
+        assert middleware(self.r).content == b'ok'
+        assert get_request_stats() is None
+        record = records[0]
+        assert record['path'] == '/rand'
+        assert record['status'] == 200
+        assert record['cache'] == {'hit': 1, 'miss': 2}
+        assert record['ice_calls'] == 2
+        assert record['ice_time'] == 0.75
+        assert record['ice_slowest'] == 'getObject'
+
+    def query(self, name):
+        get_request_stats().ice_call(name, 0.5)
+        return threading.current_thread()
+
+    @override_settings(ACCESS_LOG_SAMPLE_RATE=1, TREE_QUERY_THREADS=4)
+    def test_sampled_query_threads(self, monkeypatch):
+        threads = []
+
+        def view(request):
+            threads.extend(run_queries(MockConnection(), {
+                'one': (self.query, {'name': 'one'}),
+                'two': (self.query, {'name': 'two'}),
+                'three': (self.query, {'name': 'three'})}).values())
+            return HttpResponse('ok')
+
+        middleware = AccessLogMiddleware(view)
+        records = []
+        monkeypatch.setattr('omeroweb.access_log.logger.info',
+                            lambda msg: records.append(json.loads(msg)))
+        middleware(self.r)
+        assert threading.current_thread() not in threads
+        assert records[0]['ice_calls'] == 3
+        assert records[0]['ice_time'] == 1.5
+
+    @override_settings(ACCESS_LOG_SAMPLE_RATE=1)
+    def test_sampled_streaming(self, monkeypatch):
+        def content():
+            for name in ('one', 'two'):
+                self.query(name)
+                yield name
+
+        middleware = AccessLogMiddleware(
+            lambda request: StreamingHttpResponse(content()))
+        records = []
+        monkeypatch.setattr('omeroweb.access_log.logger.info',
+                            lambda msg: records.append(json.loads(msg)))
+        response = middleware(self.r)
+        # logged once the content has been streamed
+        assert records == []
+        assert b''.join(response.streaming_content) == b'onetwo'
+        assert get_request_stats() is None
+        assert records[0]['streaming'] is True
+        assert records[0]['ice_calls'] == 2
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Simple unit tests for the polling of jobs of the webclient Activities panel.
+"""
+
+import datetime
+import pytest
+
+from omeroweb.webclient import views
+from omeroweb.webgateway.jobs import BackgroundJobs
+
+
+def rdef_job(status='in progress'):
+    return {'job_type': 'rdef',
+            'job_name': 'Paste Rendering Settings',
+            'start_time': datetime.datetime.now(),
+            'status': status}
+
+
+class MockConnection(object):
+
+    def getEventContext(self):
+        pass
+
+    def getQueryService(self):
+        pass
+
+
+class MockSession(dict):
+
+    modified = False
+
+
+class MockRequest(object):
+
+    def __init__(self, callbacks):
+        self.session = MockSession(callback=callbacks)
+
+
+@pytest.fixture(scope='function')
+def polls(monkeypatch):
+    """
+    Replaces _poll_callback() with one that records the handles it checks
+    and reports the updates in 'results', starting without cached polls.
+    """
+    monkeypatch.setattr(views, '_callback_polls', {})
+    polled = []
+    results = {}
+
+    def poll_callback(conn, cbString, callbackDict):
+        polled.append(cbString)
+        return results.get(cbString, ('in progress', {}))
+
+    monkeypatch.setattr(views, '_poll_callback', poll_callback)
+    return polled, results
+
+
+class TestPollCallback(object):
+
+    def test_rdef_finished(self, monkeypatch):
+        jobs = BackgroundJobs(1)
+        monkeypatch.setattr(views, 'background_jobs', jobs)
+        job_id = jobs.submit(lambda: {'true': [1, 2], 'false': [3]})
+        jobs._pool.shutdown()
+        state, updates = views._poll_callback(None, job_id, rdef_job())
+        assert state == 'new'
+        assert updates == {'status': 'finished', 'updated': [1, 2],
+                           'not_updated': [3]}
+
+    def test_rdef_failed(self, monkeypatch):
+        def fail():
+            raise Exception('No rendering settings')
+
+        jobs = BackgroundJobs(1)
+        monkeypatch.setattr(views, 'background_jobs', jobs)
+        job_id = jobs.submit(fail)
+        jobs._pool.shutdown()
+        state, updates = views._poll_callback(None, job_id, rdef_job())
+        assert state == 'new'
+        # 'error' is a count, like for the other jobs, see activities()
+        assert updates == {'status': 'failed', 'error': 1,
+                           'report': 'No rendering settings'}
+
+
+class TestPollCallbacks(object):
+
+    def test_rate_limited(self, polls):
+        polled, results = polls
+        callbacks = {'job/1': rdef_job()}
+        rv = views._poll_callbacks(MockConnection(), callbacks)
+        assert rv == {'job/1': ('in progress', {})}
+        # The job finishes but the last result is reused within the interval
+        results['job/1'] = ('new', {'status': 'finished'})
+        rv = views._poll_callbacks(MockConnection(), callbacks)
+        assert rv == {'job/1': ('in progress', {})}
+        assert polled == ['job/1']
+
+    def test_reused_across_sessions(self, polls):
+        polled, results = polls
+        views._poll_callbacks(MockConnection(), {'job/1': rdef_job()})
+        # Another tab or session polls the same job and a new one
+        rv = views._poll_callbacks(
+            MockConnection(), {'job/1': rdef_job(), 'job/2': rdef_job()})
+        assert rv == {'job/1': ('in progress', {}),
+                      'job/2': ('in progress', {})}
+        assert polled == ['job/1', 'job/2']
+
+    def test_expired(self, polls, monkeypatch):
+        polled, results = polls
+        monkeypatch.setattr(views.settings, 'ACTIVITIES_POLL_INTERVAL', -1)
+        callbacks = {'job/1': rdef_job()}
+        views._poll_callbacks(MockConnection(), callbacks)
+        results['job/1'] = ('new', {'status': 'finished'})
+        rv = views._poll_callbacks(MockConnection(), callbacks)
+        assert rv == {'job/1': ('new', {'status': 'finished'})}
+        assert polled == ['job/1', 'job/1']
+
+    @pytest.mark.parametrize('status', ['finished', 'failed'])
+    def test_skip_done(self, polls, status):
+        polled, results = polls
+        rv = views._poll_callbacks(
+            MockConnection(), {'job/1': rdef_job(status)})
+        assert rv == {}
+        assert polled == []
+
+
+class TestPollChanges(object):
+
+    def test_only_changed(self, polls):
+        polled, results = polls
+        start = datetime.datetime.now() - datetime.timedelta(hours=1)
+        callbacks = {'job/1': rdef_job(), 'job/2': rdef_job(),
+                     'job/3': rdef_job('finished')}
+        for callbackDict in callbacks.values():
+            callbackDict['start_time'] = start
+        results['job/1'] = ('new', {'status': 'finished',
+                                    'updated': [1]})
+        request = MockRequest(callbacks)
+        since = views.time() - 60
+        rv = views._poll_changes(request, MockConnection(), since, 0)
+        assert list(rv['changed'].keys()) == ['job/1']
+        assert rv['changed']['job/1']['status'] == 'finished'
+        assert rv['changed']['job/1']['updated'] == [1]
+        assert rv['new_results'] == ['job/1']
+        assert rv['inprogress'] == 1
+        assert rv['jobs'] == 3
+        assert request.session.modified
+
+        # Nothing changed since the previous response
+        rv = views._poll_changes(request, MockConnection(), rv['time'], 0)
+        assert rv['changed'] == {}
+        assert rv['inprogress'] == 1
+
+    def test_unchanged_values(self, polls):
+        polled, results = polls
+        callbacks = {'job/1': rdef_job()}
+        callbacks['job/1']['start_time'] -= datetime.timedelta(hours=1)
+        results['job/1'] = ('in progress', {'status': 'in progress'})
+        request = MockRequest(callbacks)
+        rv = views._poll_changes(
+            request, MockConnection(), views.time() - 60, 0)
+        assert rv['changed'] == {}
+        assert 'last_update' not in callbacks['job/1']
+        assert not request.session.modified
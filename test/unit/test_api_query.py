@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the "api_query" module.
+"""
+
+import pytest
+
+from omero.rtypes import rlong, rstring, unwrap
+from omero.gateway import ServiceOptsDict
+from omero.sys import ParametersI
+from omeroweb.api.api_exceptions import BadRequestError
+from omeroweb.api import api_query
+from omeroweb.api.api_marshal import marshal_projection
+from omeroweb.api.api_query import apply_keyset, build_keyset_clause, \
+    decode_cursor, encode_cursor, get_sort_keys, get_validators, \
+    iter_objects, projection_query, split_expressions
+
+
+@pytest.fixture(scope='module')
+def fields():
+    return {
+        'name': ('obj.name', ('Name',)),
+        'owner': ('obj.details.owner.id', ('omero:details', 'owner', '@id')),
+    }
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append(query)
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+
+    def __init__(self, results):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.qs = MockQueryService(results)
+
+    def getUserId(self):
+        return 1
+
+    def getQueryService(self):
+        return self.qs
+
+    def buildQuery(self, object_type, opts=None):
+        query = ('select obj from %s obj join fetch obj.details.owner'
+                 ' order by lower(obj.name)' % object_type)
+        return query, ParametersI(), None
+
+
+class TestApiQuery(object):
+    """
+    Tests the keyset pagination helpers of the json api.
+    """
+
+    @pytest.mark.parametrize('values', [
+        [1], ['test', 5], [None, 3, 4], [u'n\xe4me', 7]])
+    def test_cursor_round_trip(self, values):
+        token = encode_cursor(values)
+        assert '=' not in token
+        assert decode_cursor(token) == values
+
+    @pytest.mark.parametrize('token', ['', 'not a cursor', 'e30'])
+    def test_bad_cursor(self, token):
+        with pytest.raises(BadRequestError):
+            decode_cursor(token)
+
+    def test_get_sort_keys(self):
+        assert get_sort_keys({}) == ['obj.id']
+        opts = {'order_by': 'lower(obj.lastName), lower(obj.firstName)'}
+        assert get_sort_keys(opts) == [
+            'lower(obj.lastName)', 'lower(obj.firstName)', 'obj.id']
+        assert get_sort_keys({'order_by': 'obj.id'}) == ['obj.id']
+
+    def test_build_keyset_clause(self):
+        params = ParametersI()
+        clause = build_keyset_clause(
+            ['lower(obj.name)', 'obj.id'], ['b', 10], params)
+        assert clause == (
+            '((lower(obj.name) > :cursor0 or lower(obj.name) is null)) or '
+            '(lower(obj.name) = :cursor0 and obj.id > :cursor1)')
+        assert unwrap(params.map['cursor0']) == 'b'
+        assert unwrap(params.map['cursor1']) == 10
+
+    def test_build_keyset_clause_null(self):
+        params = ParametersI()
+        clause = build_keyset_clause(
+            ['lower(obj.name)', 'obj.id'], [None, 10], params)
+        assert clause == '(lower(obj.name) is null and obj.id > :cursor1)'
+        assert 'cursor0' not in params.map
+
+    def test_apply_keyset(self):
+        query = ('select obj from Project obj join fetch obj.details.owner'
+                 ' where owner.id = :eid order by lower(obj.name)')
+        assert apply_keyset(query, ['lower(obj.name)', 'obj.id'], 'X') == (
+            'select obj from Project obj join fetch obj.details.owner'
+            ' where (owner.id = :eid) and (X)'
+            ' order by lower(obj.name), obj.id')
+        query = 'select obj from Project obj'
+        assert apply_keyset(query, ['obj.id'], 'X') == (
+            'select obj from Project obj where X order by obj.id')
+        assert apply_keyset(query, ['obj.id']) == (
+            'select obj from Project obj order by obj.id')
+
+    def test_projection_query(self, fields):
+        query = ('select obj from Project obj'
+                 ' join fetch obj.details.owner as owner'
+                 ' where owner.id = :eid order by lower(obj.name)')
+        assert projection_query(query, fields) == (
+            'select distinct obj.id, obj.name, obj.details.owner.id,'
+            ' lower(obj.name) from Project obj'
+            ' join obj.details.owner as owner'
+            ' where owner.id = :eid order by lower(obj.name)')
+
+    def test_projection_query_filtered(self, fields):
+        # Plates in several screens match once per link
+        query = ('select obj from Plate as obj'
+                 ' join fetch obj.details.owner as owner'
+                 ' left outer join fetch obj.screenLinks spl'
+                 ' left outer join fetch spl.parent sc'
+                 ' where spl.parent.id = :sid'
+                 ' order by lower(obj.name), obj.id')
+        assert projection_query(query, fields) == (
+            'select distinct obj.id, obj.name, obj.details.owner.id,'
+            ' lower(obj.name) from Plate as obj'
+            ' join obj.details.owner as owner'
+            ' left outer join obj.screenLinks spl'
+            ' left outer join spl.parent sc'
+            ' where spl.parent.id = :sid'
+            ' order by lower(obj.name), obj.id')
+        query = 'select distinct obj from Image obj order by obj.id'
+        assert projection_query(query, fields) == (
+            'select distinct obj.id, obj.name, obj.details.owner.id'
+            ' from Image obj order by obj.id')
+
+    def test_split_expressions(self):
+        assert split_expressions('lower(obj.name), obj.id') == [
+            'lower(obj.name)', 'obj.id']
+        assert split_expressions('coalesce(obj.a, obj.b),obj.id ') == [
+            'coalesce(obj.a, obj.b)', 'obj.id']
+
+    def test_marshal_projection(self, fields):
+        rows = [[rlong(1), rstring('p1'), rlong(2)],
+                [rlong(3), None, rlong(2)]]
+        marshalled = marshal_projection(rows, 'Project', fields,
+                                        extras={3: {'omero:childCount': 0}})
+        data = marshalled['data']
+        assert data[0]['@id'] == 1
+        assert data[0]['@type'].endswith('#Project')
+        assert data[0]['Name'] == 'p1'
+        assert data[0]['omero:details'] == {'owner': {'@id': 2}}
+        assert 'Name' not in data[1]
+        assert data[1]['omero:childCount'] == 0
+
+    def test_get_validators(self):
+        conn = MockConnection([[[rlong(10), rlong(3)]]])
+        assert get_validators(conn, 'Dataset', opts={}) == [10, 3]
+        assert conn.qs.queries == [
+            'select max(obj.details.updateEvent.id), count(distinct obj.id)'
+            ' from Dataset obj join obj.details.owner']
+
+    def test_get_validators_links(self):
+        # Linking and unlinking Datasets changes the link validators
+        conn = MockConnection([[[rlong(10), rlong(3)]],
+                               [[rlong(25), rlong(3)]]])
+        assert get_validators(conn, 'Dataset', opts={'project': 2}) == [
+            10, 3, 25, 3]
+        assert conn.qs.queries[1] == (
+            'select max(link.id), count(link.id) from ProjectDatasetLink'
+            ' link where link.parent.id = :id')
+
+    def test_iter_objects(self, monkeypatch):
+        pages = {'': ([1, 2], 'c2'), 'c2': ([3, 4], 'c4'), 'c4': ([5], None)}
+        calls = []
+
+        def query_objects(conn, object_type, group, opts, fields=None):
+            calls.append(dict(opts))
+            ids, cursor = pages[opts['cursor']]
+            return {'data': [{'@id': i} for i in ids],
+                    'meta': {'next': cursor}}
+
+        monkeypatch.setattr(api_query, 'query_objects', query_objects)
+        opts = {'offset': 10, 'limit': 2, 'owner': 3}
+        rv = iter_objects(None, 'Project', -1, opts)
+        # Nothing is loaded until the objects are consumed
+        assert calls == []
+        assert [m['@id'] for m in rv] == [1, 2, 3, 4, 5]
+        assert [c['cursor'] for c in calls] == ['', 'c2', 'c4']
+        for c in calls:
+            assert c['limit'] == api_query.MAX_LIMIT
+            assert c['owner'] == 3
+            assert not c['total_count']
+        # The options of the request aren't modified
+        assert opts == {'offset': 10, 'limit': 2, 'owner': 3}
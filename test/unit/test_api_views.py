@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the views of the "api" module.
+"""
+
+import json
+import pytest
+
+from django.test import RequestFactory
+from omero.gateway import ServiceOptsDict
+from omero.model import DatasetI, ProjectI
+from omero.rtypes import rstring
+
+from omeroweb.api import views
+from omeroweb.api.api_exceptions import BadRequestError
+
+
+class MockConnection(object):
+
+    c = None
+
+
+class MockWrapper(object):
+
+    LINK_CLASS = None
+
+
+class MockQueryService(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.queries = []
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self.queries.append(query)
+        obj_type, ids = query
+        return [o for o in self.objects
+                if o.__class__.__name__ == obj_type + 'I' and
+                o.id.val in ids]
+
+
+class MockBatchConnection(object):
+    """Loads the objects of each type with the 'query' (type, ids)."""
+
+    def __init__(self, objects):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.qs = MockQueryService(objects)
+
+    def buildQuery(self, obj_type, ids=None, opts=None):
+        return (obj_type, sorted(ids)), None, MockWrapper
+
+    def getQueryService(self):
+        return self.qs
+
+
+def project(obj_id, name):
+    obj = ProjectI(obj_id)
+    obj.name = rstring(name)
+    return obj
+
+
+def dataset(obj_id, name):
+    obj = DatasetI(obj_id)
+    obj.name = rstring(name)
+    return obj
+
+
+class MockObjectsView(views.ObjectsView):
+
+    OMERO_TYPE = 'Project'
+    urls = None
+
+
+class TestObjectsView(object):
+
+    @pytest.mark.parametrize('params, accept, streaming', [
+        ({}, None, False),
+        ({'stream': 'false'}, None, False),
+        ({'stream': 'true'}, None, True),
+        ({}, 'application/json', False),
+        ({}, 'application/x-ndjson', True),
+        ({}, 'application/x-ndjson, application/json;q=0.5', True)])
+    def test_is_streaming(self, params, accept, streaming):
+        headers = {}
+        if accept is not None:
+            headers['HTTP_ACCEPT'] = accept
+        request = RequestFactory().get('/api/v0/m/projects/', params,
+                                       **headers)
+        assert MockObjectsView().is_streaming(request) == streaming
+
+    def test_stream_objects(self, monkeypatch):
+        loaded = []
+
+        def iter_objects(conn, object_type, group, opts, fields):
+            assert object_type == 'Project'
+            assert group == 5
+            for i in range(1, 4):
+                loaded.append(i)
+                yield {'@id': i, 'Name': u'p\xe4%d' % i}
+
+        monkeypatch.setattr(views, 'iter_objects', iter_objects)
+        conn = MockConnection()
+        request = RequestFactory().get('/api/v0/m/projects/')
+        rsp = MockObjectsView().stream_objects(request, conn, 5, {}, None,
+                                               api_version='0')
+        assert rsp['Content-Type'] == 'application/x-ndjson'
+        # The response closes the connection once streaming is done
+        assert rsp.conn is conn
+        assert loaded == []
+        content = rsp.streaming_content
+        line = next(content)
+        assert json.loads(line) == {'@id': 1, 'Name': u'p\xe41'}
+        assert loaded == [1]
+        lines = [line] + list(content)
+        assert [json.loads(row)['@id'] for row in lines] == [1, 2, 3]
+        assert all(row.endswith(b'\n') for row in lines)
+        rsp.close()
+
+
+class TestBatchView(object):
+
+    @pytest.mark.parametrize('obj_type, view', [
+        ('Image', views.ImageView),
+        ('image', views.ImageView),
+        ('http://www.openmicroscopy.org/Schemas/OME/2016-06#Dataset',
+         views.DatasetView),
+        ('PlateAcquisition', views.PlateAcquisitionView),
+        ('ExperimenterGroup', views.ExperimenterGroupView),
+        ('Annotation', None),
+        ('childCount', None)])
+    def test_get_object_view(self, obj_type, view):
+        assert views.BatchView.get_object_view(obj_type) is view
+
+    def test_get_refs(self, monkeypatch):
+        refs = []
+        monkeypatch.setattr(views.BatchView, 'load_objects',
+                            lambda self, r, conn, rv, **kw: refs.extend(rv))
+        request = RequestFactory().get(
+            '/api/v0/m/batch/?image=1&childCount=true&dataset=3&image=2')
+        views.BatchView().get(request, None, api_version='0')
+        refs.sort(key=lambda r: (r['@type'], r['@id']))
+        assert refs == [{'@type': 'dataset', '@id': '3'},
+                        {'@type': 'image', '@id': '1'},
+                        {'@type': 'image', '@id': '2'}]
+
+    @pytest.mark.parametrize('body', ['[{"@type": ', '{"@type": "Image"}'])
+    def test_post_invalid(self, body):
+        request = RequestFactory().post('/api/v0/m/batch/', body,
+                                        content_type='application/json')
+        with pytest.raises(BadRequestError):
+            views.BatchView().post(request, None, api_version='0')
+
+    def test_load_objects(self):
+        conn = MockBatchConnection([
+            project(1, 'p1'), project(2, 'p2'), dataset(2, 'd2')])
+        refs = [{'@type': 'Project', '@id': 2},
+                {'@type': 'Dataset', '@id': '2'},
+                {'@type': 'Project', '@id': 5},
+                {'@type': 'Annotation', '@id': 1},
+                {'@type': 'Project'},
+                {'@type': 'Project', '@id': 'one'},
+                {'@type': 'project', '@id': 1},
+                {'@type': 'Project', '@id': 2}]
+        request = RequestFactory().post('/api/v0/m/batch/')
+        data = views.BatchView().load_objects(request, conn, refs,
+                                              api_version='0')['data']
+        # A single query per type
+        assert sorted(conn.qs.queries) == [('Dataset', [2]),
+                                           ('Project', [1, 2, 5])]
+        # Results are in the order of the refs
+        assert [d.get('Name') for d in data] == [
+            'p2', 'd2', None, None, None, None, 'p1', 'p2']
+        assert data[1]['url:images'].endswith('/datasets/2/images/')
+        assert data[2] == {'@type': 'Project', '@id': 5,
+                           'message': 'Project 5 not found', 'status': 404}
+        assert data[3]['status'] == 400
+        assert data[3]['message'] == 'Unknown type: Annotation'
+        assert data[4]['status'] == 400
+        assert data[5]['status'] == 400
+
+    def test_load_objects_max_limit(self, monkeypatch):
+        monkeypatch.setattr(views.api_settings, 'API_MAX_LIMIT', 2)
+        refs = [{'@type': 'Project', '@id': i} for i in range(3)]
+        request = RequestFactory().post('/api/v0/m/batch/')
+        with pytest.raises(BadRequestError):
+            views.BatchView().load_objects(request, None, refs,
+                                           api_version='0')
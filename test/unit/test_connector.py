@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Simple unit tests for the pool of public user connections and the
+keepalive coalescing of the "connector" module.
+"""
+
+import omero
+
+from omeroweb.connector import KeepAliveCoalescer, PublicConnectionPool
+
+
+class MockConnection(object):
+
+    def __init__(self, server_id=1, anonymous=True):
+        self.c = object()
+        self.server_id = server_id
+        self.anonymous = anonymous
+        self._tracked_services = {}
+        self._proxies = {}
+        self.SERVICE_OPTS = None
+
+    def isAnonymous(self):
+        return self.anonymous
+
+    def createServiceOptsDict(self):
+        return {}
+
+
+class MockStatefulPrx(object):
+    pass
+
+
+class MockProxy(object):
+    """
+    Like the gateway's ProxyObjectWrapper, unregisters its stateful
+    service from the connection when closed.
+    """
+
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._obj = MockStatefulPrx()
+        self.name = name
+        conn._tracked_services[name] = []
+
+    def close(self):
+        del self._conn._tracked_services[self.name]
+        self._obj = None
+
+
+class TestPublicConnectionPool(object):
+
+    def test_borrow_release(self):
+        pool = PublicConnectionPool(2, 3600)
+        assert pool.borrow(1) is None
+        c1 = MockConnection()
+        c2 = MockConnection(server_id=2)
+        assert pool.release(c1)
+        assert pool.release(c2)
+        assert c1.SERVICE_OPTS == {}
+        # pool is full
+        assert not pool.release(MockConnection())
+        assert pool.borrow(1) is c1
+        assert pool.borrow(1) is None
+        assert pool.borrow(2) is c2
+
+    def test_not_pooled(self):
+        pool = PublicConnectionPool(2, 3600)
+        assert not pool.release(MockConnection(anonymous=False))
+        conn = MockConnection()
+        conn._tracked_services['RenderingEngine'] = []
+        assert not pool.release(conn)
+        conn = MockConnection()
+        conn.c = None
+        assert not pool.release(conn)
+        assert not PublicConnectionPool(0, 3600).release(MockConnection())
+
+    def test_release_closes_stateful_proxies(self, monkeypatch):
+        monkeypatch.setattr(omero.api, 'StatefulServiceInterfacePrx',
+                            MockStatefulPrx)
+        pool = PublicConnectionPool(2, 3600)
+        conn = MockConnection()
+        proxy = MockProxy(conn, 'RenderingEngine')
+        conn._proxies['rendering'] = proxy
+        assert pool.release(conn)
+        assert proxy._obj is None
+        assert conn._tracked_services == {}
+        assert pool.borrow(1) is conn
+
+
+class TestKeepAliveCoalescer(object):
+
+    def test_due(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr('omeroweb.connector.time.time', lambda: now[0])
+        coalescer = KeepAliveCoalescer(120)
+        assert coalescer.due('a')
+        assert coalescer.due('b')
+        now[0] += 60
+        assert not coalescer.due('a')
+        now[0] += 61
+        assert coalescer.due('a')
+        coalescer.forget('a')
+        assert coalescer.due('a')
+
+    def test_disabled(self):
+        coalescer = KeepAliveCoalescer(0)
+        assert coalescer.due('a')
+        assert coalescer.due('a')
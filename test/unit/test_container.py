@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the tag index of the "container" controller of the
+webclient.
+"""
+
+import pytest
+
+from django.core.cache.backends.locmem import LocMemCache
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rlong, unwrap
+from omeroweb.webclient.controller import container
+from omeroweb.webclient.controller.container import BaseContainer
+from omeroweb.webclient.webclient_gateway import OmeroWebGateway
+
+
+class MockEventContext(object):
+
+    def __init__(self, user_id, groups, is_admin=False):
+        self.userId = user_id
+        self.memberOfGroups = groups
+        self.isAdmin = is_admin
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append((' '.join(query.split()), unwrap(params.map)))
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+    """
+    Lists the tags of 'tags' with the current 'version' of the index and
+    counts how many times they are listed.
+    """
+
+    def __init__(self, user_id, groups, group=3, results=()):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.SERVICE_OPTS.setOmeroGroup(group)
+        self.ctx = MockEventContext(user_id, groups)
+        self.qs = MockQueryService(results)
+        self.version = (10, 2, 5, 1)
+        self.tags = [[1, '', 'tag', 2, None]]
+        self.listed = []
+
+    def getEventContext(self):
+        return self.ctx
+
+    def getObject(self, obj_type, obj_id):
+        return None
+
+    def getQueryService(self):
+        return self.qs
+
+    def getTagIndexVersion(self, eid=None):
+        return self.version
+
+    def listTagsRecursive(self, eid=None, offset=None, limit=1000):
+        self.listed.append(eid)
+        return list(self.tags), {2: 'Test User'}
+
+
+@pytest.fixture(scope='function')
+def tag_cache(monkeypatch):
+    tag_cache = LocMemCache('test_container', {})
+    monkeypatch.setattr(container, 'cache', tag_cache)
+    yield tag_cache
+    tag_cache.clear()
+
+
+def tag(tag_id, text):
+    return [tag_id, 'description %s' % tag_id, text, 2, None]
+
+
+class TestTagIndex(object):
+
+    def test_search_tags(self):
+        manager = BaseContainer(MockConnection(2, [3]))
+        manager.tags_recursive = [
+            tag(1, 'Mitosis'), tag(2, 'anaphase'), tag(3, 'metaphase'),
+            tag(4, 'PHASE contrast'), tag(5, None), tag(6, 'phase'),
+            tag(7, 'dapi')]
+        count, tags = manager.searchTags('Phase')
+        assert count == 4
+        # Prefix matches first, then ordered by text, ignoring case
+        assert [t[0] for t in tags] == [6, 4, 2, 3]
+        assert tags[0] == tag(6, 'phase')
+        count, tags = manager.searchTags('phase', limit=2)
+        assert count == 4
+        assert [t[0] for t in tags] == [6, 4]
+        assert manager.searchTags('nothing') == (0, [])
+
+    def test_cached(self, tag_cache):
+        conn = MockConnection(2, [3])
+        manager = BaseContainer(conn)
+        manager.loadTagIndex()
+        assert manager.tags_recursive == conn.tags
+        assert manager.tags_recursive_owners == {2: 'Test User'}
+        conn.tags = [tag(8, 'new')]
+        BaseContainer(conn).loadTagIndex()
+        assert conn.listed == [2]
+
+    def test_version_changed(self, tag_cache):
+        conn = MockConnection(2, [3])
+        BaseContainer(conn).loadTagIndex()
+        conn.tags = [tag(8, 'new')]
+        conn.version = (11, 3, 5, 1)
+        manager = BaseContainer(conn)
+        manager.loadTagIndex()
+        assert manager.tags_recursive == [tag(8, 'new')]
+        assert conn.listed == [2, 2]
+
+    @pytest.mark.parametrize('user_id, groups, group, shared', [
+        (4, [3], 3, True),
+        (4, [7], 3, False),
+        (2, [3], 7, False),
+        (2, [3], -1, False)])
+    def test_shared(self, tag_cache, user_id, groups, group, shared):
+        BaseContainer(MockConnection(2, [3])).loadTagIndex(eid=5)
+        conn = MockConnection(user_id, groups, group)
+        BaseContainer(conn).loadTagIndex(eid=5)
+        assert conn.listed == ([] if shared else [5])
+
+    def test_get_tag_index_version(self):
+        conn = MockConnection(2, [3], results=[
+            [[rlong(10), rlong(2)]], [[rlong(5), rlong(1)]]])
+        assert OmeroWebGateway.getTagIndexVersion(conn, 2) == (10, 2, 5, 1)
+        (tags, params), (links, params) = conn.qs.queries
+        assert 'from TagAnnotation ann' in tags
+        assert tags.endswith('where ann.details.owner.id = :eid')
+        assert 'from AnnotationAnnotationLink aal' in links
+        assert links.endswith('and ann.details.owner.id = :eid')
+        assert params['eid'] == 2
+
+    def test_get_tag_index_version_all_users(self):
+        conn = MockConnection(2, [3], results=[
+            [[rlong(10), rlong(2)]], [[None, rlong(0)]]])
+        assert OmeroWebGateway.getTagIndexVersion(conn) == (10, 2, None, 0)
+        for query, params in conn.qs.queries:
+            assert ':eid' not in query
+            assert 'eid' not in params
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the "history" controller of the webclient.
+"""
+
+import pytest
+
+from django.core.cache.backends.locmem import LocMemCache
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rlong, rstring, unwrap
+from omeroweb.webclient.controller import history
+from omeroweb.webclient.controller.history import BaseCalendar
+
+
+class MockEventContext(object):
+
+    userId = 2
+    groupId = 3
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append((query, unwrap(params.map), ctx))
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+
+    def __init__(self, results, group=None):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        if group is not None:
+            self.SERVICE_OPTS.setOmeroGroup(group)
+        self.qs = MockQueryService(results)
+
+    def getUserId(self):
+        return 1
+
+    def getEventContext(self):
+        return MockEventContext()
+
+    def createServiceOptsDict(self):
+        return ServiceOptsDict()
+
+    def getQueryService(self):
+        return self.qs
+
+
+@pytest.fixture(scope='function')
+def calendar_cache(monkeypatch):
+    calendar_cache = LocMemCache('test_history', {})
+    monkeypatch.setattr(history, 'cache', calendar_cache)
+    yield calendar_cache
+    calendar_cache.clear()
+
+
+def day_counts(calendar):
+    return dict((int(d['day']), d['counter']) for d in calendar.cal_days
+                if d['day'] > 0)
+
+
+class TestBaseCalendar(object):
+
+    def test_create_calendar(self, calendar_cache):
+        conn = MockConnection([[
+            [rlong(3), rstring('ome.model.core.Image'), rlong(5)],
+            [rlong(3), rstring('ome.model.containers.Project'), rlong(1)],
+            [rlong(28), rstring('ome.model.containers.Dataset'), rlong(2)],
+        ]], group=4)
+        calendar = BaseCalendar(conn, year=2015, month=2)
+        calendar.create_calendar()
+        counts = day_counts(calendar)
+        assert len(counts) == 28
+        assert counts[3] == {'imgCounter': 5, 'dsCounter': 0,
+                             'prCounter': 1}
+        assert counts[28] == {'imgCounter': 0, 'dsCounter': 2,
+                              'prCounter': 0}
+        assert counts[1] == {'imgCounter': 0, 'dsCounter': 0,
+                             'prCounter': 0}
+        # Padding days of the weeks before and after the month
+        assert all(d['counter'] == {} for d in calendar.cal_days
+                   if d['day'] == 0)
+
+        query, params, ctx = conn.qs.queries[0]
+        assert 'group by day(ev.time), el.entityType' in query
+        assert 'ev.experimenterGroup.id = :gid' in query
+        assert params['eid'] == 2
+        assert params['gid'] == 4
+        assert sorted(params['types']) == sorted(history.CALENDAR_TYPES)
+        assert params['end'] > params['start']
+        assert ctx.getOmeroGroup() == '4'
+
+    def test_all_groups(self, calendar_cache):
+        conn = MockConnection([[]], group=-1)
+        calendar = BaseCalendar(conn, year=2015, month=3, eid=7)
+        calendar.create_calendar()
+        assert len(day_counts(calendar)) == 31
+        query, params, ctx = conn.qs.queries[0]
+        assert ':gid' not in query
+        assert 'gid' not in params
+        assert params['eid'] == 7
+
+    def test_cached(self, calendar_cache):
+        rows = [[rlong(10), rstring('ome.model.core.Image'), rlong(4)]]
+        conn = MockConnection([rows], group=4)
+        BaseCalendar(conn, year=2015, month=2).create_calendar()
+        calendar = BaseCalendar(conn, year=2015, month=2)
+        calendar.create_calendar()
+        assert len(conn.qs.queries) == 1
+        assert day_counts(calendar)[10]['imgCounter'] == 4
+
+        # Another month or user isn't cached
+        conn.qs.results.append([])
+        calendar = BaseCalendar(conn, year=2015, month=3)
+        calendar.create_calendar()
+        assert len(conn.qs.queries) == 2
+        conn.qs.results.append([])
+        BaseCalendar(conn, year=2015, month=2, eid=5).create_calendar()
+        assert len(conn.qs.queries) == 3
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the "plategrid" module.
+"""
+
+import pytest
+
+from io import BytesIO
+from PIL import Image
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rint, rlong, rstring, rtime
+from omeroweb.webgateway import plategrid
+from omeroweb.webgateway.plategrid import PlateGrid
+
+
+class MockPlate(object):
+
+    OMERO_CLASS = 'Plate'
+
+    def __init__(self, plate_id, rows, columns):
+        self.id = plate_id
+        self.rows = rows
+        self.columns = columns
+
+    def setGridSizeConstraints(self, rows, columns):
+        pass
+
+    def getGridSize(self):
+        return {'rows': self.rows, 'columns': self.columns}
+
+    def getRowLabels(self):
+        return [chr(ord('A') + r) for r in range(self.rows)]
+
+    def getColumnLabels(self):
+        return [c + 1 for c in range(self.columns)]
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append(query)
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+    """ Returns the JPEG of 'thumbs' for each image ID """
+
+    def __init__(self, plate, results, thumbs):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.plate = plate
+        self.qs = MockQueryService(results)
+        self.thumbs = thumbs
+        self.batches = []
+
+    def getObject(self, obj_type, obj_id):
+        return self.plate
+
+    def getQueryService(self):
+        return self.qs
+
+    def getThumbnailSet(self, image_ids, size):
+        ids = [i.val for i in image_ids]
+        self.batches.append((ids, size))
+        return dict((i, self.thumbs[i]) for i in ids if i in self.thumbs)
+
+
+def well_row(row, column, image_id):
+    return [rint(row), rint(column), rlong(image_id),
+            rstring('image%s' % image_id), rstring('Test User'),
+            rlong(image_id + 100), None, rtime(1000), None]
+
+
+def jpeg(color, size):
+    rv = BytesIO()
+    Image.new('RGB', size, color).save(rv, 'jpeg')
+    return rv.getvalue()
+
+
+def cell_color(atlas, x, y):
+    return tuple((v + 32) // 64 for v in atlas.getpixel((x, y)))
+
+
+class TestPlateGrid(object):
+
+    def test_atlas(self, monkeypatch):
+        monkeypatch.setattr(plategrid, 'ATLAS_THUMBNAIL_BATCH', 2)
+        plate = MockPlate(1, 2, 3)
+        red = jpeg((255, 0, 0), (16, 8))
+        blue = jpeg((0, 0, 255), (16, 16))
+        conn = MockConnection(plate, [[
+            well_row(0, 0, 5), well_row(0, 2, 6), well_row(1, 1, 7),
+            well_row(1, 2, 8)]],
+            {5: red, 6: blue, 7: b'not a jpeg'})
+        atlas = PlateGrid(conn, 1, 0).atlas(16)
+        atlas = Image.open(BytesIO(atlas))
+        assert atlas.format == 'JPEG'
+        assert atlas.size == (3 * 16, 2 * 16)
+        # Thumbnails are loaded in batches
+        assert conn.batches == [([5, 6], 16), ([7, 8], 16)]
+
+        red, blue, white = (4, 0, 0), (0, 0, 4), (4, 4, 4)
+        # A1: landscape thumbnail, centred vertically in its cell
+        assert cell_color(atlas, 8, 8) == red
+        assert cell_color(atlas, 8, 1) == white
+        assert cell_color(atlas, 8, 14) == white
+        # A2: no well, A3: blue thumbnail
+        assert cell_color(atlas, 24, 8) == white
+        assert cell_color(atlas, 40, 1) == blue
+        assert cell_color(atlas, 40, 14) == blue
+        # B2: invalid thumbnail, B3: no thumbnail
+        assert cell_color(atlas, 24, 24) == white
+        assert cell_color(atlas, 40, 24) == white
+
+    def test_atlas_empty(self):
+        conn = MockConnection(MockPlate(1, 2, 3), [[]], {})
+        atlas = Image.open(BytesIO(PlateGrid(conn, 1, 0).atlas(10)))
+        assert atlas.size == (30, 20)
+        assert conn.batches == []
+
+    def test_atlas_no_pil(self, monkeypatch):
+        monkeypatch.setattr(plategrid, 'Image', None)
+        conn = MockConnection(MockPlate(1, 2, 3), [], {})
+        assert PlateGrid(conn, 1, 0).atlas() is None
+        assert conn.qs.queries == []
+
+    @pytest.mark.parametrize('rows, version', [
+        ([[rlong(10), rlong(12), rlong(11)]], '10-12-11'),
+        ([[rlong(10), None, None]], '10-None-None'),
+        ([], '')])
+    def test_version(self, rows, version):
+        conn = MockConnection(MockPlate(1, 2, 3), [rows], {})
+        assert PlateGrid(conn, 1, 0).version == version
+        # No joins multiplying the rows of the plate
+        assert ' join ' not in conn.qs.queries[0]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the "search" controller of the webclient.
+"""
+
+import pytest
+
+from django.core.cache.backends.locmem import LocMemCache
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rint, rlong, rstring
+from omeroweb.webclient.controller import search
+from omeroweb.webclient.controller.search import BaseSearch
+
+
+class MockObject(object):
+
+    def __init__(self, obj_type, obj_id):
+        self.OMERO_CLASS = obj_type
+        self.id = obj_id
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append(query)
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+    """
+    Searches return the objects of 'hits' for each type. Loading objects by
+    id records the group and returns them in the order of the ids.
+    """
+
+    def __init__(self, hits, results=()):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.SERVICE_OPTS.setOmeroGroup(3)
+        self.hits = hits
+        self.searches = []
+        self.loaded = []
+        self.qs = MockQueryService(results)
+
+    def getUserId(self):
+        return 1
+
+    def getEventContext(self):
+        return None
+
+    def getQueryService(self):
+        return self.qs
+
+    def searchObjects(self, obj_types, text, created, **kwargs):
+        self.searches.append(obj_types[0])
+        return [MockObject(obj_types[0], i)
+                for i in self.hits[obj_types[0]]]
+
+    def getObjects(self, obj_type, ids, respect_order=False):
+        assert respect_order
+        self.loaded.append(
+            (obj_type, list(ids), self.SERVICE_OPTS.getOmeroGroup()))
+        return [MockObject(obj_type, i) for i in ids]
+
+
+@pytest.fixture(scope='function')
+def search_cache(monkeypatch):
+    search_cache = LocMemCache('test_search', {})
+    monkeypatch.setattr(search, 'cache', search_cache)
+    yield search_cache
+    search_cache.clear()
+
+
+def do_search(conn, query='test', types=('images', 'datasets'),
+              searchGroup=-1, ownedBy=-1):
+    controller = BaseSearch(conn)
+    controller.search(query, list(types), ['name'], searchGroup, ownedBy,
+                      False)
+    return controller
+
+
+class TestBaseSearch(object):
+
+    def test_search(self, search_cache):
+        conn = MockConnection({'image': [5, 2, 9], 'dataset': [4]})
+        controller = do_search(conn)
+        assert sorted(conn.searches) == ['dataset', 'image']
+        assert [o.id for o in controller.containers['images']] == [5, 2, 9]
+        assert [o.id for o in controller.containers['datasets']] == [4]
+        assert controller.iids == [5, 2, 9]
+        assert controller.c_size == 4
+        assert not controller.moreResults
+        assert conn.loaded == []
+
+    def test_cached_hits(self, search_cache):
+        conn = MockConnection({'image': [5, 2, 9], 'dataset': []})
+        do_search(conn)
+        conn.hits = {'image': [1], 'dataset': [1]}
+        controller = do_search(conn, searchGroup=-1)
+        # The hits are loaded by id in the order of the search
+        assert sorted(conn.searches) == ['dataset', 'image']
+        assert conn.loaded == [('image', [5, 2, 9], '-1')]
+        assert controller.iids == [5, 2, 9]
+        assert controller.containers['datasets'] == []
+        # The group of the connection is restored
+        assert conn.SERVICE_OPTS.getOmeroGroup() == '3'
+
+    @pytest.mark.parametrize('kwargs', [
+        {'query': 'other'}, {'searchGroup': 4}, {'ownedBy': 2},
+        {'types': ['images']}])
+    def test_not_cached(self, search_cache, kwargs):
+        conn = MockConnection({'image': [5], 'dataset': []})
+        do_search(conn)
+        conn.hits['image'] = [6]
+        controller = do_search(conn, **kwargs)
+        assert conn.loaded == []
+        assert controller.iids == [6]
+
+    def test_user_not_cached(self, search_cache, monkeypatch):
+        conn = MockConnection({'image': [5], 'dataset': []})
+        do_search(conn)
+        monkeypatch.setattr(conn, 'getUserId', lambda: 2)
+        conn.hits['image'] = [6]
+        assert do_search(conn).iids == [6]
+        assert conn.loaded == []
+
+    def test_well_names(self, search_cache):
+        conn = MockConnection({'well': [7, 8]}, results=[[
+            [rlong(7), rint(1), rint(2), rstring('plate'),
+             rstring('letter'), rstring('number')],
+            [rlong(8), rint(0), rint(0), rstring('plate'),
+             rstring('number'), rstring('letter')],
+        ]])
+        controller = do_search(conn, types=['wells'])
+        assert len(conn.qs.queries) == 1
+        assert [w.name for w in controller.containers['wells']] == [
+            'plate - B3', 'plate - 1A']
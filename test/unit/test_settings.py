@@ -22,7 +22,14 @@
 Simple integration tests to ensure that the settings are working correctly.
 """
 
+import json
+import os
+import pytest
+
 from omeroweb.connector import Server
+from omeroweb import settings
+from omeroweb.settings import _snapshot_value, file_stamp, \
+    load_settings_snapshot, snapshot_custom_settings
 
 
 # Test model
@@ -86,3 +93,60 @@ class TestServerModel (object):
             assert str(te) == 'No more instances allowed'
 
         Server(host=u'example1.com', port=4064)
+
+
+class TestSettingsSnapshot(object):
+
+    def test_load_settings_snapshot(self, tmpdir):
+        config_xml = tmpdir.join('config.xml')
+        config_xml.write('<icegrid/>')
+        path = tmpdir.join('omeroweb.settings.json')
+        snapshot = {'config_xml': file_stamp(str(config_xml)),
+                    'custom_settings': {'omero.web.debug': 'true'}}
+        path.write(json.dumps(snapshot))
+        assert load_settings_snapshot(str(path), str(config_xml)) == snapshot
+
+        # stale once config.xml changes
+        config_xml.write('<icegrid></icegrid>')
+        assert load_settings_snapshot(str(path), str(config_xml)) is None
+        # missing or invalid
+        assert load_settings_snapshot(
+            str(tmpdir.join('missing')), str(config_xml)) is None
+        path.write('not json')
+        assert load_settings_snapshot(str(path), str(config_xml)) is None
+
+    @pytest.mark.parametrize('value', [
+        None, True, 1, 'text', ['a', 1], {'a': [1, 2]}])
+    def test_snapshot_value(self, value):
+        assert _snapshot_value(value) == value
+
+    @pytest.mark.parametrize('value', [
+        ('a', 'b'), [('a', 1)], {1: 'a'}, object()])
+    def test_snapshot_value_not_stored(self, value):
+        with pytest.raises(ValueError):
+            _snapshot_value(value)
+
+    def test_snapshot_custom_settings(self):
+        custom_settings = {'omero.web.debug': 'true',
+                           'omero.web.myapp.option': 'x',
+                           'omero.mail.host': 'mail.example.com',
+                           'omero.master.host': 'omero.example.com',
+                           'omero.db.pass': 'secret',
+                           'omero.ldap.password': 'secret'}
+        assert snapshot_custom_settings(custom_settings) == {
+            'omero.web.debug': 'true',
+            'omero.web.myapp.option': 'x',
+            'omero.mail.host': 'mail.example.com',
+            'omero.master.host': 'omero.example.com'}
+
+    def test_write_settings_snapshot(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('omeroweb.settings.json'))
+        monkeypatch.setattr(settings, 'SETTINGS_SNAPSHOT_PATH', path)
+        monkeypatch.setattr(settings, 'SNAPSHOT_LOADED', False)
+        monkeypatch.setattr(settings, 'CUSTOM_SETTINGS', {
+            'omero.web.debug': 'true', 'omero.db.pass': 'secret'})
+        settings.write_settings_snapshot()
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        with open(path) as f:
+            snapshot = json.load(f)
+        assert snapshot['custom_settings'] == {'omero.web.debug': 'true'}
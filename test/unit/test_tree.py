@@ -23,9 +23,17 @@ Simple unit tests for the "tree" module.
 
 import pytest
 
-from omero.rtypes import rlong, rstring, rtime
+from omero.model import EventI, ExperimenterI, PermissionsI, \
+    TagAnnotationI
+from omero.rtypes import rlong, rstring, rtime, unwrap
+from omero.gateway import ServiceOptsDict
+from omeroweb.webgateway.webgateway_cache import count_cache, \
+    ThumbnailVersionCache
+from omeroweb.webclient import tree
 from omeroweb.webclient.tree import _marshal_plate_acquisition, \
-    _marshal_dataset, _marshal_plate, parse_permissions_css
+    _marshal_dataset, _marshal_plate, _marshal_annotation_link, \
+    _child_counts, marshal_annotations, marshal_changes, marshal_images, \
+    parse_permissions_css
 
 
 class MockConnection(object):
@@ -33,10 +41,77 @@ class MockConnection(object):
     def getUserId(self):
         return 1
 
+    def getEventContext(self):
+        return None
+
+    def getQueryService(self):
+        return None
+
     def isAdmin(self):
         return False
 
 
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append(query)
+        return self.results.pop(0)
+
+
+class MockChangesConnection(MockConnection):
+
+    def __init__(self, results):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.qs = MockQueryService(results)
+
+    def getQueryService(self):
+        return self.qs
+
+
+class MockAnnotationQueryService(object):
+    """
+    Answers the queries of marshal_annotations() for the given link rows
+    of each parent type and the given annotations, filtered by the IDs
+    bound to each query.
+    """
+
+    def __init__(self, links, annotations):
+        self.links = links
+        self.annotations = dict((a.id.val, a) for a in annotations)
+        self.loaded = []
+
+    def projection(self, query, params, ctx=None):
+        ids = unwrap(params.map['ids'])
+        if 'from Experimenter ' in query:
+            return [[{'id': rlong(eid), 'omeName': rstring('user%s' % eid),
+                      'firstName': rstring('First'),
+                      'lastName': rstring('Last')}] for eid in ids]
+        for dtype, rows in self.links.items():
+            if 'from %sAnnotationLink ' % dtype in query:
+                return [[row] for row in rows
+                        if unwrap(row['parentId']) in ids]
+        return []
+
+    def findAllByQuery(self, query, params, ctx=None):
+        ids = unwrap(params.map['ids'])
+        self.loaded.append(ids)
+        return [self.annotations[i] for i in ids]
+
+
+class MockAnnotationConnection(MockConnection):
+
+    def __init__(self, links, annotations):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.qs = MockAnnotationQueryService(links, annotations)
+
+    def getQueryService(self):
+        return self.qs
+
+
 @pytest.fixture(scope='module')
 def mock_conn():
     return MockConnection()
@@ -275,4 +350,134 @@ class TestTree(object):
         print(expected)
         assert marshaled == expected
 
+    def test_marshal_annotation_link(self):
+        permissions = {'canDelete': True, 'canAnnotate': False,
+                       'canLink': True, 'canEdit': False, 'perm': 'rwra--'}
+        row = {'id': 5, 'ownerId': 2, 'date': 0, 'parentId': 7,
+               'parentName': 'image7', 'annId': 9, 'annNs': None,
+               'oal_details_permissions': permissions}
+        link = _marshal_annotation_link('Image', row)
+        assert link['id'] == 5
+        assert link['owner'] == {'id': 2}
+        assert link['parent'] == {'id': 7, 'class': 'ImageI',
+                                  'name': 'image7'}
+        assert link['date'].endswith('Z')
+        assert link['permissions'] == {'canDelete': True,
+                                       'canAnnotate': False,
+                                       'canLink': True, 'canEdit': False}
+        del row['parentName']
+        link = _marshal_annotation_link('Well', row)
+        assert link['parent'] == {'id': 7, 'class': 'WellI'}
+
     # Add a lot of tests
+
+    def test_child_counts(self):
+        count_cache.clear()
+        conn = MockChangesConnection([[[rlong(1), rlong(3)]]])
+        counts = _child_counts(conn, 'ProjectDatasetLink', [1, 2],
+                               conn.SERVICE_OPTS)
+        assert counts == {1: 3, 2: 0}
+        assert 'group by link.parent.id' in conn.qs.queries[0]
+        # counts are cached, no more queries
+        assert _child_counts(conn, 'ProjectDatasetLink', [2, 1],
+                             conn.SERVICE_OPTS) == counts
+        assert len(conn.qs.queries) == 1
+        count_cache.clear()
+
+    def test_marshal_annotations(self, owner_permissions):
+        def annotation(aid, ns):
+            ann = TagAnnotationI(aid, True)
+            ann.setNs(ns and rstring(ns))
+            ann.setTextValue(rstring('tag%s' % aid))
+            ann.details.setOwner(ExperimenterI(2, False))
+            event = EventI(1, True)
+            event.setTime(rtime(0))
+            ann.details.setCreationEvent(event)
+            ann.details.setPermissions(PermissionsI('rwra--'))
+            return ann
+
+        def link(lid, parent_id, ann_id, ns):
+            return {'id': rlong(lid), 'ownerId': rlong(3), 'date': rtime(0),
+                    'oal_details_permissions': owner_permissions,
+                    'parentId': rlong(parent_id),
+                    'parentName': rstring('parent%s' % parent_id),
+                    'annId': rlong(ann_id), 'annNs': ns and rstring(ns)}
+
+        # Tag 1 is linked to both images and the dataset, and is ordered
+        # after tag 3 by namespace but before tag 2, which has none
+        links = {
+            'Image': [link(100, 10, 1, 'b.ns'), link(101, 10, 2, None),
+                      link(102, 11, 1, 'b.ns'), link(103, 11, 3, 'a.ns')],
+            'Dataset': [link(104, 20, 1, 'b.ns')],
+        }
+        annotations = [annotation(1, 'b.ns'), annotation(2, None),
+                       annotation(3, 'a.ns')]
+
+        conn = MockAnnotationConnection(links, annotations)
+        anns, exps = marshal_annotations(conn, image_ids=[10, 11],
+                                         dataset_ids=[20], page=1, limit=2)
+        assert [(a['id'], a['link']['id']) for a in anns] == \
+            [(3, 103), (1, 104), (1, 100), (1, 102)]
+        assert anns[0]['ns'] == 'a.ns'
+        assert anns[1]['link']['parent'] == {
+            'id': 20, 'class': 'DatasetI', 'name': 'parent20'}
+        assert anns[2]['link']['parent']['class'] == 'ImageI'
+        # Each link has its own copy of the annotation, loaded only once
+        assert conn.qs.loaded == [[3, 1]]
+        assert anns[1] is not anns[2]
+        assert anns[1]['textValue'] == anns[2]['textValue'] == 'tag1'
+        assert [e['id'] for e in exps] == [2, 3]
+
+        conn = MockAnnotationConnection(links, annotations)
+        anns, exps = marshal_annotations(conn, image_ids=[10, 11],
+                                         dataset_ids=[20], page=2, limit=2)
+        assert [(a['id'], a['link']['id']) for a in anns] == [(2, 101)]
+        assert anns[0]['ns'] is None
+        assert conn.qs.loaded == [[2]]
+
+    def test_marshal_images_thumb_version(self, owner_permissions,
+                                          monkeypatch):
+        monkeypatch.setattr(tree, 'thumbnail_version_cache',
+                            ThumbnailVersionCache(10))
+        images = [[{'id': rlong(iid), 'name': rstring('image%s' % iid),
+                    'ownerId': rlong(1),
+                    'image_details_permissions': owner_permissions,
+                    'filesetId': None}]
+                  for iid in (1, 2)]
+        # only image 1 has a thumbnail
+        thumbs = [[rlong(1), rlong(3)]]
+        conn = MockChangesConnection([images, thumbs, images, []])
+        marshaled = marshal_images(conn, thumb_version=True)
+        assert [i.get('thumbVersion') for i in marshaled] == [3, None]
+        # image 2 is queried again, its thumbnail may have been created
+        marshaled = marshal_images(conn, thumb_version=True)
+        assert [i.get('thumbVersion') for i in marshaled] == [3, None]
+        assert len(conn.qs.queries) == 4
+        assert tree.thumbnail_version_cache.get(1, [1, 2]) == {1: 3}
+
+    def test_marshal_changes(self, owner_permissions):
+        # link rows: child id, link creationEvent, child updateEvent
+        links = [[rlong(1), rlong(5), rlong(5)],
+                 [rlong(2), rlong(20), rlong(20)],
+                 [rlong(3), rlong(5), rlong(30)]]
+        images = [[{'id': rlong(iid), 'name': rstring('image%s' % iid),
+                    'ownerId': rlong(1),
+                    'image_details_permissions': owner_permissions,
+                    'filesetId': None}]
+                  for iid in (2, 3)]
+        conn = MockChangesConnection([links, images])
+        changes = marshal_changes(conn, 'dataset', 10, since=10,
+                                  known_ids=[1, 3, 4])
+        assert [i['id'] for i in changes['added']] == [2]
+        assert [i['id'] for i in changes['updated']] == [3]
+        assert changes['removed'] == [{'id': 4, 'deleted': True}]
+        assert changes['token'] == 30
+        assert 'image.id in (:imageIds)' in conn.qs.queries[1]
+
+    def test_marshal_changes_unchanged(self):
+        links = [[rlong(1), rlong(5), rlong(5)]]
+        conn = MockChangesConnection([links])
+        changes = marshal_changes(conn, 'dataset', 10, since=10)
+        assert changes == {'added': [], 'updated': [], 'removed': [],
+                           'token': 10}
+        assert len(conn.qs.queries) == 1
@@ -28,11 +28,27 @@ import json
 from django.core.urlresolvers import reverse
 
 from omeroweb.utils import reverse_with_params, sort_properties_to_tuple
+from omeroweb.utils import run_chunked, run_queries, _query_thread
+from omeroweb.utils import is_preloaded
 from omeroweb.webclient.webclient_utils import formatPercentFraction
 from omeroweb.webclient.webclient_utils import getDateTime
 from omeroweb.connector import Connector
 
 
+class MockConnection(object):
+
+    def getEventContext(self):
+        return None
+
+    def getQueryService(self):
+        return None
+
+
+@pytest.fixture(scope='module')
+def mock_conn():
+    return MockConnection()
+
+
 class TestUtil(object):
     """
     Tests various util methods
@@ -140,3 +156,101 @@ class TestUtil(object):
         client = versions[1]
         compatible = versions[2]
         assert Connector.is_compatible(server, client) == compatible
+
+    def test_run_queries(self, mock_conn):
+        def add(a, b):
+            return a + b
+
+        def nested(conn):
+            return run_queries(conn, {'x': (add, {'a': 1, 'b': 2}),
+                                      'y': (add, {'a': 3, 'b': 4})})
+
+        results = run_queries(mock_conn, {
+            'one': (add, {'a': 1, 'b': 0}),
+            'two': (add, {'a': 1, 'b': 1}),
+            'nested': (nested, {'conn': mock_conn}),
+        })
+        assert results == {'one': 1, 'two': 2, 'nested': {'x': 3, 'y': 7}}
+
+    def test_run_queries_nested_twice(self, mock_conn):
+        def add(a, b):
+            return a + b
+
+        def nested(conn):
+            # Still in the pool after a nested call, so that the second
+            # call runs inline instead of waiting on the pool
+            first = run_queries(conn, {'x': (add, {'a': 1, 'b': 2}),
+                                       'y': (add, {'a': 3, 'b': 4})})
+            in_pool = _query_thread.in_pool
+            second = run_queries(conn, {'x': (add, {'a': 5, 'b': 6}),
+                                        'y': (add, {'a': 7, 'b': 8})})
+            return first, second, in_pool
+
+        results = run_queries(mock_conn, {
+            'one': (nested, {'conn': mock_conn}),
+            'two': (nested, {'conn': mock_conn}),
+        })
+        for key in ('one', 'two'):
+            assert results[key] == ({'x': 3, 'y': 7}, {'x': 11, 'y': 15},
+                                    True)
+
+    def test_run_queries_error(self, mock_conn):
+        def fail():
+            raise ValueError('fail')
+
+        with pytest.raises(ValueError):
+            run_queries(mock_conn, {'ok': (dict, {}), 'fail': (fail, {})})
+
+    def test_run_chunked(self, mock_conn):
+        calls = []
+
+        def load(ids):
+            calls.append(ids)
+            return [i * 10 for i in ids]
+
+        assert run_chunked(mock_conn, load, []) == []
+        assert calls == []
+        assert run_chunked(mock_conn, load, range(5), chunk_size=2) == \
+            [0, 10, 20, 30, 40]
+        assert sorted(calls) == [[0, 1], [2, 3], [4]]
+
+    def test_run_chunked_paged(self, mock_conn):
+        # Collation of the query, which Python can't reproduce by sorting
+        names = {3: 'b', 8: 'A', 1: None, 9: 'a', 4: 'c', 7: 'B'}
+        db_order = [8, 9, 7, 3, 4, 1]
+        calls = []
+
+        def load(ids, offset=0, limit=None):
+            calls.append(sorted(ids))
+            rows = [{'id': i, 'name': names[i]} for i in db_order
+                    if i in ids]
+            return rows[offset:offset + limit]
+
+        def page(offset, limit, chunk_size):
+            del calls[:]
+            rows = run_chunked(mock_conn, load, [3, 8, 1, 9, 4, 7],
+                               id_key=lambda r: r['id'], offset=offset,
+                               limit=limit, chunk_size=chunk_size)
+            return [r['id'] for r in rows]
+
+        assert page(1, 3, 10) == [9, 7, 3]
+        assert calls == [[1, 3, 4, 7, 8, 9]]
+        # The first 3 of each chunk, until those fit in one query
+        assert page(1, 2, 4) == [9, 7]
+        assert sorted(calls[:2]) == [[1, 3, 8, 9], [4, 7]]
+        assert sorted(calls[2:4]) == [[3, 7, 8, 9], [4]]
+        assert calls[4:] == [[4, 7, 8, 9]]
+        assert page(0, 1, 2) == [8]
+        assert calls[-1] == [7, 8]
+        # The chunks can't narrow down the IDs: a single query for all
+        assert page(4, 3, 4) == [4, 1]
+        assert calls[-1] == [1, 3, 4, 7, 8, 9]
+
+    @pytest.mark.parametrize('worker_class', ['sync', 'gevent'])
+    @pytest.mark.parametrize('preload', [False, True])
+    def test_is_preloaded(self, worker_class, preload):
+        class Settings(object):
+            WSGI_WORKER_CLASS = worker_class
+            WSGI_PRELOAD = preload
+
+        assert is_preloaded(Settings) == (preload and worker_class == 'sync')
@@ -356,6 +356,16 @@ class TestWeb(object):
         assert startout == o.split(os.linesep)[1]
         assert 2 == len(o.split(os.linesep))-1
 
+    @pytest.mark.parametrize('worker_class', ['sync', 'gevent'])
+    @pytest.mark.parametrize('preload', [False, True])
+    def testWebPreload(self, worker_class, preload, monkeypatch):
+        monkeypatch.setattr(settings, 'WSGI_WORKER_CLASS', worker_class,
+                            raising=False)
+        monkeypatch.setattr(settings, 'WSGI_PRELOAD', preload,
+                            raising=False)
+        cmd = WebControl()._build_run_cmd(settings).split()
+        assert ('--preload' in cmd) == (preload and worker_class == 'sync')
+
     @pytest.mark.parametrize('max_body_size', [None, '0', '1m'])
     @pytest.mark.parametrize('server_type', [
         "nginx", "nginx-development"])
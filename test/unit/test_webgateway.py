@@ -8,6 +8,10 @@ import pytest
 
 from omeroweb.webgateway.webgateway_cache import FileCache, WebGatewayCache
 from omeroweb.webgateway.webgateway_cache import WebGatewayTempFile
+from omeroweb.webgateway.webgateway_cache import ThumbnailVersionCache
+from omeroweb.webgateway.webgateway_cache import CountCache
+from omeroweb.webgateway.jobs import BackgroundJobs
+from omeroweb.webgateway.util import parse_byte_range
 import omero.gateway
 
 
@@ -164,6 +168,123 @@ class TestFileCache(object):
         assert self.cache._num_entries == 0
 
 
+class TestThumbnailVersionCache(object):
+    def testGetSet(self):
+        cache = ThumbnailVersionCache(10)
+        assert cache.get(1, [1, 2]) == {}
+        cache.set(1, {1: 5, 2: None})
+        assert cache.get(1, [1, 2, 3]) == {1: 5, 2: None}
+        # versions are kept per thumbnail owner
+        assert cache.get(2, [1]) == {}
+        cache.set(2, {1: 7})
+        assert cache.get(1, [1]) == {1: 5}
+        assert cache.get(2, [1]) == {1: 7}
+        cache.clear(1)
+        assert cache.get(1, [1, 2]) == {2: None}
+        assert cache.get(2, [1]) == {}
+
+    def testMaxSize(self):
+        cache = ThumbnailVersionCache(2)
+        cache.set(1, {1: 1, 2: 2})
+        # least recently used image is dropped
+        assert cache.get(1, [1]) == {1: 1}
+        cache.set(1, {3: 3})
+        assert cache.get(1, [1, 2, 3]) == {1: 1, 3: 3}
+
+    def testTimeout(self):
+        cache = ThumbnailVersionCache(10, timeout=0)
+        cache.set(1, {1: 1})
+        time.sleep(0.01)
+        assert cache.get(1, [1]) == {}
+
+    def testDisabled(self):
+        cache = ThumbnailVersionCache(0)
+        cache.set(1, {1: 1})
+        assert cache.get(1, [1]) == {}
+
+
+class TestCountCache(object):
+    def testGetSet(self):
+        cache = CountCache(60)
+        key = (1, '-1', None, 'ProjectDatasetLink', None, 3)
+        assert cache.get(key) is None
+        cache.set(key, 0)
+        assert cache.get(key) == 0
+        cache.set_many({(1, '-1', 2, 'TagAnnotation'): 4})
+        assert cache.get_many([key, (1, '-1', 2, 'TagAnnotation'), 'x']) == {
+            key: 0, (1, '-1', 2, 'TagAnnotation'): 4}
+        cache.clear()
+        assert cache.get_many([key]) == {}
+
+    def testMaxSize(self):
+        cache = CountCache(60, size=2)
+        cache.set_many({1: 1, 2: 2})
+        cache.set(3, 3)
+        assert cache.get_many([1, 2, 3]) == {2: 2, 3: 3}
+
+    def testTimeout(self):
+        cache = CountCache(0.001)
+        cache.set(1, 1)
+        time.sleep(0.01)
+        assert cache.get(1) is None
+
+    def testDisabled(self):
+        cache = CountCache(0)
+        cache.set(1, 1)
+        assert cache.get(1) is None
+
+
+class TestBackgroundJobs(object):
+    def _wait(self, jobs, job_id):
+        for i in range(100):
+            status = jobs.status(job_id)
+            if status['status'] != 'in progress':
+                return status
+            time.sleep(0.05)
+        return status
+
+    def testFinished(self):
+        jobs = BackgroundJobs(2)
+        job_id = jobs.submit(lambda a, b: a + b, 1, b=2)
+        assert job_id.startswith('WebJob/')
+        assert self._wait(jobs, job_id) == {
+            'status': 'finished', 'result': 3}
+
+    def testFailed(self):
+        def fail():
+            raise ValueError('fail')
+        jobs = BackgroundJobs(1)
+        job_id = jobs.submit(fail)
+        assert self._wait(jobs, job_id) == {
+            'status': 'failed', 'error': 'fail'}
+
+    def testUnknown(self):
+        assert BackgroundJobs(1).status('WebJob/unknown') is None
+
+
+class TestByteRange(object):
+
+    @pytest.mark.parametrize('header, expected', [
+        (None, None),
+        ('', None),
+        ('bytes=0-99', (0, 99)),
+        ('bytes=100-', (100, 999)),
+        ('bytes=-100', (900, 999)),
+        ('bytes=-5000', (0, 999)),
+        ('bytes=900-5000', (900, 999)),
+        ('bytes=500-100', None),
+        ('bytes=0-1,5-6', None),
+        ('lines=0-1', None),
+    ])
+    def testParseByteRange(self, header, expected):
+        assert parse_byte_range(header, 1000) == expected
+
+    @pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=-0'])
+    def testUnsatisfiableRange(self, header):
+        with pytest.raises(ValueError):
+            parse_byte_range(header, 1000)
+
+
 class TestWebGatewayCacheTempFile(object):
     @pytest.fixture(autouse=True)
     def setUp(self, request):
@@ -292,6 +413,25 @@ class TestWebGatewayCache(object):
         self.wcache.clear()
         assert self.wcache._thumb_cache._num_entries == 0
 
+    def testPlateAtlasCache(self):
+        plate = omero.gateway.PlateWrapper(None, omero.model.PlateI(1, False))
+        other = omero.gateway.PlateWrapper(None, omero.model.PlateI(2, False))
+        assert self.wcache.getPlateAtlas(None, 'test', 123, plate, 'a') is None
+        self.wcache.setPlateAtlas(None, 'test', 123, plate, 'atlas1', 'a')
+        self.wcache.setPlateAtlas(None, 'test', 123, other, 'atlas2', 'a')
+        self.wcache.setPlateAtlas(None, 'test', 456, plate, 'atlas3', 'a')
+        assert (self.wcache.getPlateAtlas(None, 'test', 123, plate, 'a') ==
+                'atlas1')
+        assert self.wcache.getPlateAtlas(None, 'test', 123, plate, 'b') is None
+        # Atlases are kept per user
+        assert (self.wcache.getPlateAtlas(None, 'test', 456, plate, 'a') ==
+                'atlas3')
+        self.wcache.clearPlateAtlases('test', 123)
+        assert self.wcache.getPlateAtlas(None, 'test', 123, plate, 'a') is None
+        assert self.wcache.getPlateAtlas(None, 'test', 123, other, 'a') is None
+        assert (self.wcache.getPlateAtlas(None, 'test', 456, plate, 'a') ==
+                'atlas3')
+
     def testImageCache(self):
         uid = 123
         # Also add a thumb, a split channel and a projection, as it should get
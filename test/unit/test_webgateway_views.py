@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simple unit tests for the views of the "webgateway" module.
+"""
+
+import pytest
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rdouble, rint, rlong, rstring, unwrap
+from omeroweb.webgateway import views
+
+
+class MockConnector(object):
+
+    server_id = 1
+
+
+class MockObject(object):
+
+    def __init__(self, obj_type, obj_id):
+        self.OMERO_CLASS = obj_type
+        self.id = obj_id
+
+    def simpleMarshal(self, xtra=None, parents=False):
+        return {'type': self.OMERO_CLASS, 'id': self.id}
+
+
+class MockSearchConnection(object):
+    """
+    Searches return the 'hits'. Loading objects by id records the ids and
+    returns the ones that still exist.
+    """
+
+    def __init__(self, hits):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.hits = hits
+        self.searches = []
+        self.loaded = []
+        self.deleted = set()
+
+    def getUserId(self):
+        return 1
+
+    def searchObjects(self, obj_types, text, opts=None):
+        self.searches.append((obj_types, text))
+        return [MockObject(t, i) for t, i in self.hits]
+
+    def getObjects(self, obj_type, ids, respect_order=False):
+        self.loaded.append((obj_type, list(ids), respect_order))
+        return [MockObject(obj_type, i) for i in ids
+                if (obj_type, i) not in self.deleted]
+
+
+class MockQueryService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.queries = []
+
+    def projection(self, query, params, ctx=None):
+        self.queries.append((query, unwrap(params.map), ctx))
+        return self.results.pop(0)
+
+
+class MockConnection(object):
+
+    def __init__(self, results):
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.SERVICE_OPTS.setOmeroGroup(3)
+        self.qs = MockQueryService(results)
+
+    def getUserId(self):
+        return 1
+
+    def getQueryService(self):
+        return self.qs
+
+
+def channel_row(iid, idx, name=None, wave=None, ptype='uint8', size_c=2):
+    return [rlong(iid), rstring(ptype), rint(size_c), rint(idx),
+            name is not None and rstring(name) or None,
+            wave is not None and rdouble(wave) or None]
+
+
+@pytest.fixture(scope='function')
+def django_cache(monkeypatch):
+    django_cache = LocMemCache('test_webgateway_views', {})
+    monkeypatch.setattr(views, 'django_cache', django_cache)
+    yield django_cache
+    django_cache.clear()
+
+
+def search_json(conn, **params):
+    request = RequestFactory().get('/webgateway/search/', params)
+    request.session = {'connector': MockConnector()}
+    rv = views.search_json(request, conn=conn, _raw=True)
+    return [(r['type'], r['id']) for r in rv]
+
+
+class TestSearchJson(object):
+
+    hits = [('Image', 1), ('Dataset', 2), ('Image', 3), ('Project', 4),
+            ('Image', 5)]
+
+    def test_page(self, django_cache):
+        conn = MockSearchConnection(self.hits)
+        assert search_json(conn, text='test', start=1, limit=2) == \
+            self.hits[1:3]
+        assert conn.searches == [(None, b'test')]
+        # The objects of the search are marshalled without loading them
+        assert conn.loaded == []
+
+    def test_cached_pages(self, django_cache):
+        conn = MockSearchConnection(self.hits)
+        assert search_json(conn, text='test', limit=2) == self.hits[:2]
+        conn.deleted.add(('Image', 5))
+        assert search_json(conn, text='test', start=2, limit=3) == \
+            self.hits[2:4]
+        assert search_json(conn, text='test', start=3) == self.hits[3:4]
+        assert search_json(conn, text='test', start=7, limit=2) == []
+        assert len(conn.searches) == 1
+        # Only the objects of each page are loaded, one query per type
+        assert sorted(conn.loaded) == [
+            ('Image', [3, 5], False), ('Image', [5], False),
+            ('Project', [4], False), ('Project', [4], False)]
+
+    @pytest.mark.parametrize('params', [
+        {'text': 'other'}, {'text': 'test', 'ctx': 'imgs'},
+        {'text': 'Test'}])
+    def test_not_cached(self, django_cache, params):
+        conn = MockSearchConnection(self.hits)
+        search_json(conn, text='test')
+        search_json(conn, **params)
+        assert len(conn.searches) == 2
+        assert conn.loaded == []
+
+    def test_grab_data(self, django_cache, monkeypatch):
+        pages = []
+
+        def imagesData_json(request, image_ids, key=None, conn=None):
+            pages.append((image_ids, key))
+            return [{'type': 'Image', 'id': i} for i in image_ids]
+
+        monkeypatch.setattr(views, 'imagesData_json', imagesData_json)
+        hits = [('Image', 1), ('Image', 3), ('Image', 5)]
+        conn = MockSearchConnection(hits)
+        for start in (0, 2):
+            assert search_json(conn, text='test', ctx='imgs', grabData=1,
+                               start=start, limit=2, key='id') == \
+                hits[start:start + 2]
+        assert pages == [([1, 3], 'id'), ([5], 'id')]
+        assert conn.searches == [(['image'], b'test')]
+
+    def test_images_data(self, monkeypatch):
+        def imageMarshal(image, key=None, request=None):
+            if image.id == 3:
+                raise AttributeError('No pixels')
+            return {'id': image.id}
+
+        monkeypatch.setattr(views, 'imageMarshal', imageMarshal)
+        conn = MockSearchConnection([])
+        request = RequestFactory().get('/webgateway/search/')
+        assert views.imagesData_json(request, [], conn=conn) == []
+        assert conn.loaded == []
+        rv = views.imagesData_json(request, [5, 3, 1], conn=conn)
+        assert rv == [{'id': 5}, {'id': 1}]
+        assert conn.loaded == [('Image', [5, 3, 1], True)]
+
+
+class TestCompatibleImages(object):
+
+    def test_channel_signatures(self):
+        conn = MockConnection([[
+            channel_row(1, 0, name='DAPI'),
+            channel_row(1, 1, name='GFP'),
+            channel_row(2, 0, name=' ', wave=520.0),
+            channel_row(2, 1, wave=512.5),
+            channel_row(2, 2, ptype='uint16', size_c=3),
+        ]])
+        params = views.omero.sys.ParametersI()
+        params.addId(7)
+        rv = views._channel_signatures(conn, 'image.id = :id', params)
+        # Labels are sorted, so the order of channels doesn't matter
+        assert rv == {1: ('uint8', 2, ('DAPI', 'GFP')),
+                      2: ('uint8', 2, ('2', '512.5', '520'))}
+        query, params, ctx = conn.qs.queries[0]
+        assert query.strip().endswith('where image.id = :id')
+        assert params == {'id': 7}
+        # All groups, without changing the group of the connection
+        assert ctx.getOmeroGroup() == '-1'
+        assert conn.SERVICE_OPTS.getOmeroGroup() == '3'
+
+    def test_list_compatible_imgs(self, django_cache):
+        source = [channel_row(3, 0, name='GFP'), channel_row(3, 1, name='RFP')]
+        project = source + [
+            channel_row(1, 0, name='RFP'), channel_row(1, 1, name='GFP'),
+            channel_row(2, 0, name='GFP'), channel_row(2, 1, name='DAPI'),
+            channel_row(4, 0, name='GFP', ptype='uint16'),
+            channel_row(4, 1, name='RFP', ptype='uint16')]
+        conn = MockConnection([source, project])
+        assert views._list_compatible_imgs(conn, 5, 3) == [1, 3]
+        assert conn.qs.queries[1][1] == {'id': 5}
+        # The project isn't queried again for the same signature
+        conn.qs.results.append(source)
+        assert views._list_compatible_imgs(conn, 5, 3) == [1, 3]
+        assert len(conn.qs.queries) == 3
+
+    def test_list_compatible_imgs_no_channels(self, django_cache):
+        conn = MockConnection([[]])
+        assert views._list_compatible_imgs(conn, 5, 3) == []
+        assert len(conn.qs.queries) == 1